@@ -3,36 +3,57 @@
 四层AI融合体 · FastAPI · Vercel Serverless
 """
 
+from __future__ import annotations
+
 import os
+import sys
 import json
+import time
+import hashlib
 import asyncio
 import logging
-from typing import Optional
+import tempfile
+import importlib
+import importlib.util
+from typing import TYPE_CHECKING, Optional
+
+# 冷启动计时：记录各模块首次导入耗时（毫秒）
+BOOT_STARTED = time.perf_counter()
+IMPORT_TIMES = {}
+
+
+def timed_import(name: str):
+    """导入模块并记录首次导入耗时"""
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.setdefault(name, round((time.perf_counter() - started) * 1000, 1))
+    return module
+
+
+timed_import('fastapi')
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import JSONResponse, PlainTextResponse
-from telegram import Update
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters
-)
 
-# AI客户端
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OpenAI = None
-    OPENAI_AVAILABLE = False
-
-try:
-    import anthropic
-    ANTHROPIC_AVAILABLE = True
-except ImportError:
-    anthropic = None
-    ANTHROPIC_AVAILABLE = False
+if TYPE_CHECKING:
+    # 仅用于类型注解；运行时 telegram 在首次处理更新时才导入
+    from telegram import Update
+    from telegram.ext import ContextTypes
+
+# AI客户端（异步版本，不阻塞事件循环）在首次使用时才导入，这里只检查是否安装
+OPENAI_AVAILABLE = importlib.util.find_spec('openai') is not None
+ANTHROPIC_AVAILABLE = importlib.util.find_spec('anthropic') is not None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+timed_import('onikali.router')
+from onikali.hedge import LatencyTracker, race
+from onikali.router import LayerRouter, emergency_reply, load_config, OPEN
+from onikali.ratelimit import RateLimiters
+from onikali.cache import TTLCache, DedupeWindow
+from onikali.progress import ProgressiveEdit, ProgressGroup
+from onikali.outbox import Outbox
+from onikali.singleflight import SingleFlight
+from onikali.state import StateError, describe as describe_backend, open_backend
+from onikali import metrics
 
 # 配置日志
 logging.basicConfig(
@@ -44,172 +65,562 @@ logger = logging.getLogger(__name__)
 # FastAPI应用
 app = FastAPI(title="ÖNIKA LI Bot", version="1.0.0")
 
+# 单个worker内同时进行的LLM请求上限
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))
+
+SYSTEM_PROMPT = "你是 ÖNIKA LI，摇滚风格AI助手，简洁有力，偶尔用emoji。"
+
+# 各层的 (模型, temperature)，用于构造缓存键
+LAYER_MODELS = {
+    "L1_Kimi": ("moonshot-v1-8k", 0.7),
+    "L4_Claude": ("claude-3-sonnet-20240229", None),
+}
+
+# LLM响应缓存：按指令设置TTL（秒），未列出的指令不缓存
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', '256'))
+LLM_CACHE_TTL = {
+    "hello": float(os.getenv('LLM_CACHE_TTL_HELLO', '3600')),
+    "create": float(os.getenv('LLM_CACHE_TTL_CREATE', '900')),
+}
+# 过期后仍可先返回旧结果、后台刷新的时间窗口（0 表示关闭）
+LLM_CACHE_STALE = float(os.getenv('LLM_CACHE_STALE', '600'))
+LLM_CACHE_DISABLED = os.getenv('LLM_CACHE_DISABLED', '0') == '1'
+# 指令末尾加上该参数可跳过缓存，如 /hello --fresh
+CACHE_BYPASS_FLAG = "--fresh"
+
+# Webhook：立即应答，后台按会话调度处理；update_id 去重防止重复投递
+# WEBHOOK_WORKERS 为同时处理的更新数，/start、/status、/help 另有独立的快速通道
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+UPDATE_DEDUPE_TTL = float(os.getenv('UPDATE_DEDUPE_TTL', '3600'))
+# 返回响应后会冻结进程的平台（如Vercel）默认改为处理完再应答，仍保留去重
+WEBHOOK_INLINE = os.getenv('WEBHOOK_INLINE', '1' if os.getenv('VERCEL') else '0') == '1'
+
+# 雷达状态文件（Serverless 环境只有临时目录可写，实例回收后从头扫描）
+RADAR_STATE = os.getenv('RADAR_STATE', os.path.join(tempfile.gettempdir(), 'onikali_radar_state.json'))
+
+# 预先确定的指令表：指令 -> BotState 方法名
+COMMANDS = (
+    ("start", "cmd_start"),
+    ("status", "cmd_status"),
+    ("hello", "cmd_hello"),
+    ("help", "cmd_help"),
+    ("create", "cmd_create"),
+    ("radar", "cmd_radar"),
+)
+
+# 显式设置 TELEGRAM_BOT_USERNAME 时由 token 和它推出身份、跳过 getMe，省去冷启动的一次网络往返；
+# 不用配置中的用户名，token 属于其他 bot 时群组里的 /cmd@用户名 会被误判
+SKIP_GET_ME = os.getenv('TELEGRAM_SKIP_GET_ME', '1') == '1'
+
+
+def make_prefetched_bot(token: str, me):
+    """创建已知身份的 ExtBot，initialize() 时不再请求 getMe"""
+    from telegram.ext import ExtBot
+
+    class PrefetchedBot(ExtBot):
+        async def get_me(self, *args, **kwargs):
+            if self._bot_user is None:
+                self._bot_user = me
+            return me
+
+    return PrefetchedBot(token)
+
 # 全局状态
 class BotState:
     def __init__(self):
         self.token = os.getenv('TELEGRAM_TOKEN')
         self.moonshot_key = os.getenv('MOONSHOT_API_KEY')
         self.anthropic_key = os.getenv('ANTHROPIC_API_KEY')
-        self.moonshot_client = None
-        self.anthropic_client = None
-        self.current_layer = 1
+        self._moonshot_client = None
+        self._anthropic_client = None
+        self._current_layer = 1
         self.application = None
         self.initialized = False
-
-    def init_clients(self):
-        """初始化AI客户端"""
-        if OPENAI_AVAILABLE and self.moonshot_key:
-            self.moonshot_client = OpenAI(
+        self.llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        # STATE_BACKEND 设置后，层健康、当前层、LLM缓存和 update_id 去重在各 worker / 实例间共享
+        self.shared = open_backend('api')
+        self.router = LayerRouter(backend=open_backend('api_layers'))
+        self.latency = LatencyTracker(defaults=self.router.hedge_delays())
+        self.limiters = RateLimiters(self.router.layers)
+        # Telegram 发送出口：限流、RetryAfter 重试、长文分条、编辑合并
+        self.outbox = Outbox()
+        self.llm_cache = TTLCache(maxsize=LLM_CACHE_SIZE, backend=open_backend('llm'), grace=LLM_CACHE_STALE)
+        self._refreshing = set()
+        self.generations = SingleFlight("generation")
+        self.seen_updates = DedupeWindow(UPDATE_DEDUPE_TTL, backend=open_backend('updates'))
+        self.tasks = set()
+        self._init_lock = asyncio.Lock()
+        self.bot_init_ms = None
+        self._http_pool = None
+        self._radar_lock = asyncio.Lock()
+
+    @property
+    def current_layer(self) -> int:
+        """最近一次成功响应的层（本实例内存中的值，load_current_layer() 读取所有实例中最近的一次）"""
+        return self._current_layer
+
+    @current_layer.setter
+    def current_layer(self, layer: int):
+        self._current_layer = layer
+        if self.shared is not None:
+            self.shared.set_nowait("current_layer", str(layer), 86400)
+
+    async def load_current_layer(self) -> int:
+        if self.shared is not None:
+            try:
+                row = await self.shared.aget("current_layer")
+                if row is not None:
+                    self._current_layer = int(row[0])
+            except StateError as e:
+                logger.warning(f"当前层读取失败: {e}")
+        return self._current_layer
+
+    def layer_configured(self, key: str) -> bool:
+        """该层是否可用（已安装SDK且配置了Key），不会创建客户端"""
+        if key == "L1_Kimi":
+            return OPENAI_AVAILABLE and bool(self.moonshot_key)
+        if key == "L4_Claude":
+            return ANTHROPIC_AVAILABLE and bool(self.anthropic_key)
+        return False
+
+    @property
+    def moonshot_client(self):
+        """Kimi客户端，首次使用时导入SDK并创建"""
+        if self._moonshot_client is None and self.layer_configured("L1_Kimi"):
+            openai = timed_import('openai')
+            self._moonshot_client = openai.AsyncOpenAI(
                 api_key=self.moonshot_key,
                 base_url="https://api.moonshot.cn/v1"
             )
             logger.info("✅ Layer 1 (Kimi) initialized")
+        return self._moonshot_client
+
+    @property
+    def anthropic_client(self):
+        """Claude客户端，首次使用时导入SDK并创建"""
+        if self._anthropic_client is None and self.layer_configured("L4_Claude"):
+            anthropic = timed_import('anthropic')
+            self._anthropic_client = anthropic.AsyncAnthropic(api_key=self.anthropic_key)
+            logger.info("✅ Layer 4 (Claude) initialized")
+        return self._anthropic_client
 
-        if ANTHROPIC_AVAILABLE and self.anthropic_key:
-            self.anthropic_client = anthropic.Anthropic(api_key=self.anthropic_key)
-            logger.info("✅ Layer 2 (Claude) initialized")
+    def init_clients(self):
+        """预先创建全部AI客户端（常驻进程预热用，冷启动路径不调用）"""
+        return self.moonshot_client, self.anthropic_client
+
+    def layer_handlers(self, message: str, progress: Optional[ProgressiveEdit] = None):
+        """本入口已接入的层 -> 调用函数"""
+        def handler(key, call):
+            async def run():
+                on_delta = progress.writer(key) if progress else None
+                try:
+                    return await call(message, on_delta=on_delta)
+                except Exception:
+                    if progress:
+                        progress.release(key)
+                    raise
+            return run
+
+        handlers = {}
+        if self.layer_configured("L1_Kimi"):
+            handlers["L1_Kimi"] = handler("L1_Kimi", self.call_moonshot)
+        if self.layer_configured("L4_Claude"):
+            handlers["L4_Claude"] = handler("L4_Claude", self.call_claude)
+        return handlers
+
+    async def probe_moonshot(self) -> bool:
+        await self.moonshot_client.models.list()
+        return True
+
+    async def probe_claude(self) -> bool:
+        await self.anthropic_client.messages.create(
+            model="claude-3-sonnet-20240229",
+            max_tokens=1,
+            messages=[{"role": "user", "content": "ping"}]
+        )
+        return True
+
+    def start_probing(self):
+        """后台定期试探已熔断的层"""
+        probes = {}
+        if self.layer_configured("L1_Kimi"):
+            probes["L1_Kimi"] = self.probe_moonshot
+        if self.layer_configured("L4_Claude"):
+            probes["L4_Claude"] = self.probe_claude
+        self.router.start_probing(probes)
+
+    def bot_identity(self):
+        """由 token（冒号前即 bot id）和 TELEGRAM_BOT_USERNAME 推出 bot 身份；未设置时返回 None，启动时调用 getMe"""
+        bot_id = (self.token or '').split(':', 1)[0]
+        identity = load_config().get('identity') or {}
+        username = os.getenv('TELEGRAM_BOT_USERNAME', '').lstrip('@')
+        if not SKIP_GET_ME or not bot_id.isdigit() or not username:
+            return None
+        from telegram import User
+        return User(id=int(bot_id), first_name=identity.get('name', 'ÖNIKA LI'), is_bot=True, username=username)
 
     async def init_bot(self):
         """初始化Telegram Bot"""
-        if self.application is None:
-            self.application = Application.builder().token(self.token).build()
-            self._register_handlers()
-            await self.application.initialize()
-            self.initialized = True
+        async with self._init_lock:
+            if self.application is None:
+                started = time.perf_counter()
+                timed_import('telegram.ext')
+                from telegram.ext import Application
+                scheduler = timed_import('onikali.scheduler')
+
+                me = self.bot_identity()
+                if me is not None:
+                    builder = Application.builder().bot(make_prefetched_bot(self.token, me))
+                else:
+                    builder = Application.builder().token(self.token)
+                # 不同会话并发、同一会话按顺序处理
+                builder = builder.concurrent_updates(scheduler.ChatScheduler(WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_SIZE))
+                self.application = builder.build()
+                self._register_handlers()
+                await self.application.initialize()
+                self.initialized = True
+                self.bot_init_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    async def process(self, data: dict):
+        """处理一条Telegram更新（经过会话调度器）"""
+        if not self.initialized:
+            await self.init_bot()
+        from telegram import Update
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+
+    async def _handle(self, data: dict):
+        try:
+            await self.process(data)
+        except Exception as e:
+            logger.error(f"Update {data.get('update_id')} failed: {e}")
+
+    def enqueue(self, data: dict) -> bool:
+        """交给后台处理，未完成的更新已达上限时返回 False"""
+        if len(self.tasks) >= WEBHOOK_QUEUE_SIZE:
+            return False
+        task = asyncio.ensure_future(self._handle(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def drain(self, timeout: float = 10):
+        """等待后台更新处理完（最多 timeout 秒），超时的取消"""
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"Shutdown with {len(pending)} pending updates")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
 
     def _register_handlers(self):
         """注册命令处理器"""
-        self.application.add_handler(CommandHandler("start", self.cmd_start))
-        self.application.add_handler(CommandHandler("status", self.cmd_status))
-        self.application.add_handler(CommandHandler("hello", self.cmd_hello))
-        self.application.add_handler(CommandHandler("help", self.cmd_help))
-        self.application.add_handler(CommandHandler("create", self.cmd_create))
-        self.application.add_handler(CommandHandler("radar", self.cmd_radar))
+        from telegram.ext import CommandHandler, MessageHandler, filters
+
+        for command, method in COMMANDS:
+            self.application.add_handler(CommandHandler(command, getattr(self, method)))
         self.application.add_handler(
             MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
         )
 
-    async def call_moonshot(self, message: str) -> str:
-        """调用Kimi"""
+    async def call_moonshot(self, message: str, on_delta=None) -> str:
+        """调用Kimi；传入 on_delta 时流式返回"""
         if not self.moonshot_client:
             raise Exception("Layer 1 not available")
 
-        response = self.moonshot_client.chat.completions.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": "你是 ÖNIKA LI，摇滚风格AI助手，简洁有力，偶尔用emoji。"},
-                {"role": "user", "content": message}
-            ],
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-
-    async def call_claude(self, message: str) -> str:
-        """调用Claude"""
+        await self.limiters.acquire("moonshot", "moonshot-v1-8k", "L1_Kimi")
+        async with self.llm_semaphore, metrics.track("moonshot", "moonshot-v1-8k"):
+            response = await self.moonshot_client.chat.completions.create(
+                model="moonshot-v1-8k",
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": message}
+                ],
+                temperature=0.7,
+                stream=on_delta is not None,
+                # 流式响应的最后一块带上token用量
+                **({"stream_options": {"include_usage": True}} if on_delta is not None else {})
+            )
+            if on_delta is None:
+                if response.usage:
+                    metrics.record_tokens("moonshot", "moonshot-v1-8k",
+                                          response.usage.prompt_tokens, response.usage.completion_tokens)
+                return response.choices[0].message.content
+
+            parts = []
+            usage = None
+            async for chunk in response:
+                # Kimi 把用量放在最后一个 choice 上，OpenAI 放在数据块上
+                usage = getattr(chunk, 'usage', None) or (
+                    getattr(chunk.choices[0], 'usage', None) if chunk.choices else None) or usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+            if usage:
+                # choice 上的附加字段可能是未解析的字典
+                usage = usage if isinstance(usage, dict) else vars(usage)
+                metrics.record_tokens("moonshot", "moonshot-v1-8k",
+                                      usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        if not parts:
+            raise Exception("Layer 1 empty response")
+        return "".join(parts)
+
+    async def call_claude(self, message: str, on_delta=None) -> str:
+        """调用Claude；传入 on_delta 时流式返回"""
         if not self.anthropic_client:
-            raise Exception("Layer 2 not available")
-
-        response = self.anthropic_client.messages.create(
-            model="claude-3-sonnet-20240229",
-            max_tokens=1024,
-            system="你是 ÖNIKA LI，摇滚风格AI助手，简洁有力，偶尔用emoji。",
-            messages=[{"role": "user", "content": message}]
+            raise Exception("Layer 4 not available")
+
+        await self.limiters.acquire("anthropic", "claude-3-sonnet-20240229", "L4_Claude")
+        async with self.llm_semaphore, metrics.track("anthropic", "claude-3-sonnet-20240229"):
+            if on_delta is None:
+                response = await self.anthropic_client.messages.create(
+                    model="claude-3-sonnet-20240229",
+                    max_tokens=1024,
+                    system=SYSTEM_PROMPT,
+                    messages=[{"role": "user", "content": message}]
+                )
+                metrics.record_tokens("anthropic", "claude-3-sonnet-20240229",
+                                      response.usage.input_tokens, response.usage.output_tokens)
+                return response.content[0].text
+
+            parts = []
+            async with self.anthropic_client.messages.stream(
+                model="claude-3-sonnet-20240229",
+                max_tokens=1024,
+                system=SYSTEM_PROMPT,
+                messages=[{"role": "user", "content": message}]
+            ) as stream:
+                async for delta in stream.text_stream:
+                    parts.append(delta)
+                    on_delta(delta)
+                final = await stream.get_final_message()
+                metrics.record_tokens("anthropic", "claude-3-sonnet-20240229",
+                                      final.usage.input_tokens, final.usage.output_tokens)
+        if not parts:
+            raise Exception("Layer 4 empty response")
+        return "".join(parts)
+
+    @staticmethod
+    def cache_key(layer: str, message: str) -> str:
+        """缓存键：(模型, 系统提示, 消息, temperature)"""
+        model, temperature = LAYER_MODELS[layer]
+        raw = json.dumps(
+            [model, SYSTEM_PROMPT, [{"role": "user", "content": message}], temperature],
+            ensure_ascii=False
         )
-        return response.content[0].text
-
-    async def get_ai_response(self, message: str):
-        """获取AI响应，自动故障转移"""
-        # Layer 1: Kimi
-        if self.moonshot_client:
-            try:
-                response = await self.call_moonshot(message)
-                self.current_layer = 1
-                return {"text": response, "layer": 1}
-            except Exception as e:
-                logger.warning(f"Layer 1 failed: {e}")
-
-        # Layer 2: Claude
-        if self.anthropic_client:
-            try:
-                response = await self.call_claude(message)
-                self.current_layer = 2
-                return {"text": response, "layer": 2}
-            except Exception as e:
-                logger.error(f"Layer 2 failed: {e}")
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def cached_response(self, message: str):
+        """按层级顺序查找缓存，返回 (层, 文本, 是否过期) 或 None"""
+        now = time.time()
+        for key in self.router.order():
+            if key not in LAYER_MODELS:
+                continue
+            entry = await self.llm_cache.aget_entry(self.cache_key(key, message))
+            if entry is None:
+                continue
+            text, expires = entry
+            if now < expires:
+                return key, text, False
+            if now < expires + LLM_CACHE_STALE:
+                return key, text, True
+        return None
+
+    async def _refresh(self, message: str, cache_ttl: float, policy: Optional[str] = None):
+        """后台刷新过期缓存"""
+        try:
+            await self.get_ai_response(message, cache_ttl=cache_ttl, bypass=True, policy=policy)
+        finally:
+            self._refreshing.discard(message)
+
+    async def get_ai_response(self, message: str, cache_ttl: Optional[float] = None, bypass: bool = False,
+                              progress: Optional[ProgressiveEdit] = None, policy: Optional[str] = None):
+        """获取AI响应，自动故障转移
+
+        按 policy（routing.policies 中的命令策略）对各层排序，跳过已熔断的层；
+        主层超过历史延迟分位数仍未返回时，并行启动备用层，取先返回的结果。
+        指定 cache_ttl 时结果会被缓存，bypass=True 跳过缓存读取；
+        传入 progress 时流式显示生成过程。
+        """
+        use_cache = cache_ttl is not None and not LLM_CACHE_DISABLED
+        if use_cache and not bypass:
+            cached = await self.cached_response(message)
+            if cached:
+                key, text, stale = cached
+                self.llm_cache.hits += 1
+                if stale and message not in self._refreshing:
+                    self._refreshing.add(message)
+                    asyncio.ensure_future(self._refresh(message, cache_ttl, policy))
+                return {"text": text, "layer": self.router.priority(key), "cached": True}
+            self.llm_cache.misses += 1
+
+        # 相同策略、相同消息的并发请求合并为一次上游调用，各自的进度消息显示同一份流式输出；
+        # 进度组总是创建，第一个调用方不需要进度时，后加入的调用方也能看到流式输出
+        group = None
+
+        def join(data):
+            nonlocal group
+            group = data.setdefault('progress', ProgressGroup())
+            if progress:
+                group.add(progress)
+
+        async def generate(data):
+            attempts = self.router.attempts(self.layer_handlers(message, data.get('progress')), policy=policy)
+            return await race(attempts, self.latency)
+
+        try:
+            key, response = await self.generations.do((policy, message), generate, join)
+        finally:
+            if progress:
+                group.discard(progress)
+        if key:
+            layer = self.router.priority(key)
+            if layer != self._current_layer:
+                self.current_layer = layer
+            if use_cache:
+                self.llm_cache.set(self.cache_key(key, message), response, ttl=cache_ttl)
+            return {"text": response, "layer": layer}
+
+        # 应急模式：预设规则即时回复
+        if self.router.emergency_enabled:
+            return {"text": emergency_reply(message), "layer": 0}
 
         return {"text": "⚠️ 所有AI层都暂时不可用，请稍后再试。", "layer": 0}
 
+    def layer_label(self, layer: int) -> str:
+        """Layer 编号即配置中的 priority（Kimi 1 … Claude 4），附上层名"""
+        for key in self.router.order():
+            if self.router.priority(key) == layer:
+                return f"Layer {layer} ({self.router.name(key)})"
+        return f"Layer {layer}"
+
+    def layer_lines(self, connected: str, standby: str):
+        """按配置列出各层状态"""
+        lines = []
+        handlers = self.layer_handlers("")
+        current = self.current_layer
+        for key, info in self.router.status().items():
+            label = f"Layer {info['priority']} ({info['name']})"
+            if key not in handlers:
+                lines.append(f"⏸️ {label} - 预留")
+            elif info['state'] == OPEN:
+                lines.append(f"🔴 {label} - 熔断中（{info['retry_in']}秒后试探）")
+            elif info['priority'] == current:
+                lines.append(f"✅ {label} - {connected}")
+            else:
+                lines.append(f"✅ {label} - {standby}")
+        return lines
+
+    def ranking_line(self, policy: str) -> str:
+        """某命令当前的路由排序：层名 平均耗时·失败率"""
+        parts = []
+        for r in self.router.rankings(policy, self.layer_handlers("")):
+            latency = f"{r['latency']:.1f}s" if r['latency'] is not None else "—"
+            icon = "🔴" if r['state'] == OPEN else ""
+            parts.append(f"{icon}{r['name']} {latency}·{r['error_rate']:.0%}")
+        strategy = self.router.policy(policy).get('strategy', 'priority')
+        return f"/{policy}（{strategy}）：" + (" → ".join(parts) or "无可用层")
+
     # 命令处理器
     async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        layer1_status = "✅ Layer 1 (Kimi 2.5) - 运行中" if self.moonshot_client else "❌ Layer 1 (Kimi 2.5) - 未配置"
-        layer2_status = "✅ Layer 2 (Claude 3) - 备用" if self.anthropic_client else "⏸️ Layer 2 (Claude 3) - 未配置"
+        layers = "\n".join(self.layer_lines("运行中", "备用"))
 
         text = (
             "🎸 <b>ÖNIKA LI 已激活</b>\n"
             "━━━━━━━━━━━━━━\n"
             "四层AI融合体 · 故障自愈 · 自动切换\n\n"
             f"<b>当前状态：</b>\n"
-            f"{layer1_status}\n"
-            f"{layer2_status}\n"
-            "⏸️ Layer 3 (DeepSeek) - 预留\n"
-            "⏸️ Layer 4 (Groq) - 预留\n\n"
+            f"{layers}\n\n"
             "输入 /help 查看所有指令\n"
             "直接发消息即可对话！"
         )
-        await update.message.reply_text(text, parse_mode='HTML')
+        await self.outbox.reply(update.message, text, parse_mode='HTML')
 
     async def cmd_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        layer1_status = "✅ 运行中" if self.moonshot_client else "❌ 未配置"
-        layer2_status = "✅ 备用就绪" if self.anthropic_client else "⏸️ 未配置"
+        # 显示所有实例的最新状态
+        await self.router.sync()
+        current = await self.load_current_layer()
+        lines = []
+        for line, key in zip(self.layer_lines("运行中", "备用就绪"), self.router.order()):
+            lines.append(f"{line}\n   角色：{self.router.layers[key].get('role', '')}")
+        layers = "\n\n".join(lines)
+        opened = [info['name'] for info in self.router.status().values() if info['state'] == OPEN]
+        health = f"⚠️ 熔断：{'、'.join(opened)}" if opened else "✅ 正常"
 
         text = (
             "🎸 <b>ÖNIKA LI 系统状态</b>\n"
             "━━━━━━━━━━━━━━\n\n"
             f"<b>🧠 意识层：</b>\n"
-            f"{'🟢' if self.current_layer == 1 else '⚪'} Layer 1 (Kimi 2.5) {layer1_status}\n"
-            f"   角色：主力创作 · 中文长文本\n\n"
-            f"{'🟢' if self.current_layer == 2 else '⚪'} Layer 2 (Claude 3) {layer2_status}\n"
-            f"   角色：备用兜底 · 英文质量\n\n"
-            f"⏸️ Layer 3 (DeepSeek) - 预留\n"
-            f"⏸️ Layer 4 (Groq) - 预留\n\n"
-            f"<b>📊 当前使用：</b>Layer {self.current_layer}\n"
-            f"<b>系统健康：</b>✅ 正常"
+            f"{layers}\n\n"
+            f"<b>📊 当前使用：</b>{self.layer_label(current)}\n"
+            f"<b>系统健康：</b>{health}\n\n"
+            f"<b>🧭 路由排序：</b>\n"
+            + "\n".join(self.ranking_line(policy) for policy in ("hello", "create", "chat"))
         )
-        await update.message.reply_text(text, parse_mode='HTML')
+        await self.outbox.reply(update.message, text, parse_mode='HTML')
 
     async def cmd_hello(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        result = await self.get_ai_response("用一句话介绍你自己")
+        bypass = CACHE_BYPASS_FLAG in (context.args or [])
+        result = await self.get_ai_response("用一句话介绍你自己", cache_ttl=LLM_CACHE_TTL["hello"], bypass=bypass,
+                                            policy="hello")
+        source = " · 缓存" if result.get('cached') else ""
         text = (
             f"🎸 ÖNIKA LI 回应\n"
             f"━━━━━━━━━━━━━━\n"
             f"{result['text']}\n\n"
-            f"<i>（由 Layer {result['layer']} 生成）</i>"
+            f"<i>（由 {self.layer_label(result['layer'])} 生成{source}）</i>"
         )
-        await update.message.reply_text(text, parse_mode='HTML')
+        await self.outbox.reply(update.message, text, parse_mode='HTML')
 
     async def cmd_create(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        args = context.args
+        args = context.args or []
+        bypass = CACHE_BYPASS_FLAG in args
+        args = [a for a in args if a != CACHE_BYPASS_FLAG]
         topic = ' '.join(args) if args else "今日摇滚热点"
 
-        await update.message.reply_text(
+        await self.outbox.reply(
+            update.message,
             f"🎸 <b>ÖNIKA LI 生成中...</b>\n主题：{topic}\n━━━━━━━━━━━━━━",
             parse_mode='HTML'
         )
 
         prompt = f"生成一段关于'{topic}'的摇滚风格内容，100字左右，带emoji"
-        result = await self.get_ai_response(prompt)
+        result = await self.get_ai_response(prompt, cache_ttl=LLM_CACHE_TTL["create"], bypass=bypass,
+                                            policy="create")
 
-        text = f"{result['text']}\n\n<i>— 由 Layer {result['layer']} 生成</i>"
-        await update.message.reply_text(text, parse_mode='HTML')
+        source = " · 缓存" if result.get('cached') else ""
+        text = f"{result['text']}\n\n<i>— 由 {self.layer_label(result['layer'])} 生成{source}</i>"
+        await self.outbox.reply(update.message, text, parse_mode='HTML')
+
+    @property
+    def http_pool(self):
+        """aiohttp 连接池，首次使用时导入并创建"""
+        if self._http_pool is None:
+            http = timed_import('onikali.http')
+            self._http_pool = http.HTTPPool(proxy=os.getenv('RADAR_PROXY') or None)
+        return self._http_pool
 
     async def cmd_radar(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        text = (
-            "🎸 <b>ÖNIKA LI 信息雷达</b>\n"
-            "━━━━━━━━━━━━━━\n"
-            "扫描中...\n\n"
-            "<i>（功能开发中）</i>"
-        )
-        await update.message.reply_text(text, parse_mode='HTML')
+        if self._radar_lock.locked():
+            await self.outbox.reply(update.message, "🎸 雷达正在扫描中，请稍后再试")
+            return
+        async with self._radar_lock:
+            msg = await self.outbox.reply(
+                update.message,
+                "🎸 <b>ÖNIKA LI 信息雷达</b>\n━━━━━━━━━━━━━━\n扫描中...", parse_mode='HTML'
+            )
+            radar = timed_import('onikali.radar')
+            state = await asyncio.to_thread(radar.RadarState, RADAR_STATE)
+            found = await radar.run_radar(self.http_pool, state)
+            report, shown = radar.build_report(found)
+            await self.outbox.edit(msg, report, parse_mode='HTML', disable_web_page_preview=True)
+            # 报告发出后才把列出的条目记为见过
+            state.mark(shown)
+            await asyncio.to_thread(state.save)
 
     async def cmd_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = (
@@ -222,28 +633,59 @@ class BotState:
             "/help - 显示帮助\n\n"
             "<b>内容创作：</b>\n"
             "/create [主题] - 生成内容\n"
-            "/radar - 启动信息雷达\n\n"
+            "/radar - 启动信息雷达\n"
+            "<i>/hello、/create 后加 --fresh 跳过缓存</i>\n\n"
             "<b>直接发消息 = AI对话</b>\n\n"
             "<i>故障时会自动切换备用模型</i>"
         )
-        await update.message.reply_text(text, parse_mode='HTML')
+        await self.outbox.reply(update.message, text, parse_mode='HTML')
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理普通消息"""
         text = update.message.text
         await update.message.chat.send_action(action="typing")
 
-        result = await self.get_ai_response(text)
+        # 先发占位消息，生成过程中逐步更新
+        msg = await self.outbox.reply(update.message, "💭 ...")
+        progress = ProgressiveEdit(msg, outbox=self.outbox)
+        result = await self.get_ai_response(text, progress=progress, policy="chat")
+        await progress.close()
         reply = result['text']
 
-        if result['layer'] == 2:
-            reply += "\n\n<i>— Layer 2 (备用)</i>"
+        if result['layer'] > 1:
+            reply += f"\n\n<i>— {self.layer_label(result['layer'])} 备用</i>"
 
-        await update.message.reply_text(reply, parse_mode='HTML')
+        await self.outbox.edit(msg, reply, parse_mode='HTML')
 
-# 全局状态实例
+# 全局状态实例（AI客户端与Telegram Application都在首次使用时创建）
 bot_state = BotState()
-bot_state.init_clients()
+
+# 运行指标：Webhook 更新计数；缓存、熔断、队列长度在导出时读取
+WEBHOOK_UPDATES = metrics.REGISTRY.counter("onikali_webhook_updates_total", "收到的Webhook更新", ["result"])
+
+
+def webhook_metrics():
+    pending = metrics.Gauge("onikali_webhook_pending_updates", "等待处理的更新数")
+    pending.set(len(bot_state.tasks))
+    return [pending]
+
+
+metrics.REGISTRY.collector(lambda: metrics.cache_metrics({"llm": bot_state.llm_cache}))
+metrics.REGISTRY.collector(lambda: metrics.breaker_metrics(bot_state.router))
+metrics.REGISTRY.collector(webhook_metrics)
+BOOT_MS = round((time.perf_counter() - BOOT_STARTED) * 1000, 1)
+
+@app.on_event("startup")
+async def startup():
+    """启动熔断层后台探测"""
+    bot_state.start_probing()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await bot_state.drain()
+    await bot_state.router.stop_probing()
+    if bot_state._http_pool is not None:
+        await bot_state._http_pool.close()
 
 @app.get("/")
 async def root():
@@ -252,30 +694,84 @@ async def root():
 
 @app.post("/")
 async def webhook(request: Request):
-    """Telegram Webhook入口"""
+    """Telegram Webhook入口：校验、去重、入队后立即返回"""
     try:
-        # 初始化Bot
-        if not bot_state.initialized:
-            await bot_state.init_bot()
-
         # 解析请求
-        data = await request.json()
-        update = Update.de_json(data, bot_state.application.bot)
-
-        # 处理更新
-        await bot_state.application.process_update(update)
+        try:
+            data = await request.json()
+        except ValueError:
+            WEBHOOK_UPDATES.inc(result="invalid")
+            return JSONResponse({"error": "invalid json"}, status_code=400)
+        update_id = data.get('update_id') if isinstance(data, dict) else None
+        if not isinstance(update_id, int):
+            WEBHOOK_UPDATES.inc(result="invalid")
+            return JSONResponse({"error": "missing update_id"}, status_code=400)
+
+        # Telegram超时重投的更新直接丢弃；登记是原子的，多个实例收到同一更新时只有一个处理
+        if not await bot_state.seen_updates.claim(update_id):
+            logger.info(f"Duplicate update {update_id} dropped")
+            WEBHOOK_UPDATES.inc(result="duplicate")
+            return PlainTextResponse("OK")
+
+        if WEBHOOK_INLINE:
+            WEBHOOK_UPDATES.inc(result="accepted")
+            await bot_state.process(data)
+            return PlainTextResponse("OK")
+
+        # 队列满时撤销登记并返回503，让Telegram稍后重投
+        if not bot_state.enqueue(data):
+            bot_state.seen_updates.discard(update_id)
+            WEBHOOK_UPDATES.inc(result="busy")
+            return JSONResponse({"error": "busy"}, status_code=503)
+        WEBHOOK_UPDATES.inc(result="accepted")
 
         return PlainTextResponse("OK")
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/health")
 async def health():
     """健康检查API"""
+    await bot_state.router.sync()
     return {
         "status": "ok",
-        "layer1": "connected" if bot_state.moonshot_client else "disconnected",
-        "layer2": "connected" if bot_state.anthropic_client else "disconnected",
-        "current_layer": bot_state.current_layer
+        "layer1": "connected" if bot_state.layer_configured("L1_Kimi") else "disconnected",
+        "layer2": "connected" if bot_state.layer_configured("L4_Claude") else "disconnected",
+        "current_layer": await bot_state.load_current_layer(),
+        "pending_updates": len(bot_state.tasks),
+        "layers": bot_state.router.status(),
+        "llm_cache": bot_state.llm_cache.stats(),
+        "state_backend": describe_backend(),
+        "outbox": bot_state.outbox.stats(),
+        "cold_start": cold_start_report()
     }
+
+
+def cold_start_report() -> dict:
+    """冷启动报告：模块加载耗时、各模块首次导入耗时、Bot初始化耗时"""
+    return {
+        "boot_ms": BOOT_MS,
+        "bot_init_ms": bot_state.bot_init_ms,
+        "imports_ms": dict(sorted(IMPORT_TIMES.items(), key=lambda item: -item[1])),
+    }
+
+
+if __name__ == "__main__":
+    # 冷启动检查：python api/index.py --max-boot-ms 1500，超出阈值时退出码为1
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ÖNIKA LI 冷启动报告")
+    parser.add_argument("--max-boot-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    report = cold_start_report()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.max_boot_ms is not None and BOOT_MS > args.max_boot_ms:
+        print(f"❌ 冷启动 {BOOT_MS}ms 超过阈值 {args.max_boot_ms}ms")
+        sys.exit(1)
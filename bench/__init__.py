@@ -0,0 +1,4 @@
+"""
+ÖNIKA LI 离线基准测试
+本地服务商替身 + 场景驱动，见 bench/run.py
+"""
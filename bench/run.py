@@ -0,0 +1,434 @@
+"""
+ÖNIKA LI 离线基准测试
+启动本地服务商替身（OpenRouter、Groq、Moonshot、Anthropic、Brave、Telegram），
+驱动两个入口的主要路径，输出 p50/p95/p99 延迟、吞吐量和内存分配到 JSON
+
+用法：
+    python -m bench.run --out /tmp/base.json
+    python -m bench.run --scenario do_write --requests 50 --concurrency 10
+    python -m bench.run --set openrouter.error_rate=0.3 --baseline /tmp/base.json --out /tmp/new.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import types
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stubs import ARTICLE, RespStub, Stats, start_all
+
+# 场景：请求数、并发数、该场景期间对替身行为的覆盖
+SCENARIOS = {
+    "do_write": {"requests": 40, "concurrency": 8},
+    "do_write_hot_topic": {"requests": 40, "concurrency": 20},
+    "modify_cmd": {"requests": 40, "concurrency": 8},
+    "generate_content_failover": {
+        "requests": 60, "concurrency": 12,
+        "overrides": {"openrouter": {"rate_limit_rate": 0.3, "no_credits_rate": 0.2, "error_rate": 0.1}},
+    },
+    "get_ai_response": {"requests": 100, "concurrency": 20},
+    "get_ai_response_failover": {
+        "requests": 100, "concurrency": 20,
+        "overrides": {"moonshot": {"error_rate": 0.5}},
+    },
+    "webhook_concurrent": {"requests": 200, "concurrency": 50},
+    "long_reply": {
+        "requests": 20, "concurrency": 10,
+        "overrides": {"telegram": {"rate_limit_rate": 0.1}},
+    },
+}
+
+SAMPLE_RESULTS = [
+    {"title": f"巡演资讯 {i}", "url": f"https://example.com/{i}", "description": "时间、地点、阵容与票价信息。" * 4}
+    for i in range(1, 6)
+]
+TG_TOKEN = "123456:bench"
+
+
+def prepare_env(workdir: str, local_limits: bool):
+    """导入两个入口前设置环境：假Key、临时工作目录、关闭磁盘缓存"""
+    os.environ.update({
+        "HOME": workdir,
+        "TELEGRAM_BOT_TOKEN": TG_TOKEN,
+        "TELEGRAM_TOKEN": TG_TOKEN,
+        "OPENROUTER_API_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "BRAVE_API_KEY": "bench",
+        "MOONSHOT_API_KEY": "bench",
+        "ANTHROPIC_API_KEY": "bench",
+        "SEARCH_CACHE_DB": "",
+        "WEBHOOK_INLINE": "0",
+    })
+    if not local_limits:
+        # 测的是代码路径而不是配额，默认放开本地令牌桶
+        os.environ.update({"RATE_LIMIT_DEFAULT": "1000000/min", "RATE_LIMIT_BURST": "100000",
+                           "RATE_LIMIT_MAX_QUEUE": "100000"})
+        os.environ.update({"TG_GLOBAL_RATE": "1000000/s", "TG_CHAT_RATE": "1000000/s",
+                           "TG_GROUP_RATE": "1000000/s", "TG_CHAT_BURST": "100000"})
+        # 替身都在 127.0.0.1，按域名限并发会把所有原文抓取排成一队
+        os.environ["ARTICLE_PER_DOMAIN"] = "100000"
+
+
+def percentile(sorted_values, q: float) -> float:
+    """最近秩分位数"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def summarize(latencies) -> dict:
+    values = sorted(latencies)
+    ms = lambda s: round(s * 1000, 2)
+    return {
+        "p50": ms(percentile(values, 0.50)),
+        "p95": ms(percentile(values, 0.95)),
+        "p99": ms(percentile(values, 0.99)),
+        "mean": ms(sum(values) / len(values)) if values else 0.0,
+        "max": ms(values[-1]) if values else 0.0,
+    }
+
+
+class Bench:
+    """持有替身服务和两个入口，逐个场景测量"""
+
+    def __init__(self, args):
+        self.args = args
+        self.stubs = {}
+        self.bot = None
+        self.api = None
+        self.tg = None
+        self.update_id = 0
+
+    async def setup(self):
+        self.stubs = await start_all(self.args.overrides, seed=self.args.seed)
+        # 共享状态后端：在导入两个入口之前设置，各组件初始化时读取
+        if self.args.state == "redis":
+            self.stubs["state"] = await RespStub(self.args.overrides.get("state")).start()
+            os.environ["STATE_BACKEND"] = self.stubs["state"].url
+        elif self.args.state == "sqlite":
+            os.environ["STATE_BACKEND"] = f"sqlite:///{os.path.join(os.environ['HOME'], 'state.db')}"
+        await self._setup_bot()
+        await self._setup_api()
+
+    async def _setup_bot(self):
+        import importlib
+        from telegram import Bot
+        from telegram.request import HTTPXRequest
+        from onikali.http import HTTPPool
+        from onikali.ratelimit import RateLimiters
+
+        bot = importlib.import_module("bot.onikali_bot")
+        s = self.stubs
+        bot.BRAVE_URL = f"{s['brave'].url}/res/v1/web/search"
+        bot.OPENROUTER_URL = f"{s['openrouter'].url}/api/v1/chat/completions"
+        bot.GROQ_URL = f"{s['groq'].url}/openai/v1/chat/completions"
+        bot.GROQ_MODELS_URL = f"{s['groq'].url}/openai/v1/models"
+        # 替身在本机，不走本地代理
+        bot.http_pool = HTTPPool(limit_per_host=self.args.pool_size)
+        bot.articles.proxy = None
+        bot.limiters = RateLimiters(bot.router.layers if self.args.local_limits else None)
+        await bot.sessions.start()
+        await bot.drafts.start()
+        self.tg = Bot(TG_TOKEN, base_url=f"{s['telegram'].url}/bot",
+                      request=HTTPXRequest(connection_pool_size=self.args.pool_size))
+        await self.tg.initialize()
+        self.bot = bot
+
+    async def _setup_api(self):
+        import importlib
+        import openai
+        import anthropic
+        from telegram.ext import Application
+        from onikali.ratelimit import RateLimiters
+        from onikali.scheduler import ChatScheduler
+
+        api = importlib.import_module("api.index")
+        state = api.bot_state
+        s = self.stubs
+        state._moonshot_client = openai.AsyncOpenAI(api_key="bench", base_url=f"{s['moonshot'].url}/v1")
+        state._anthropic_client = anthropic.AsyncAnthropic(api_key="bench", base_url=s['anthropic'].url)
+        state.limiters = RateLimiters(state.router.layers if self.args.local_limits else None)
+        state.application = (
+            Application.builder().token(TG_TOKEN).base_url(f"{s['telegram'].url}/bot")
+            .connection_pool_size(self.args.pool_size)
+            .concurrent_updates(ChatScheduler(api.WEBHOOK_WORKERS, max_pending=api.WEBHOOK_QUEUE_SIZE)).build()
+        )
+        state._register_handlers()
+        await state.application.initialize()
+        state.initialized = True
+        self.api = api
+
+    async def teardown(self):
+        if self.bot is not None:
+            await self.bot.http_pool.close()
+            await self.bot.articles.close()
+            await self.bot.sessions.close()
+            await self.bot.drafts.close()
+        if self.tg is not None:
+            await self.tg.shutdown()
+        if self.api is not None:
+            await self.api.bot_state.drain()
+            await self.api.bot_state.application.shutdown()
+        for stub in self.stubs.values():
+            await stub.close()
+
+    def reset(self):
+        """每个场景使用全新的熔断器和延迟记录，场景之间互不影响"""
+        from onikali.hedge import LatencyTracker
+        from onikali.router import LayerRouter
+        self.bot.router = LayerRouter()
+        self.bot.layer_latency = LatencyTracker(defaults=self.bot.router.hedge_delays())
+        state = self.api.bot_state
+        state.router = LayerRouter()
+        state.latency = LatencyTracker(defaults=state.router.hedge_delays())
+        for stub in self.stubs.values():
+            stub.stats = Stats()
+
+    def update_data(self, user_id: int, text: str) -> dict:
+        self.update_id += 1
+        message = {
+            "message_id": self.update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.update_id, "message": message}
+
+    def update(self, user_id: int, text: str):
+        from telegram import Update
+        return Update.de_json(self.update_data(user_id, text), self.tg)
+
+    # 各场景的单次请求，返回结果标签
+    async def do_write(self, i):
+        user_id = 10_000 + i
+        topic = f"乐队巡演 {i}"
+        await self.bot.do_write(self.update(user_id, f"/write {topic}"), topic)
+        return "ok" if await self.bot.sessions.aget(user_id) else "failed"
+
+    async def do_write_hot_topic(self, i):
+        """大量用户同时写同一个主题：搜索与生成应合并为少数几次上游调用"""
+        user_id = 40_000 + i
+        topic = "巡演官宣 热门话题"
+        await self.bot.do_write(self.update(user_id, f"/write {topic}"), topic)
+        return "ok" if await self.bot.sessions.aget(user_id) else "failed"
+
+    async def setup_modify_cmd(self, requests):
+        for i in range(requests):
+            await self.bot.sessions.asave_draft(20_000 + i, f"乐队巡演 {i}", ARTICLE)
+
+    async def modify_cmd(self, i):
+        user_id = 20_000 + i
+        before = (await self.bot.sessions.aget(user_id)).version
+        context = types.SimpleNamespace(args=["第二段", "加上", "加演场次"])
+        await self.bot.modify_cmd(self.update(user_id, "/modify 第二段 加上 加演场次"), context)
+        return "ok" if (await self.bot.sessions.aget(user_id)).version > before else "failed"
+
+    async def generate_content_failover(self, i):
+        content, layer = await self.bot.generate_content(f"音乐节阵容 {i}", SAMPLE_RESULTS)
+        return layer if content else "failed"
+
+    async def get_ai_response(self, i):
+        result = await self.api.bot_state.get_ai_response(f"你好，介绍一下你自己 {i}")
+        return f"layer{result['layer']}"
+
+    get_ai_response_failover = get_ai_response
+
+    async def long_reply(self, i):
+        """超长回复经 outbox 按段落拆成多条；Telegram 替身随机返回 429，按 retry_after 暂停后重试"""
+        from onikali.outbox import split_message
+        text = "\n\n".join(f"{n}. {ARTICLE}" for n in range(120))
+        message = self.update(50_000 + i, "/write 长文").message
+        await self.bot.outbox.reply(message, text)
+        return f"{len(split_message(text))} 条"
+
+    async def setup_webhook_concurrent(self, requests):
+        import httpx
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.api.app), base_url="http://bench")
+
+    async def webhook_concurrent(self, i):
+        resp = await self.client.post("/", json=self.update_data(30_000 + i, f"今晚有什么演出推荐 {i}"))
+        return str(resp.status_code)
+
+    async def finish_webhook_concurrent(self):
+        """应答之后等待后台worker处理完全部更新"""
+        started = time.perf_counter()
+        await self.api.bot_state.drain(timeout=600)
+        await self.client.aclose()
+        return {"drain_s": round(time.perf_counter() - started, 3)}
+
+    async def run_scenario(self, name: str, requests: int, concurrency: int, overrides: dict) -> dict:
+        self.reset()
+        saved = {k: dict(self.stubs[k].profile) for k in overrides}
+        for k, v in overrides.items():
+            self.stubs[k].profile.update(v)
+        setup = getattr(self, f"setup_{name}", None)
+        if setup:
+            await setup(requests)
+
+        call = getattr(self, name)
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        outcomes = Counter()
+
+        async def one(i):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    outcome = await call(i)
+                except Exception as e:
+                    outcome = f"error:{type(e).__name__}"
+                latencies.append(time.perf_counter() - started)
+                outcomes[outcome] += 1
+
+        if self.args.alloc:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        wall = time.perf_counter() - started
+        finish = getattr(self, f"finish_{name}", None)
+        extra = await finish() if finish else {}
+        result = {
+            "requests": requests,
+            "concurrency": concurrency,
+            "wall_s": round(wall, 3),
+            "throughput_rps": round(requests / wall, 2) if wall else 0.0,
+            "latency_ms": summarize(latencies),
+            "outcomes": dict(sorted(outcomes.items())),
+            "overrides": overrides,
+            "stub_calls": {k: v.stats.as_dict() for k, v in self.stubs.items() if v.stats.requests},
+        }
+        if self.args.alloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["alloc_kb"] = {
+                "net": round((current - base) / 1024, 1),
+                "peak": round((peak - base) / 1024, 1),
+                "per_request_peak": round((peak - base) / 1024 / max(1, requests), 2),
+            }
+        result.update(extra)
+        for k, v in saved.items():
+            self.stubs[k].profile = v
+        return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def parse_overrides(items) -> dict:
+    """--set openrouter.error_rate=0.3 -> {"openrouter": {"error_rate": 0.3}}"""
+    overrides = {}
+    for item in items or []:
+        key, _, value = item.partition("=")
+        provider, _, field = key.partition(".")
+        overrides.setdefault(provider, {})[field] = float(value)
+    return overrides
+
+
+def compare(baseline: dict, current: dict):
+    """与上一次结果对比，打印各场景延迟与吞吐变化"""
+    print(f"\n对比 {baseline.get('meta', {}).get('git', '?')} -> {current['meta']['git']}")
+    for name, now in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        cells = []
+        for label, old, new in (
+            ("p50", before["latency_ms"]["p50"], now["latency_ms"]["p50"]),
+            ("p95", before["latency_ms"]["p95"], now["latency_ms"]["p95"]),
+            ("p99", before["latency_ms"]["p99"], now["latency_ms"]["p99"]),
+            ("rps", before["throughput_rps"], now["throughput_rps"]),
+        ):
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            cells.append(f"{label} {old}->{new} ({change})")
+        print(f"  {name:28s} " + "  ".join(cells))
+
+
+async def main(args) -> dict:
+    bench = Bench(args)
+    await bench.setup()
+    results = {}
+    try:
+        for name in args.scenarios:
+            spec = SCENARIOS[name]
+            requests = args.requests or spec["requests"]
+            concurrency = args.concurrency or spec["concurrency"]
+            logging.getLogger("bench").warning(f"▶ {name} ({requests} 请求, 并发 {concurrency})")
+            results[name] = await bench.run_scenario(name, requests, concurrency, spec.get("overrides", {}))
+            lat = results[name]["latency_ms"]
+            print(f"{name:28s} p50 {lat['p50']:>8}ms  p95 {lat['p95']:>8}ms  p99 {lat['p99']:>8}ms  "
+                  f"{results[name]['throughput_rps']:>7} req/s  {results[name]['outcomes']}")
+    finally:
+        await bench.teardown()
+    return {
+        "meta": {
+            "git": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "alloc_tracing": args.alloc,
+            "local_limits": args.local_limits,
+            "state": args.state,
+            "set": args.overrides,
+        },
+        "stubs": {name: stub.profile for name, stub in bench.stubs.items()},
+        "scenarios": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ÖNIKA LI 离线基准测试")
+    # 默认写到系统临时目录，结果文件不进入仓库
+    parser.add_argument("--out", default=os.path.join(tempfile.gettempdir(), "onikali-bench-results.json"))
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), dest="scenarios",
+                        help="只运行指定场景（可重复），默认全部")
+    parser.add_argument("--requests", type=int, help="覆盖每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, help="覆盖每个场景的并发数")
+    parser.add_argument("--set", action="append", dest="set", metavar="PROVIDER.FIELD=VALUE",
+                        help="覆盖替身行为，如 openrouter.rate_limit_rate=0.2、groq.latency_ms=50、state.latency_ms=200（--state redis）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pool-size", type=int, default=64, help="HTTP 连接池大小")
+    parser.add_argument("--local-limits", action="store_true", help="使用配置中的各层限流参数")
+    parser.add_argument("--state", choices=("local", "sqlite", "redis"), default="local",
+                        help="共享状态后端：进程内、SQLite 文件或本地 Redis 协议替身")
+    parser.add_argument("--no-alloc", dest="alloc", action="store_false", help="关闭 tracemalloc（减少测量开销）")
+    parser.add_argument("--baseline", help="与之前的结果文件对比")
+    parser.add_argument("--log-level", default="CRITICAL")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    args.overrides = parse_overrides(args.set)
+
+    workdir = tempfile.mkdtemp(prefix="onikali-bench-")
+    prepare_env(workdir, args.local_limits)
+    logging.basicConfig(level=args.log_level)
+
+    report = asyncio.run(main(args))
+    logging.getLogger().setLevel(args.log_level)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(json.load(f), report)
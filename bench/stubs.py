@@ -0,0 +1,437 @@
+"""
+本地服务商替身
+每个服务商一个本地 aiohttp 服务，按配置模拟延迟、5xx、429、402
+"""
+
+import json
+import time
+import hashlib
+import random
+import asyncio
+import threading
+from typing import Dict, Optional
+from urllib.parse import quote
+
+from aiohttp import web
+
+# 默认行为：延迟（毫秒，正态分布）、各类错误概率、流式分块
+DEFAULT_PROFILE = {
+    "latency_ms": 300,
+    "jitter_ms": 60,
+    "error_rate": 0.0,       # 500
+    "rate_limit_rate": 0.0,  # 429
+    "no_credits_rate": 0.0,  # 402
+    "stream_chunks": 20,
+    "chunk_delay_ms": 15,
+}
+
+PROFILES = {
+    "openrouter": dict(DEFAULT_PROFILE, latency_ms=600, jitter_ms=150),
+    "groq": dict(DEFAULT_PROFILE, latency_ms=200, jitter_ms=40, stream_chunks=10, chunk_delay_ms=5),
+    "moonshot": dict(DEFAULT_PROFILE, latency_ms=500, jitter_ms=120),
+    "anthropic": dict(DEFAULT_PROFILE, latency_ms=700, jitter_ms=150),
+    "brave": dict(DEFAULT_PROFILE, latency_ms=250, jitter_ms=50),
+    "telegram": dict(DEFAULT_PROFILE, latency_ms=80, jitter_ms=20),
+}
+
+# 生成的文案：多段落，供 /modify 按段落修改
+ARTICLE = "\n\n".join([
+    "【标题】摇滚不死：2026 巡演全面开启",
+    "乐队将于三月起在全国十二座城市巡演，首站北京工体，全程预计覆盖十万名观众。",
+    "本轮巡演带来全新专辑中的八首作品，并重新编排三首经典老歌，现场加入弦乐与合成器。",
+    "门票将于下周五中午十二点开售，早鸟票限量两千张，学生凭证件可享八折。",
+    "#摇滚巡演 #LiveGigsAsia #现场音乐",
+    "推荐平台：微博、小红书、抖音，配合现场花絮短视频发布效果最佳。",
+])
+EDITS_REPLY = json.dumps(
+    {"edits": [{"op": "replace", "index": 2, "text": "乐队将于三月起在全国十二座城市巡演，首站北京工体，预计十万名观众到场，另有两场加演。"}]},
+    ensure_ascii=False
+)
+
+
+class Stats:
+    """每个替身服务的请求计数"""
+
+    def __init__(self):
+        self.requests = 0
+        self.status: Dict[int, int] = {}
+
+    def record(self, status: int):
+        self.requests += 1
+        self.status[status] = self.status.get(status, 0) + 1
+
+    def as_dict(self) -> dict:
+        return {"requests": self.requests, "status": {str(k): v for k, v in sorted(self.status.items())}}
+
+
+class StubServer:
+    """单个服务商替身，监听 127.0.0.1 的随机端口"""
+
+    def __init__(self, name: str, profile: Optional[dict] = None, rng: Optional[random.Random] = None):
+        self.name = name
+        self.profile = dict(PROFILES.get(name, DEFAULT_PROFILE), **(profile or {}))
+        self.rng = rng or random.Random()
+        self.stats = Stats()
+        self.url = None
+        self._runner = None
+        self._message_id = 0
+
+    def routes(self):
+        if self.name in ("openrouter", "groq", "moonshot"):
+            prefix = {"openrouter": "/api/v1", "groq": "/openai/v1", "moonshot": "/v1"}[self.name]
+            return [
+                web.post(f"{prefix}/chat/completions", self.openai_chat),
+                web.get(f"{prefix}/models", self.openai_models),
+            ]
+        if self.name == "anthropic":
+            return [web.post("/v1/messages", self.anthropic_messages)]
+        if self.name == "brave":
+            # 搜索结果指向本替身的网页，供原文抓取使用
+            return [web.get("/res/v1/web/search", self.brave_search), web.get("/article/{topic}/{index}", self.article)]
+        if self.name == "telegram":
+            return [web.post("/bot{token}/{method}", self.telegram_method)]
+        raise ValueError(f"未知服务商: {self.name}")
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self):
+        """模拟服务商处理时间（首字节之前）"""
+        p = self.profile
+        await asyncio.sleep(max(0.0, self.rng.gauss(p["latency_ms"], p["jitter_ms"])) / 1000)
+
+    def _failure(self) -> Optional[int]:
+        """按配置概率抽取一个错误状态码"""
+        p = self.profile
+        roll = self.rng.random()
+        for status, rate in ((429, p["rate_limit_rate"]), (402, p["no_credits_rate"]), (500, p["error_rate"])):
+            if roll < rate:
+                return status
+            roll -= rate
+        return None
+
+    def _error(self, status: int) -> web.Response:
+        self.stats.record(status)
+        headers = {"Retry-After": "1"} if status == 429 else None
+        return web.json_response({"error": {"message": f"stub {status}", "code": status}}, status=status, headers=headers)
+
+    def _reply_text(self, prompt: str) -> str:
+        return EDITS_REPLY if "只输出JSON" in prompt else ARTICLE
+
+    def _chunks(self, text: str):
+        n = max(1, self.profile["stream_chunks"])
+        size = max(1, -(-len(text) // n))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def _sse(self, request, events):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await resp.prepare(request)
+            for event in events:
+                await resp.write(event.encode('utf-8'))
+                await asyncio.sleep(self.profile["chunk_delay_ms"] / 1000)
+        except ConnectionResetError:
+            # 客户端中途断开（对冲请求中落后的一方被取消），按 499 记录
+            self.stats.record(499)
+            return resp
+        self.stats.record(200)
+        try:
+            await resp.write_eof()
+        except ConnectionResetError:
+            # 客户端读到结束事件后即释放连接
+            pass
+        return resp
+
+    async def openai_chat(self, request):
+        body = await request.json()
+        await self._delay()
+        status = self._failure()
+        if status:
+            return self._error(status)
+        prompt = "".join(m.get("content", "") for m in body.get("messages", []))
+        text = self._reply_text(prompt)
+        model = body.get("model", "stub")
+        if body.get("stream"):
+            events = [
+                "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": c}}], "model": model}, ensure_ascii=False) + "\n\n"
+                for c in self._chunks(text)
+            ]
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = {"prompt_tokens": len(prompt) // 2, "completion_tokens": len(text) // 2,
+                         "total_tokens": (len(prompt) + len(text)) // 2}
+                events.append("data: " + json.dumps({"choices": [], "model": model, "usage": usage}) + "\n\n")
+            events.append("data: [DONE]\n\n")
+            return await self._sse(request, events)
+        self.stats.record(200)
+        return web.json_response({
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 2, "completion_tokens": len(text) // 2,
+                      "total_tokens": (len(prompt) + len(text)) // 2},
+        })
+
+    async def openai_models(self, request):
+        await self._delay()
+        self.stats.record(200)
+        return web.json_response({"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "stub"}]})
+
+    async def anthropic_messages(self, request):
+        body = await request.json()
+        await self._delay()
+        status = self._failure()
+        if status:
+            return self._error(status)
+        prompt = "".join(m.get("content", "") for m in body.get("messages", []) if isinstance(m.get("content"), str))
+        text = self._reply_text(prompt)
+        model = body.get("model", "stub")
+        usage = {"input_tokens": len(prompt) // 2, "output_tokens": len(text) // 2}
+        message = {"id": "msg_stub", "type": "message", "role": "assistant", "model": model,
+                   "content": [], "stop_reason": None, "stop_sequence": None, "usage": usage}
+        if body.get("stream"):
+            def event(name, data):
+                return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            events = [
+                event("message_start", {"type": "message_start", "message": message}),
+                event("content_block_start", {"type": "content_block_start", "index": 0,
+                                              "content_block": {"type": "text", "text": ""}}),
+            ]
+            events += [
+                event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                              "delta": {"type": "text_delta", "text": c}})
+                for c in self._chunks(text)
+            ]
+            events += [
+                event("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                        "usage": {"output_tokens": usage["output_tokens"]}}),
+                event("message_stop", {"type": "message_stop"}),
+            ]
+            return await self._sse(request, events)
+        self.stats.record(200)
+        return web.json_response(dict(message, content=[{"type": "text", "text": text}], stop_reason="end_turn"))
+
+    async def brave_search(self, request):
+        await self._delay()
+        status = self._failure()
+        if status:
+            return self._error(status)
+        query = request.query.get("q", "")
+        count = int(request.query.get("count", "5"))
+        self.stats.record(200)
+        return web.json_response({"web": {"results": [
+            {"title": f"{query} 相关报道 {i}", "url": f"{self.url}/article/{quote(query, safe='')}/{i}",
+             "description": f"{query} 的第 {i} 条摘要：时间、地点、阵容与票价信息。" * 3}
+            for i in range(1, count + 1)
+        ]}})
+
+    async def article(self, request):
+        """新闻网页：导航、脚本、页脚之间的正文，带 ETag，支持 If-None-Match"""
+        await self._delay()
+        status = self._failure()
+        if status:
+            return self._error(status)
+        topic, index = request.match_info["topic"], request.match_info["index"]
+        paragraphs = "".join(f"<p>{p}</p>" for p in [
+            f"{topic}：主办方今日公布第 {index} 批详细安排。",
+            f"演出定于 2026 年 5 月 {index} 日晚 19:30 开始，场馆可容纳 {index}2000 名观众。",
+            f"门票分为 380 元、580 元和 880 元三档，{index} 月 20 日中午 12 点开售。",
+            "乐队此前发行的专辑在流媒体平台累计播放超过一亿次，本轮将演唱其中的全部歌曲。",
+        ])
+        html = (f"<html><head><meta charset='utf-8'><title>{topic}</title><script>var ad = 1;</script></head>"
+                f"<body><nav>首页 新闻 演出 票务 关于我们 联系方式 下载客户端</nav>"
+                f"<article><h1>{topic} 相关报道 {index}</h1>{paragraphs}</article>"
+                f"<footer>版权所有 © 2026 摇滚新闻网 保留所有权利 京ICP备00000000号</footer></body></html>")
+        etag = '"%s"' % hashlib.sha256(html.encode('utf-8')).hexdigest()[:16]
+        if request.headers.get("If-None-Match") == etag:
+            self.stats.record(304)
+            return web.Response(status=304, headers={"ETag": etag})
+        self.stats.record(200)
+        return web.Response(text=html, content_type="text/html", headers={"ETag": etag})
+
+    async def telegram_method(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        await self._delay()
+        if self._failure() == 429:
+            self.stats.record(429)
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        self.stats.record(200)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "ÖNIKA LI", "username": "onikali_bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            if method == "sendMessage":
+                self._message_id += 1
+            message_id = int(params.get("message_id") or self._message_id)
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+async def start_all(overrides: Optional[Dict[str, dict]] = None, seed: int = 0) -> Dict[str, StubServer]:
+    """启动全部替身服务，overrides 按服务商覆盖默认行为"""
+    servers = {}
+    for i, name in enumerate(PROFILES):
+        servers[name] = await StubServer(name, (overrides or {}).get(name), random.Random(seed + i)).start()
+    return servers
+
+
+class RespStub:
+    """Redis 协议替身：内存键值存储，支持共享状态后端用到的命令（PING/AUTH/SELECT/GET/SET/PTTL/DEL/EXISTS/FLUSHDB）
+
+    profile 的 latency_ms 为每条响应的网络延迟（命令照常流水线处理，响应按顺序延后送达），用于模拟慢 Redis。
+    """
+
+    def __init__(self, profile: Optional[dict] = None):
+        self.profile = dict(profile or {})
+        self.stats = Stats()
+        self.url = None
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._writers = set()
+        self._data: Dict[str, tuple] = {}
+
+    async def start(self):
+        # 客户端是同步套接字，会阻塞调用它的事件循环，替身必须跑在自己的线程和循环里
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="resp-stub", daemon=True)
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._serve, "127.0.0.1", 0), self._loop)
+        self._server = await asyncio.wrap_future(future)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"redis://127.0.0.1:{port}/0"
+        return self
+
+    async def close(self):
+        if self._server is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            # 客户端连接还开着：关闭后各连接的读取收到 EOF，处理任务自行结束
+            for writer in list(self._writers):
+                writer.close()
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._server.wait_closed()
+
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(shutdown(), self._loop))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        await asyncio.to_thread(self._thread.join)
+        self._loop.close()
+        self._server = None
+
+    def _alive(self, key: str):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    @staticmethod
+    async def _read_command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode('utf-8').split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2].decode('utf-8'))
+        return args
+
+    @staticmethod
+    def _bulk(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode('utf-8')
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def execute(self, args) -> bytes:
+        name = args[0].upper()
+        if name in ("PING",):
+            return b"+PONG\r\n"
+        if name in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            entry = self._alive(args[1])
+            return self._bulk(entry[0] if entry else None)
+        if name == "SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            expires = None
+            if "PX" in options:
+                expires = time.time() + int(args[3 + options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires = time.time() + int(args[3 + options.index("EX") + 1])
+            if "NX" in options and self._alive(key) is not None:
+                return b"$-1\r\n"
+            self._data[key] = (value, expires)
+            return b"+OK\r\n"
+        if name == "PTTL":
+            entry = self._alive(args[1])
+            if entry is None:
+                return b":-2\r\n"
+            return b":%d\r\n" % (-1 if entry[1] is None else int((entry[1] - time.time()) * 1000))
+        if name in ("DEL", "EXISTS"):
+            found = [key for key in args[1:] if self._alive(key) is not None]
+            if name == "DEL":
+                for key in found:
+                    del self._data[key]
+            return b":%d\r\n" % len(found)
+        if name == "FLUSHDB":
+            self._data.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name.encode('utf-8')
+
+    async def _deliver(self, replies: asyncio.Queue, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, reply = await replies.get()
+            if reply is None:
+                return
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            writer.write(reply)
+            await writer.drain()
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue()
+        delivery = asyncio.ensure_future(self._deliver(replies, writer))
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if not args:
+                    break
+                reply = self.execute(args)
+                self.stats.record(500 if reply.startswith(b"-") else 200)
+                replies.put_nowait((loop.time() + self.profile.get("latency_ms", 0) / 1000, reply))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            replies.put_nowait((0, None))
+            await asyncio.gather(delivery, return_exceptions=True)
+            self._writers.discard(writer)
+            writer.close()
@@ -1,14 +1,35 @@
 import os
+import sys
 import logging
 import asyncio
 import aiohttp
 import time
 import json
-from datetime import datetime
+import hashlib
+import argparse
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from onikali.http import HTTPPool, read_openai_stream
+from onikali.hedge import LatencyTracker, race
+from onikali.router import LayerRouter, OPEN
+from onikali.ratelimit import LOCAL_THROTTLE, RateLimiters, RateLimitExceeded
+from onikali.cache import TTLCache, normalize_query
+from onikali.progress import ProgressiveEdit, ProgressGroup
+from onikali.outbox import Outbox
+from onikali.singleflight import SingleFlight
+from onikali.prompts import build_prompts
+from onikali.articles import ARTICLE_CACHE_KEEP, ARTICLE_CACHE_SIZE, ARTICLE_CACHE_TTL, ArticleFetcher
+from onikali.batch import BATCH_CONCURRENCY, BatchJournal, parse_topics, provider_slot, run_batch, unfinished
+from onikali.scheduler import ChatScheduler
+from onikali import metrics
+from onikali.sessions import SessionStore, SharedSessionStore
+from onikali.state import STATE_BACKEND, open_backend
+from onikali.drafts import DraftWriter
+from onikali.edits import EDIT_FORMAT, is_global_edit, split_sections, join_sections, numbered, parse_edits, apply_edits
+
 load_dotenv()
 
 logging.basicConfig(
@@ -24,30 +45,139 @@ GROQ_KEY = os.getenv('GROQ_API_KEY')
 BRAVE_KEY = os.getenv("BRAVE_API_KEY")
 PROXY_URL = "http://127.0.0.1:9674"
 
+# 服务商地址
+BRAVE_URL = "https://api.search.brave.com/res/v1/web/search"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_AUDIO_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
+GROQ_MODELS_URL = "https://api.groq.com/openai/v1/models"
+
+# 共享连接池：每个服务商主机一个长连接会话
+http_pool = HTTPPool(
+    proxy=PROXY_URL,
+    limit_per_host=int(os.getenv('HTTP_LIMIT_PER_HOST', '10')),
+    keepalive_timeout=float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '75')),
+)
+
+# Telegram 发送出口：全局/每会话限流、RetryAfter 重试、长文分条、编辑合并
+outbox = Outbox()
+
+# 按 config/onikali_config.yml 路由，带熔断；设置 STATE_BACKEND 后熔断状态在多个进程间共享
+router = LayerRouter(backend=open_backend('bot_layers'))
+
+# 各模型延迟记录，用于对冲请求；样本不足时按配置中各层的 hedge_delay 等待
+layer_latency = LatencyTracker(defaults=router.hedge_delays())
+
+# 本入口接入的层：配置中的层 -> (模型, 显示名)
+BOT_LAYERS = {
+    "L2_DeepSeek": ("deepseek/deepseek-r1-0528:free", "DeepSeek R1"),
+    "L3_Groq": ("llama-3.3-70b-versatile", "Groq Llama"),
+    "L4_Claude": ("anthropic/claude-3.5-sonnet", "Claude 3.5"),
+}
+MODEL_LAYERS = {model: key for key, (model, _) in BOT_LAYERS.items()}
+OPENROUTER_DEFAULT_MODEL = BOT_LAYERS["L4_Claude"][0]
+
+# 按服务商+模型的令牌桶限流，参数来自各层配置
+limiters = RateLimiters(router.layers)
+
 # 工作目录
 WORK_DIR = os.path.expanduser("~/ÖNIKA_Workspace")
 os.makedirs(WORK_DIR, exist_ok=True)
 
-# 用户数据存储
-user_data = {}
-last_request_time = 0
-MIN_REQUEST_INTERVAL = 3  # 增加间隔到3秒
+# 用户会话：内存LRU + SQLite，保存每个用户的草稿版本历史；设置 STATE_BACKEND 时直接读写共享后端
+if STATE_BACKEND:
+    sessions = SharedSessionStore(open_backend('sessions'), history=int(os.getenv('SESSION_HISTORY', '10')))
+else:
+    sessions = SessionStore(
+        os.getenv('SESSION_DB', os.path.join(WORK_DIR, 'sessions.db')),
+        maxsize=int(os.getenv('SESSION_CACHE_SIZE', '1000')),
+        history=int(os.getenv('SESSION_HISTORY', '10')),
+    )
+
+# 搜索结果缓存：内存LRU + 可选磁盘层（SEARCH_CACHE_DB 设为空则只用内存）
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '21600'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '512'))
+SEARCH_CACHE_DB = os.getenv('SEARCH_CACHE_DB', os.path.join(WORK_DIR, 'search_cache.db'))
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_DB or None, table='search',
+                        backend=open_backend('search'))
+
+# 原文抓取：/write 前并发读取前几条搜索结果的网页，正文按 URL 和内容哈希缓存
+articles = ArticleFetcher(
+    TTLCache(ARTICLE_CACHE_SIZE, ARTICLE_CACHE_TTL, SEARCH_CACHE_DB or None, table='articles',
+             backend=open_backend('articles'), grace=ARTICLE_CACHE_KEEP),
+    proxy=PROXY_URL,
+)
+
+# 语音识别：同时转写数量上限、流式分块大小、按 file_unique_id 缓存转写结果
+VOICE_MAX_CONCURRENCY = int(os.getenv('VOICE_MAX_CONCURRENCY', '4'))
+VOICE_CHUNK_SIZE = 64 * 1024
+voice_semaphore = asyncio.Semaphore(VOICE_MAX_CONCURRENCY)
+transcript_cache = TTLCache(
+    int(os.getenv('TRANSCRIPT_CACHE_SIZE', '1024')),
+    float(os.getenv('TRANSCRIPT_CACHE_TTL', '2592000')),
+    SEARCH_CACHE_DB or None,
+    table='transcripts',
+    backend=open_backend('transcripts')
+)
+
+# /modify 每轮token用量：增量修改 vs 整篇重写
+modify_tokens = {
+    "patch": {"rounds": 0, "prompt": 0, "completion": 0},
+    "full": {"rounds": 0, "prompt": 0, "completion": 0},
+}
+
+# 文案写入：后台批量落盘，WORK_DIR/manifest.jsonl 记录索引
+drafts = DraftWriter(WORK_DIR, max_queue=int(os.getenv('DRAFT_QUEUE_SIZE', '256')))
+
+# 运行指标：缓存命中与熔断状态在导出时读取；设置 METRICS_PORT 后启动独立的 /metrics 服务
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+metrics.REGISTRY.collector(lambda: metrics.cache_metrics(
+    {"search": search_cache, "transcripts": transcript_cache, "articles": articles.cache}))
+metrics.REGISTRY.collector(lambda: metrics.breaker_metrics(router))
+metrics_runner = None
 
-def save_to_file(filename, content, folder="文案"):
-    folder_path = os.path.join(WORK_DIR, folder)
-    os.makedirs(folder_path, exist_ok=True)
-    safe_filename = "".join([c for c in filename if c.isalpha() or c.isdigit() or c in (' ', '-', '_')]).rstrip()[:30]
-    filepath = os.path.join(folder_path, f"{safe_filename}_{datetime.now().strftime('%m%d_%H%M')}.txt")
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(f"# {filename}\n# 生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n{content}")
-    return filepath
+# /write 提示词模板：{search_info} 由 onikali.prompts 在输入预算内填入搜索摘要
+WRITE_TEMPLATE = """你是LiveGigs Asia的专业文案写手。
+
+主题：{topic}
+
+{search_info}
+
+请创作包含以下内容的文案：
+1. 吸引人的标题
+2. 正文（300-500字，包含具体数据、时间、亮点）
+3. 社交媒体标签（#话题）
+4. 适合发布的平台建议
+
+风格：专业、有激情、适合音乐演出行业。如果提供了搜索信息，必须融入真实数据。"""
+
+# 请求合并：同一时间相同的搜索/生成只调用一次上游，结果共享
+search_flight = SingleFlight("search")
+generation_flight = SingleFlight("generation")
+
+# 批量生成：日志保存在 WORK_DIR/batches，每个用户同时只运行一批
+BATCH_DIR = os.path.join(WORK_DIR, 'batches')
+running_batches = {}
+
+async def save_to_file(filename, content, folder="文案", user_id=None, model=None, wait=False):
+    """保存文案：立即返回不重名的路径，由后台任务写盘；wait=True 时落盘后返回"""
+    return await drafts.save(filename, content, folder, user_id, model, wait=wait)
 
 async def brave_search(query, count=5):
-    """Brave Search API"""
+    """Brave Search API（结果按归一化查询缓存）"""
     if not BRAVE_KEY:
         return None, "Brave API Key 未配置"
     
-    url = "https://api.search.brave.com/res/v1/web/search"
+    cache_key = f"{count}:{normalize_query(query)}"
+    cached = await search_cache.aget(cache_key)
+    if cached is not None:
+        return cached, None
+    
+    return await search_flight.do(cache_key, lambda _: fetch_search(query, count, cache_key))
+
+async def fetch_search(query, count, cache_key):
+    """实际请求 Brave Search 并写入缓存"""
+    url = BRAVE_URL
     headers = {
         "Accept": "application/json",
         "X-Subscription-Token": BRAVE_KEY
@@ -58,10 +188,9 @@ async def brave_search(query, count=5):
         "search_lang": "zh"
     }
     
-    try:
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(url, headers=headers, params=params, proxy=PROXY_URL, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+    async with provider_slot("brave"), metrics.track("brave", "web") as call:
+        try:
+            async with http_pool.get(url, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=30)) as resp:
                 if resp.status == 200:
                     data = await resp.json()
                     results = []
@@ -71,27 +200,23 @@ async def brave_search(query, count=5):
                             'url': item.get('url', ''),
                             'description': item.get('description', '')[:300]
                         })
+                    search_cache.set(cache_key, results)
                     return results, None
                 else:
-                    text = await resp.text()
+                    await resp.read()
+                    call.status = "rate_limit" if resp.status == 429 else "error"
                     return None, f"搜索失败: {resp.status}"
-    except Exception as e:
-        return None, f"搜索错误: {str(e)[:100]}"
+        except Exception as e:
+            call.status = metrics.failure_reason(e)
+            return None, f"搜索错误: {str(e)[:100]}"
 
-async def call_openrouter(messages, model="anthropic/claude-3.5-sonnet", retry=2):
-    """调用OpenRouter，带重试"""
-    global last_request_time
-    
+@metrics.tracked("openrouter")
+async def call_openrouter(messages, model=OPENROUTER_DEFAULT_MODEL, retry=2, on_delta=None, max_tokens=2000, usage=None):
+    """调用OpenRouter，带重试；传入 on_delta 时以SSE流式返回，传入 usage 字典时写入token用量"""
     if not OPENROUTER_KEY:
         return None, "OpenRouter API Key 未配置"
     
-    # 速率限制
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    if time_since_last < MIN_REQUEST_INTERVAL:
-        await asyncio.sleep(MIN_REQUEST_INTERVAL - time_since_last)
-    
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    url = OPENROUTER_URL
     headers = {
         "Authorization": f"Bearer {OPENROUTER_KEY}",
         "Content-Type": "application/json",
@@ -102,49 +227,78 @@ async def call_openrouter(messages, model="anthropic/claude-3.5-sonnet", retry=2
         "model": model,
         "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 2000
+        "max_tokens": max_tokens
     }
     
+    # 已输出过增量时不再重试，避免进度消息重复
+    emitted = []
+    if on_delta:
+        data["stream"] = True
+        # 流式响应的最后一块带上token用量
+        data["stream_options"] = {"include_usage": True}
+        
+        def emit(delta):
+            emitted.append(delta)
+            on_delta(delta)
+    
     for attempt in range(retry):
+        # 速率限制：按模型的令牌桶，排队过长视为限流
         try:
-            connector = aiohttp.TCPConnector(ssl=False)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.post(url, headers=headers, json=data, proxy=PROXY_URL, timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                    last_request_time = time.time()
-                    
-                    if resp.status == 200:
-                        result = await resp.json()
-                        return result['choices'][0]['message']['content'], None
-                    elif resp.status == 401:
-                        error_text = await resp.text()
-                        logger.error(f"OpenRouter 401错误: {error_text}")
-                        if attempt < retry - 1:
-                            await asyncio.sleep(2)
-                            continue
-                        return None, f"API认证失败(401)，请检查OpenRouter Key是否有效"
-                    elif resp.status == 429:
-                        return None, "rate_limit"
-                    elif resp.status == 402:
-                        return None, "no_credits"
+            await limiters.acquire("openrouter", model, MODEL_LAYERS.get(model))
+        except RateLimitExceeded as e:
+            logger.warning(f"OpenRouter本地限流 {model}: {e}")
+            return None, LOCAL_THROTTLE
+        
+        try:
+            async with http_pool.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+                if resp.status == 200:
+                    tokens = {}
+                    if on_delta:
+                        content = await read_openai_stream(resp, emit, tokens)
                     else:
-                        error_text = await resp.text()
-                        logger.error(f"OpenRouter错误 {resp.status}: {error_text[:200]}")
-                        return None, f"API错误: {resp.status}"
+                        result = await resp.json()
+                        tokens = result.get('usage') or {}
+                        content = result['choices'][0]['message']['content']
+                    metrics.record_tokens("openrouter", model, tokens.get('prompt_tokens', 0), tokens.get('completion_tokens', 0))
+                    if usage is not None:
+                        usage.update(tokens)
+                    if on_delta and not content:
+                        return None, "空响应"
+                    return content, None
+                elif resp.status == 401:
+                    error_text = await resp.text()
+                    logger.error(f"OpenRouter 401错误: {error_text}")
+                    if attempt < retry - 1:
+                        await asyncio.sleep(2)
+                        continue
+                    return None, f"API认证失败(401)，请检查OpenRouter Key是否有效"
+                elif resp.status == 429:
+                    await resp.read()
+                    return None, "rate_limit"
+                elif resp.status == 402:
+                    await resp.read()
+                    return None, "no_credits"
+                else:
+                    error_text = await resp.text()
+                    logger.error(f"OpenRouter错误 {resp.status}: {error_text[:200]}")
+                    return None, f"API错误: {resp.status}"
         except Exception as e:
             logger.error(f"OpenRouter请求异常: {str(e)}")
-            if attempt < retry - 1:
+            if attempt < retry - 1 and not emitted:
                 await asyncio.sleep(2)
                 continue
-            return None, f"请求失败: {str(e)[:100]}"
+            reason = "请求超时" if isinstance(e, asyncio.TimeoutError) else str(e)[:100]
+            return None, f"请求失败: {reason}"
     
     return None, "所有重试失败"
 
-async def call_groq(messages, model="llama-3.3-70b-versatile"):
-    """调用Groq"""
+@metrics.tracked("groq")
+async def call_groq(messages, model="llama-3.3-70b-versatile", on_delta=None, max_tokens=2000):
+    """调用Groq；传入 on_delta 时以SSE流式返回"""
     if not GROQ_KEY:
         return None, "Groq未配置"
     
-    url = "https://api.groq.com/openai/v1/chat/completions"
+    url = GROQ_URL
     headers = {
         "Authorization": f"Bearer {GROQ_KEY}",
         "Content-Type": "application/json"
@@ -153,112 +307,197 @@ async def call_groq(messages, model="llama-3.3-70b-versatile"):
         "model": model,
         "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 2000
+        "max_tokens": max_tokens
     }
+    if on_delta:
+        data["stream"] = True
+        data["stream_options"] = {"include_usage": True}
     
     try:
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(url, headers=headers, json=data, proxy=PROXY_URL, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    return result['choices'][0]['message']['content'], None
+        await limiters.acquire("groq", model, MODEL_LAYERS.get(model))
+    except RateLimitExceeded as e:
+        logger.warning(f"Groq本地限流 {model}: {e}")
+        return None, LOCAL_THROTTLE
+    
+    try:
+        async with http_pool.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+            if resp.status == 200:
+                tokens = {}
+                if on_delta:
+                    content = await read_openai_stream(resp, on_delta, tokens)
                 else:
-                    return None, f"Groq错误: {resp.status}"
+                    result = await resp.json()
+                    tokens = result.get('usage') or {}
+                    content = result['choices'][0]['message']['content']
+                metrics.record_tokens("groq", model, tokens.get('prompt_tokens', 0), tokens.get('completion_tokens', 0))
+                if on_delta and not content:
+                    return None, "Groq空响应"
+                return content, None
+            elif resp.status == 429:
+                await resp.read()
+                return None, "rate_limit"
+            else:
+                await resp.read()
+                return None, f"Groq错误: {resp.status}"
     except Exception as e:
-        return None, f"Groq请求失败: {str(e)[:50]}"
+        reason = "请求超时" if isinstance(e, asyncio.TimeoutError) else str(e)[:50]
+        return None, f"Groq请求失败: {reason}"
 
-async def transcribe_voice(voice_file_url):
-    """语音识别"""
+async def transcribe_voice(voice_file_url, file_unique_id=None):
+    """语音识别：边下载边上传，不在内存中缓存整段音频；结果按 file_unique_id 缓存"""
     if not GROQ_KEY:
         return None, "Groq未配置"
     
-    try:
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(voice_file_url, proxy=PROXY_URL, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status != 200:
-                    return None, "下载失败"
-                voice_data = await resp.read()
-            
-            url = "https://api.groq.com/openai/v1/audio/transcriptions"
-            headers = {"Authorization": f"Bearer {GROQ_KEY}"}
-            data = aiohttp.FormData()
-            data.add_field('file', voice_data, filename='voice.ogg', content_type='audio/ogg')
-            data.add_field('model', 'whisper-large-v3')
-            data.add_field('language', 'zh')
-            
-            async with session.post(url, headers=headers, data=data, proxy=PROXY_URL, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    return result['text'], None
-                else:
-                    return None, f"识别失败"
-    except Exception as e:
-        return None, f"语音错误"
-
-async def generate_content(topic, search_results=None):
-    """生成文案"""
-    search_info = ""
-    if search_results:
-        search_info = "基于以下网络信息创作：\n"
-        for i, r in enumerate(search_results[:3], 1):
-            search_info += f"{i}. {r['title']}: {r['description'][:200]}\n"
+    if file_unique_id:
+        cached = await transcript_cache.aget(file_unique_id)
+        if cached is not None:
+            return cached, None
     
-    prompt = f"""你是LiveGigs Asia的专业文案写手。
-
-主题：{topic}
-
-{search_info}
-
-请创作包含以下内容的文案：
-1. 吸引人的标题
-2. 正文（300-500字，包含具体数据、时间、亮点）
-3. 社交媒体标签（#话题）
-4. 适合发布的平台建议
+    async with voice_semaphore, metrics.track("groq", "whisper-large-v3") as call:
+        try:
+            async with http_pool.get(voice_file_url, timeout=aiohttp.ClientTimeout(total=30)) as download:
+                if download.status != 200:
+                    call.status = "download_failed"
+                    return None, "下载失败"
+                
+                url = GROQ_AUDIO_URL
+                headers = {"Authorization": f"Bearer {GROQ_KEY}"}
+                data = aiohttp.FormData()
+                data.add_field('file', download.content.iter_chunked(VOICE_CHUNK_SIZE), filename='voice.ogg', content_type='audio/ogg')
+                data.add_field('model', 'whisper-large-v3')
+                data.add_field('language', 'zh')
+                
+                async with http_pool.post(url, headers=headers, data=data, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+                    if resp.status == 200:
+                        result = await resp.json()
+                        if file_unique_id:
+                            transcript_cache.set(file_unique_id, result['text'])
+                        return result['text'], None
+                    else:
+                        await resp.read()
+                        call.status = "rate_limit" if resp.status == 429 else "error"
+                        return None, f"识别失败"
+        except Exception as e:
+            call.status = metrics.failure_reason(e)
+            logger.error(f"语音识别异常: {e}")
+            return None, f"语音错误"
+
+async def generate_content(topic, search_results=None, progress=None, policy="write"):
+    """生成文案；传入 progress 时流式显示生成过程，policy 为 routing.policies 中的排序策略"""
+    # 每个模型按各自的分词估算放入摘要，max_tokens 按目标字数设置
+    prompts = build_prompts(WRITE_TEMPLATE, topic, search_results, [model for model, _ in BOT_LAYERS.values()])
+    
+    # 相同策略、相同提示词的并发生成合并为一次，各调用方的进度消息都显示同一份流式输出；
+    # 进度组总是创建，第一个调用方不需要进度时，后加入的调用方也能看到流式输出
+    group = None
+    
+    def join(data):
+        nonlocal group
+        group = data.setdefault('progress', ProgressGroup())
+        if progress:
+            group.add(progress)
+    
+    key = (policy, hashlib.sha256("\0".join(sorted({p.text for p in prompts.values()})).encode('utf-8')).hexdigest())
+    try:
+        return await generation_flight.do(
+            key, lambda data: run_layers(prompts, topic, search_results, data.get('progress'), policy), join
+        )
+    finally:
+        if progress:
+            group.discard(progress)
+
+async def run_layers(prompts, topic, search_results=None, progress=None, policy="write"):
+    """按策略排序尝试各层，熔断中的层直接跳过；返回 (文案, 层名或错误)"""
+    attempts = router.attempts(layer_handlers(prompts, progress), accept=lambda r: bool(r[0]), policy=policy)
+    key, result = await race(attempts, layer_latency, accept=lambda r: bool(r[0]))
+    if key:
+        return result[0], BOT_LAYERS[key][1]
+    
+    # 应急模式：用搜索结果按模板拼出草稿；批量生成不用，否则模板草稿会被记为完成、续跑时不再重新生成
+    if router.emergency_enabled and policy != "batch":
+        return emergency_draft(topic, search_results), "应急模式"
+    
+    if result is None:
+        return None, "所有AI层熔断中，请稍后再试"
+    error = result[1] if isinstance(result, tuple) else f"请求失败: {str(result)[:100]}"
+    return None, error
 
-风格：专业、有激情、适合音乐演出行业。如果提供了搜索信息，必须融入真实数据。"""
-    
-    messages = [{"role": "user", "content": prompt}]
-    
-    # 先尝试Claude
-    content, error = await call_openrouter(messages, "anthropic/claude-3.5-sonnet")
-    if content:
-        return content, "Claude 3.5"
-    
-    # 如果失败，尝试DeepSeek免费版
-    if error in ["rate_limit", "no_credits"]:
-        content, error = await call_openrouter(messages, "deepseek/deepseek-r1-0528:free")
-        if content:
-            return content, "DeepSeek R1"
-    
-    # 最后尝试Groq
+def layer_handlers(prompts, progress=None):
+    """已配置Key的层 -> 调用函数；prompts 为 模型 -> Prompt"""
+    def handler(key, call, provider):
+        async def run():
+            on_delta = progress.writer(key) if progress else None
+            model = BOT_LAYERS[key][0]
+            prompt = prompts[model]
+            async with provider_slot(provider):
+                content, error = await call(prompt.messages, model, on_delta=on_delta, max_tokens=prompt.max_tokens)
+            if progress and not content:
+                progress.release(key)
+            return content, error
+        return run
+    
+    handlers = {}
+    if OPENROUTER_KEY:
+        handlers["L2_DeepSeek"] = handler("L2_DeepSeek", call_openrouter, "openrouter")
+        handlers["L4_Claude"] = handler("L4_Claude", call_openrouter, "openrouter")
     if GROQ_KEY:
-        content, error = await call_groq(messages)
-        if content:
-            return content, "Groq Llama"
-    
-    return None, error
+        handlers["L3_Groq"] = handler("L3_Groq", call_groq, "groq")
+    return handlers
+
+def emergency_draft(topic, search_results=None):
+    """应急模式文案：不调用AI，按预设模板整理搜索结果"""
+    lines = [f"【{topic}】", ""]
+    if search_results:
+        for r in search_results[:3]:
+            lines.append(f"▶ {r['title']}")
+            lines.append(r['description'])
+            lines.append(r['url'])
+            lines.append("")
+    else:
+        lines.append("详细信息整理中，敬请关注 LiveGigs Asia 后续更新。")
+        lines.append("")
+    tag = "".join(c for c in topic if c.isalnum())[:20]
+    lines.append(f"#LiveGigsAsia #{tag}" if tag else "#LiveGigsAsia")
+    lines.append("")
+    lines.append("（应急模式生成：AI层暂不可用，请人工润色后发布）")
+    return "\n".join(lines)
+
+async def probe_openrouter(model):
+    """熔断恢复探测：1 token 请求"""
+    headers = {"Authorization": f"Bearer {OPENROUTER_KEY}", "Content-Type": "application/json"}
+    data = {"model": model, "messages": [{"role": "user", "content": "ping"}], "max_tokens": 1}
+    async with http_pool.post(OPENROUTER_URL, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        await resp.read()
+        return resp.status == 200
+
+async def probe_groq():
+    """熔断恢复探测：模型列表"""
+    headers = {"Authorization": f"Bearer {GROQ_KEY}"}
+    async with http_pool.get(GROQ_MODELS_URL, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        await resp.read()
+        return resp.status == 200
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome = """🎸 ÖNIKA LI 运营助理
 
 ✅ 自动上网搜索: Brave Search
-✅ AI文案生成: Claude 3.5 / DeepSeek / Groq
+✅ AI文案生成: DeepSeek / Groq / Claude 3.5（按配置顺序自动切换）
 ✅ 语音识别: Whisper
 
 📋 指令：
 /write [主题] - 自动搜索+写文案
 /search [关键词] - 搜索信息
 /modify [要求] - 修改文案
+/batch [主题列表] - 批量写文案（每行一个主题）
+/drafts - 最近保存的文案
 
 💡 直接发送主题，如"noname乐队2026巡演"，自动写文案"""
-    await update.message.reply_text(welcome)
+    await outbox.reply(update.message, welcome)
 
 async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """搜索命令"""
     if not context.args:
-        await update.message.reply_text("🔍 用法：/search [关键词]")
+        await outbox.reply(update.message, "🔍 用法：/search [关键词]")
         return
     
     query = " ".join(context.args)
@@ -266,19 +505,19 @@ async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     results, error = await brave_search(query)
     if error:
-        await update.message.reply_text(f"⚠️ {error}")
+        await outbox.reply(update.message, f"⚠️ {error}")
         return
     
     text = f"🔍 {query} 的搜索结果：\n━━━━━━━━━━━━━━\n"
     for i, r in enumerate(results[:3], 1):
         text += f"{i}. {r['title']}\n{r['description'][:150]}...\n{r['url']}\n\n"
     
-    await update.message.reply_text(text[:1500])
+    await outbox.reply(update.message, text)
 
 async def write_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """写文案"""
     if not context.args:
-        await update.message.reply_text("📝 用法：/write [主题]")
+        await outbox.reply(update.message, "📝 用法：/write [主题]")
         return
     
     topic = " ".join(context.args)
@@ -289,51 +528,49 @@ async def do_write(update: Update, topic: str):
     user_id = update.effective_user.id
     
     await update.message.chat.send_action(action="typing")
-    msg = await update.message.reply_text(f"🔍 正在搜索【{topic}】...")
+    msg = await outbox.reply(update.message, f"🔍 正在搜索【{topic}】...")
     
-    # 强制搜索
+    # 强制搜索，再并发读取前几条结果的原文（限时，最多多一次往返）
     search_results, search_error = await brave_search(topic, count=5)
+    search_results = await articles.enrich(topic, search_results)
     
-    # 生成
+    # 生成（流式显示草稿）
     await update.message.chat.send_action(action="typing")
-    content, layer = await generate_content(topic, search_results)
+    progress = ProgressiveEdit(msg, header=f"✍️ 正在生成【{topic}】...\n\n", outbox=outbox)
+    content, layer = await generate_content(topic, search_results, progress)
+    await progress.close()
     
     if content:
         # 保存
         filename = topic[:25]
-        filepath = save_to_file(filename, content, "文案")
+        filepath = await save_to_file(filename, content, "文案", user_id, layer)
         
         # 记录
-        user_data[user_id] = {
-            "last_content": content,
-            "last_topic": topic,
-            "last_filepath": filepath,
-            "search_results": search_results
-        }
-        
-        preview = content[:700] + "..." if len(content) > 700 else content
+        await sessions.asave_draft(user_id, topic, content, filepath, search_results)
         
+        # 全文发出，超过单条上限时由 outbox 按段落拆成多条
         text = f"""✅ 文案已生成（使用 {layer}）！
 
 📁 保存：{filepath}
 
-{preview}
+{content}
 
 💡 提修改意见（太长/加数据/改风格），我自动修改"""
-        await msg.edit_text(text)
+        await outbox.edit(msg, text)
     else:
-        await msg.edit_text(f"⚠️ 生成失败：{layer}\n\n建议：\n1. 检查OpenRouter Key是否有效\n2. 等待1分钟再试\n3. 或联系管理员检查配置")
+        await outbox.edit(msg, f"⚠️ 生成失败：{layer}\n\n建议：\n1. 检查OpenRouter Key是否有效\n2. 等待1分钟再试\n3. 或联系管理员检查配置")
 
 async def modify_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """修改文案"""
     user_id = update.effective_user.id
     
-    if user_id not in user_data:
-        await update.message.reply_text("⚠️ 没有可修改的文案，先发送主题生成")
+    session = await sessions.aget(user_id)
+    if session is None:
+        await outbox.reply(update.message, "⚠️ 没有可修改的文案，先发送主题生成")
         return
     
     if not context.args:
-        await update.message.reply_text("""✏️ 用法：/modify [修改要求]
+        await outbox.reply(update.message, """✏️ 用法：/modify [修改要求]
 
 例如：
 /modify 缩短到200字
@@ -342,72 +579,251 @@ async def modify_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     modification = " ".join(context.args)
-    last_content = user_data[user_id]["last_content"]
-    topic = user_data[user_id]["last_topic"]
+    last_content = session.content
+    topic = session.topic
     
     await update.message.chat.send_action(action="typing")
     
+    new_content, error, mode, usage = await revise_content(topic, last_content, modification)
+    
+    if new_content:
+        filename = f"{topic}_修改版"
+        filepath = await save_to_file(filename, new_content, "文案", user_id, BOT_LAYERS["L4_Claude"][1])
+        
+        version = (await sessions.asave_draft(user_id, topic, new_content, filepath)).version
+        
+        mode_label = "增量修改" if mode == "patch" else "整篇重写"
+        text = f"""✅ 已修改！（第 {version} 版 · {mode_label}）
+
+📁 新版本：{filepath}
+
+{new_content}
+
+🧮 本轮 tokens：输入 {usage['prompt']} / 输出 {usage['completion']}
+💡 继续修改或说定稿"""
+        await outbox.reply(update.message, text)
+    else:
+        await outbox.reply(update.message, f"⚠️ 修改失败：{error}")
+
+async def revise_content(topic, content, modification):
+    """修改文案：优先让模型只返回改动段落并在本地应用，必要时整篇重写
+
+    返回 (新文案, 错误, 模式, 本轮token用量)
+    """
+    round_usage = {"prompt": 0, "completion": 0}
+    
+    def count(mode, usage):
+        round_usage["prompt"] += usage.get('prompt_tokens', 0)
+        round_usage["completion"] += usage.get('completion_tokens', 0)
+        stats = modify_tokens[mode]
+        stats["prompt"] += usage.get('prompt_tokens', 0)
+        stats["completion"] += usage.get('completion_tokens', 0)
+    
+    sections = split_sections(content)
+    if len(sections) > 1 and not is_global_edit(modification):
+        prompt = f"""按修改要求修改下面的文案，文案已按段落编号。
+
+原文主题：{topic}
+
+{numbered(sections)}
+
+修改要求：{modification}
+
+{EDIT_FORMAT}"""
+        usage = {}
+        reply, error = await call_openrouter([{"role": "user", "content": prompt}], OPENROUTER_DEFAULT_MODEL, max_tokens=1000, usage=usage)
+        count("patch", usage)
+        edits = parse_edits(reply) if reply else None
+        if edits and not edits.get('full'):
+            revised = apply_edits(sections, edits.get('edits'))
+            if revised:
+                modify_tokens["patch"]["rounds"] += 1
+                return join_sections(revised), None, "patch", round_usage
+        logger.info("增量修改不可用，改为整篇重写")
+    
     prompt = f"""修改以下文案。
 
 原文主题：{topic}
 
 原文案：
-{last_content}
+{content}
 
 修改要求：{modification}
 
 请输出修改后的完整文案。"""
     
-    messages = [{"role": "user", "content": prompt}]
-    new_content, error = await call_openrouter(messages)
-    
+    usage = {}
+    new_content, error = await call_openrouter([{"role": "user", "content": prompt}], OPENROUTER_DEFAULT_MODEL, usage=usage)
+    count("full", usage)
     if new_content:
-        filename = f"{topic}_修改版"
-        filepath = save_to_file(filename, new_content, "文案")
-        
-        user_data[user_id]["last_content"] = new_content
-        user_data[user_id]["last_filepath"] = filepath
-        
-        preview = new_content[:700] + "..." if len(new_content) > 700 else new_content
-        
-        text = f"""✅ 已修改！
+        modify_tokens["full"]["rounds"] += 1
+    return new_content, error, "full", round_usage
+
+async def write_batch_item(topic, user_id=None, folder="批量"):
+    """批量中的一个主题：搜索+生成+保存，返回 (路径, 层名, 错误)"""
+    search_results, _ = await brave_search(topic, count=5)
+    search_results = await articles.enrich(topic, search_results)
+    content, layer = await generate_content(topic, search_results, policy="batch")
+    if not content:
+        return None, None, layer
+    # 确认落盘后才记为完成，崩溃后从日志继续时不会漏掉文件
+    filepath = await save_to_file(topic[:25], content, folder, user_id, layer, wait=True)
+    return filepath, layer, None
+
+def batch_summary(journal, limit=10):
+    """批次结果：成功的列出保存路径，失败的列出原因"""
+    lines = []
+    for index, topic in enumerate(journal.topics):
+        entry = journal.results.get(index)
+        if entry is None:
+            continue
+        if entry["status"] == "ok":
+            lines.append(f"✅ {topic}（{entry['layer']}）\n   {entry['path']}")
+        else:
+            lines.append(f"❌ {topic}：{entry['error']}")
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"……另有 {len(lines) - limit} 条，见 {journal.path}"]
+    return "\n".join(lines)
+
+async def run_batch_chat(msg, journal, user_id):
+    """在后台运行一批，节流更新进度消息"""
+    header = f"📦 批量生成 {journal.id}（共 {journal.total} 个主题）\n"
+    last = {"at": 0.0, "task": None}
+    
+    def on_progress(journal, entry):
+        now = time.monotonic()
+        if now - last["at"] < 3 or (last["task"] is not None and not last["task"].done()):
+            return
+        last["at"] = now
+        icon = "✅" if entry["status"] == "ok" else "❌"
+        last["task"] = asyncio.ensure_future(
+            outbox.edit(msg, f"{header}进度：{journal.done + journal.failed}/{journal.total}（失败 {journal.failed}）\n{icon} {entry['topic']}")
+        )
+    
+    running_batches[user_id] = journal
+    started = time.monotonic()
+    try:
+        await run_batch(journal, lambda topic: write_batch_item(topic, user_id, os.path.join("批量", journal.id)),
+                        on_progress=on_progress)
+        if last["task"] is not None:
+            await asyncio.gather(last["task"], return_exceptions=True)
+        status = "✅ 全部完成" if journal.finished else f"⚠️ {journal.failed} 个失败，发送 /batch resume 重试"
+        await outbox.edit(
+            msg, f"{header}{status}（{journal.done}/{journal.total}，用时 {time.monotonic() - started:.0f}s）\n\n{batch_summary(journal)}"
+        )
+    except Exception as e:
+        logger.error(f"批量任务 {journal.id} 异常: {e}")
+        await outbox.edit(msg, f"{header}⚠️ 中断：{str(e)[:100]}\n发送 /batch resume 继续")
+    finally:
+        running_batches.pop(user_id, None)
 
-📁 新版本：{filepath}
+async def batch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """批量写文案：/batch 后每行一个主题；/batch resume 继续上次未完成的批次"""
+    user_id = update.effective_user.id
+    if user_id in running_batches:
+        journal = running_batches[user_id]
+        await outbox.reply(update.message, f"⏳ 批次 {journal.id} 还在运行（{journal.done + journal.failed}/{journal.total}）")
+        return
+    
+    text = update.message.text.split(maxsplit=1)
+    body = text[1] if len(text) > 1 else ""
+    if body.strip().lower() == "resume":
+        pending = await asyncio.to_thread(unfinished, BATCH_DIR, user_id)
+        if not pending:
+            await outbox.reply(update.message, "📦 没有未完成的批次")
+            return
+        journal = pending[0]
+    else:
+        topics = parse_topics(body)
+        if not topics:
+            await outbox.reply(update.message, """📦 用法：/batch 后每行一个主题（或用分号分隔），最多 50 个
 
-{preview}
+例如：
+/batch 万能青年旅店 北京站
+万能青年旅店 上海站
+万能青年旅店 成都站
 
-💡 继续修改或说定稿"""
-        await update.message.reply_text(text)
-    else:
-        await update.message.reply_text(f"⚠️ 修改失败：{error}")
+/batch resume - 继续上次中断的批次""")
+            return
+        journal = await asyncio.to_thread(BatchJournal.create, BATCH_DIR, topics, user_id, update.effective_chat.id)
+    
+    msg = await outbox.reply(
+        update.message, f"📦 批量生成 {journal.id}：{len(journal.pending())}/{journal.total} 个主题待处理..."
+    )
+    # 后台运行，不占用本会话的更新队列
+    context.application.create_task(run_batch_chat(msg, journal, user_id), update=update)
 
 async def save_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """手动保存"""
     if len(context.args) < 2:
-        await update.message.reply_text("💾 用法：/save [文件名] [内容]")
+        await outbox.reply(update.message, "💾 用法：/save [文件名] [内容]")
         return
     
     filename = context.args[0]
     content = " ".join(context.args[1:])
-    filepath = save_to_file(filename, content, "手动保存")
+    filepath = await save_to_file(filename, content, "手动保存", update.effective_user.id)
+    
+    await outbox.reply(update.message, f"✅ 已保存：{filepath}")
+
+async def drafts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """列出最近保存的文案（读取索引，不扫描目录）"""
+    entries = await drafts.alist(user_id=update.effective_user.id, limit=10)
+    if not entries:
+        await outbox.reply(update.message, "📂 还没有保存过文案")
+        return
     
-    await update.message.reply_text(f"✅ 已保存：{filepath}")
+    text = "📂 最近的文案：\n━━━━━━━━━━━━━━\n"
+    for i, e in enumerate(entries, 1):
+        model = f" · {e['model']}" if e.get('model') else ""
+        text += f"{i}. {e['topic']}{model}\n   {e['timestamp'].replace('T', ' ')} · {e['bytes']}B\n   {e['path']}\n"
+    await outbox.reply(update.message, text)
+
+def ranking_line(policy):
+    """某命令当前的路由排序：层名 平均耗时·失败率"""
+    parts = []
+    for r in router.rankings(policy, BOT_LAYERS):
+        latency = f"{r['latency']:.1f}s" if r['latency'] is not None else "—"
+        icon = "🔴" if r['state'] == OPEN else ""
+        parts.append(f"{icon}{BOT_LAYERS[r['key']][1]} {latency}·{r['error_rate']:.0%}")
+    strategy = router.policy(policy).get('strategy', 'priority')
+    return f"/{policy}（{strategy}）：" + " → ".join(parts)
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """状态"""
+    layers = []
+    for key, info in router.status().items():
+        if key not in BOT_LAYERS:
+            continue
+        count, total = metrics.LAYER_DURATION.total(layer=key, outcome="ok")
+        failovers = metrics.FAILOVERS.total(layer=key)
+        usage = f"（成功 {count} 次 · 平均 {total / count:.1f}s · 切换 {failovers:.0f} 次）" if count else (
+            f"（切换 {failovers:.0f} 次）" if failovers else "")
+        if info['state'] == OPEN:
+            layers.append(f"🔴 {BOT_LAYERS[key][1]} - 熔断中（{info['retry_in']}秒后试探）{usage}")
+        else:
+            layers.append(f"✅ {BOT_LAYERS[key][1]} - Layer {info['priority']}{usage}")
+    layers = "\n".join(layers)
+    cache = search_cache.stats()
+    patch, full = modify_tokens["patch"], modify_tokens["full"]
+    
     text = f"""🎸 ÖNIKA LI 运营助理状态
 ━━━━━━━━━━━━━━
 ✅ Brave Search - 自动上网
-✅ Claude 3.5 - 主要AI
-✅ DeepSeek R1 - 免费备用
-✅ Groq Llama - 极速备用
+{layers}
 ✅ Whisper - 语音识别
 
+🧭 路由排序
+{ranking_line("write")}
+{ranking_line("batch")}
+
 🔑 OpenRouter Key: {'✅' if OPENROUTER_KEY else '❌'}
 🔑 Groq Key: {'✅' if GROQ_KEY else '❌'}
 
+✏️ 修改：增量 {patch['rounds']} 次（输入 {patch['prompt']} / 输出 {patch['completion']} tokens），整篇 {full['rounds']} 次（输入 {full['prompt']} / 输出 {full['completion']} tokens）
+🗂️ 搜索缓存：命中 {cache['hits']} / 未命中 {cache['misses']}（{cache['size']} 条，命中率 {cache['hit_rate']:.0%}）
+
 💾 工作目录：{WORK_DIR}"""
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理文字消息"""
@@ -420,14 +836,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # 修改意图检测
     modify_keywords = ['太长', '太短', '加', '改', '换', '优化', '调整', '不够', '要', '不要', '删除', '增加', '减少']
-    if user_id in user_data and any(kw in text for kw in modify_keywords):
+    if any(kw in text for kw in modify_keywords) and await sessions.aget(user_id) is not None:
         context.args = text.split()
         await modify_cmd(update, context)
         return
     
     # 定稿/发布
     if '定稿' in text or '发布' in text:
-        await update.message.reply_text("""📋 定稿功能开发中...
+        await outbox.reply(update.message, """📋 定稿功能开发中...
 
 当前：
 ✅ 文案生成
@@ -445,7 +861,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # 其他情况：帮助提示
-    await update.message.reply_text("""💡 发送主题直接写文案，例如：
+    await outbox.reply(update.message, """💡 发送主题直接写文案，例如：
 - "noname乐队2026巡演"
 - "AI音乐演出趋势"
 - "LiveGigs Asia宣传"
@@ -455,25 +871,120 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理语音"""
     if not GROQ_KEY:
-        await update.message.reply_text("🎤 语音识别未配置")
+        await outbox.reply(update.message, "🎤 语音识别未配置")
         return
     
     await update.message.chat.send_action(action="typing")
     voice = update.message.voice
-    file = await context.bot.get_file(voice.file_id)
     
-    text, error = await transcribe_voice(file.file_path)
+    # 转发/重发的语音 file_unique_id 相同，直接用缓存，连 getFile 都省掉
+    text = await transcript_cache.aget(voice.file_unique_id)
+    error = None
+    if text is None:
+        file = await context.bot.get_file(voice.file_id)
+        text, error = await transcribe_voice(file.file_path, voice.file_unique_id)
     if error:
-        await update.message.reply_text(f"⚠️ {error}")
+        await outbox.reply(update.message, f"⚠️ {error}")
         return
     
-    await update.message.reply_text(f"🎤 识别：{text}")
+    await outbox.reply(update.message, f"🎤 识别：{text}")
     
     # 作为文字处理
     update.message.text = text
     await handle_text(update, context)
 
+async def on_startup(app: Application):
+    """启动时预建连接池"""
+    global metrics_runner
+    await http_pool.start([BRAVE_URL, OPENROUTER_URL, GROQ_URL])
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_PORT)
+    await sessions.start()
+    await drafts.start()
+    
+    # 上次进程中断时还有主题未处理的批次：提醒发起人继续
+    for journal in unfinished(BATCH_DIR):
+        if len(journal.results) == journal.total:
+            continue
+        chat_id = journal.info.get("chat_id")
+        logger.info(f"📦 未完成的批次 {journal.id}: {journal.done}/{journal.total}")
+        if chat_id and journal.owner is not None:
+            try:
+                await outbox.send(
+                    app.bot, chat_id, f"📦 批次 {journal.id} 上次未完成（{journal.done}/{journal.total}），发送 /batch resume 继续"
+                )
+            except Exception as e:
+                logger.warning(f"批次提醒发送失败: {e}")
+    
+    # 后台试探已熔断的层
+    probes = {}
+    if OPENROUTER_KEY:
+        probes["L2_DeepSeek"] = lambda: probe_openrouter(BOT_LAYERS["L2_DeepSeek"][0])
+        probes["L4_Claude"] = lambda: probe_openrouter(BOT_LAYERS["L4_Claude"][0])
+    if GROQ_KEY:
+        probes["L3_Groq"] = probe_groq
+    router.start_probing(probes)
+
+async def on_shutdown(app: Application):
+    """退出时关闭连接池"""
+    await router.stop_probing()
+    await http_pool.close()
+    await articles.close()
+    search_cache.close()
+    transcript_cache.close()
+    articles.cache.close()
+    await sessions.close()
+    await drafts.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def batch_cli(path=None, resume=None, concurrency=None):
+    """命令行批量生成：主题文件每行一个；resume 为批次ID或 "latest" 时从日志继续"""
+    if resume:
+        if resume == "latest":
+            pending = unfinished(BATCH_DIR)
+            if not pending:
+                print("没有未完成的批次")
+                return 0
+            journal = pending[0]
+        else:
+            journal = BatchJournal.open(os.path.join(BATCH_DIR, f"{resume}.jsonl"))
+    else:
+        with open(path, encoding='utf-8') as f:
+            topics = parse_topics(f.read(), limit=10 ** 6)
+        journal = BatchJournal.create(BATCH_DIR, topics)
+    
+    def on_progress(journal, entry):
+        icon = "✅" if entry["status"] == "ok" else "❌"
+        detail = entry["path"] if entry["status"] == "ok" else entry["error"]
+        print(f"[{journal.done + journal.failed}/{journal.total}] {icon} {entry['topic']} - {detail}", flush=True)
+    
+    print(f"📦 批次 {journal.id}：{len(journal.pending())}/{journal.total} 个主题待处理（日志 {journal.path}）")
+    started = time.monotonic()
+    await http_pool.start([BRAVE_URL, OPENROUTER_URL, GROQ_URL])
+    try:
+        await run_batch(journal, lambda topic: write_batch_item(topic, folder=os.path.join("批量", journal.id)),
+                        concurrency=concurrency or BATCH_CONCURRENCY, on_progress=on_progress)
+    finally:
+        await http_pool.close()
+        await articles.close()
+        search_cache.close()
+        transcript_cache.close()
+        articles.cache.close()
+    print(f"完成 {journal.done}/{journal.total}，失败 {journal.failed}，用时 {time.monotonic() - started:.0f}s")
+    if not journal.finished:
+        print(f"继续：python bot/onikali_bot.py --resume {journal.id}")
+    return 0 if journal.finished else 1
+
 def main():
+    parser = argparse.ArgumentParser(description="ÖNIKA LI 运营助理")
+    parser.add_argument("--batch", metavar="FILE", help="批量生成：主题文件，每行一个主题")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="BATCH_ID", help="继续未完成的批次（默认最近一个）")
+    parser.add_argument("--concurrency", type=int, help="同时处理的主题数")
+    args = parser.parse_args()
+    if args.batch or args.resume:
+        sys.exit(asyncio.run(batch_cli(args.batch, args.resume, args.concurrency)))
+    
     if not TOKEN:
         logger.error("TOKEN未设置")
         return
@@ -483,7 +994,14 @@ def main():
     logger.info(f"🔑 Groq: {'已配置' if GROQ_KEY else '未配置'}")
     logger.info(f"💾 工作目录: {WORK_DIR}")
     
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(ChatScheduler())  # 不同会话并发、同一会话按顺序，/start /status /help 走快速通道
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("search", search_cmd))
@@ -491,6 +1009,8 @@ def main():
     app.add_handler(CommandHandler("modify", modify_cmd))
     app.add_handler(CommandHandler("save", save_cmd))
     app.add_handler(CommandHandler("status", status_cmd))
+    app.add_handler(CommandHandler("drafts", drafts_cmd))
+    app.add_handler(CommandHandler("batch", batch_cmd))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
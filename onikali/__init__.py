@@ -0,0 +1,4 @@
+"""
+ÖNIKA LI 共享组件
+bot/onikali_bot.py 与 api/index.py 共用的基础设施
+"""
@@ -0,0 +1,293 @@
+"""
+ÖNIKA LI 原文抓取
+并发抓取搜索结果前几条的网页，按域名限制并发、整体限时；提取正文后按 URL 和内容哈希缓存，
+过期后用 ETag / Last-Modified 条件请求验证，未改动时不再下载和解析
+"""
+
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from onikali import metrics
+from onikali.cache import TTLCache
+from onikali.prompts import relevance
+from onikali.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# 每次写作抓取前几条结果；0 表示关闭，只用搜索摘要
+ARTICLE_TOP_K = int(os.getenv('ARTICLE_TOP_K', '3'))
+# 整个抓取阶段的时限（秒）：各条并发，超时未完成的不等待，最多增加一次往返的延迟
+ARTICLE_TIMEOUT = float(os.getenv('ARTICLE_TIMEOUT', '3'))
+ARTICLE_PER_DOMAIN = int(os.getenv('ARTICLE_PER_DOMAIN', '2'))
+ARTICLE_MAX_BYTES = int(os.getenv('ARTICLE_MAX_BYTES', str(1024 * 1024)))
+# 缓存的正文字数上限、放入提示词的段落字数
+ARTICLE_MAX_CHARS = int(os.getenv('ARTICLE_MAX_CHARS', '6000'))
+ARTICLE_EXCERPT_CHARS = int(os.getenv('ARTICLE_EXCERPT_CHARS', '600'))
+# 正文在该时间内直接使用；过期后保留 ARTICLE_CACHE_KEEP 秒，用于条件请求验证
+ARTICLE_CACHE_TTL = float(os.getenv('ARTICLE_CACHE_TTL', '21600'))
+ARTICLE_CACHE_KEEP = float(os.getenv('ARTICLE_CACHE_KEEP', '604800'))
+ARTICLE_CACHE_SIZE = int(os.getenv('ARTICLE_CACHE_SIZE', '512'))
+
+USER_AGENT = "Mozilla/5.0 (compatible; OnikaLiBot/1.0; +https://t.me/onikali_bot)"
+DNS_CACHE_TTL = 300
+# 少于该字数的文本块视为导航、按钮、版权之类，不算正文
+MIN_PARAGRAPH = 20
+
+ARTICLE_FETCHES = metrics.REGISTRY.counter(
+    "onikali_article_fetches_total", "原文抓取结果", ["result"])
+
+_SKIP_TAGS = {'script', 'style', 'noscript', 'template', 'nav', 'footer', 'header', 'aside', 'form',
+              'iframe', 'svg', 'button', 'select', 'figcaption'}
+_MAIN_TAGS = {'article', 'main'}
+_BLOCK_TAGS = {'p', 'div', 'section', 'article', 'main', 'br', 'li', 'ul', 'ol', 'table', 'tr', 'td',
+               'blockquote', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+_SPACES = re.compile(r'\s+')
+_META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+_DIGITS = re.compile(r'\d')
+
+
+class _TextExtractor(HTMLParser):
+    """按块级标签切出文本块，记录是否位于 <article>/<main> 内，跳过脚本、导航、页脚等"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.description = ""
+        self._parts = []
+        self._skip = 0
+        self._main = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._flush()
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag in _MAIN_TAGS:
+            self._main += 1
+        elif tag == 'meta' and not self.description:
+            values = dict(attrs)
+            if values.get('name') == 'description' or values.get('property') == 'og:description':
+                self.description = _SPACES.sub(' ', values.get('content') or '').strip()
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCK_TAGS:
+            self._flush()
+        if tag in _SKIP_TAGS and self._skip:
+            self._skip -= 1
+        elif tag in _MAIN_TAGS and self._main:
+            self._main -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._parts.append(data)
+
+    def _flush(self):
+        text = _SPACES.sub(' ', ''.join(self._parts)).strip()
+        self._parts = []
+        if text:
+            self.blocks.append((text, self._main > 0))
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def extract_text(html: str, max_chars: int = ARTICLE_MAX_CHARS) -> str:
+    """网页正文：优先取 <article>/<main> 内的段落，没有时取全页足够长的文本块；都没有时退回 meta 描述"""
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        logger.debug(f"网页解析中断: {e}")
+    main = [text for text, in_main in parser.blocks if in_main]
+    blocks = main if sum(len(t) for t in main) >= MIN_PARAGRAPH * 5 else [text for text, _ in parser.blocks]
+    paragraphs, seen = [], set()
+    for text in blocks:
+        if len(text) < MIN_PARAGRAPH or text in seen:
+            continue
+        seen.add(text)
+        paragraphs.append(text)
+    body = "\n\n".join(paragraphs)[:max_chars]
+    return body or parser.description
+
+
+def decode_html(raw: bytes, charset: Optional[str] = None) -> str:
+    """按响应头或 <meta charset> 解码；GB2312/GBK 按其超集 GB18030 处理"""
+    if not charset:
+        match = _META_CHARSET.search(raw[:4096])
+        charset = match.group(1).decode('ascii', 'ignore') if match else 'utf-8'
+    charset = charset.lower()
+    if charset in ('gb2312', 'gbk'):
+        charset = 'gb18030'
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def excerpt(body: str, topic: str, limit: int = ARTICLE_EXCERPT_CHARS) -> str:
+    """从正文中挑与主题最相关、带数字（日期、票价、场次）的段落，按原文顺序拼到 limit 字以内"""
+    paragraphs = [p for p in body.split("\n\n") if p.strip()]
+    ranked = sorted(
+        range(len(paragraphs)),
+        key=lambda i: (-(relevance(topic, {'description': paragraphs[i]}) + (0.2 if _DIGITS.search(paragraphs[i]) else 0)), i)
+    )
+    chosen, size = {}, 0
+    for i in ranked:
+        if size + len(paragraphs[i]) > limit:
+            if not chosen:
+                chosen[i] = paragraphs[i][:limit]
+                size = limit
+            continue
+        chosen[i] = paragraphs[i]
+        size += len(paragraphs[i])
+    return "\n".join(chosen[i] for i in sorted(chosen))
+
+
+def _domain(url: str) -> str:
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+class ArticleFetcher:
+    """搜索结果的原文抓取
+
+    缓存两层：url:<地址> 记录内容哈希和 ETag/Last-Modified，body:<哈希> 保存提取后的正文，
+    不同地址的相同内容只解析一次。新鲜期内直接用缓存；过期后带验证头请求，304 时沿用原正文。
+    同一地址的并发请求合并，同一域名同时最多 per_domain 个请求。
+    """
+
+    def __init__(self, cache: Optional[TTLCache] = None, proxy: Optional[str] = None,
+                 per_domain: int = ARTICLE_PER_DOMAIN, timeout: float = ARTICLE_TIMEOUT, ssl: bool = False):
+        self.cache = cache if cache is not None else TTLCache(ARTICLE_CACHE_SIZE, ARTICLE_CACHE_TTL,
+                                                              grace=ARTICLE_CACHE_KEEP)
+        self.proxy = proxy
+        self.per_domain = per_domain
+        self.timeout = timeout
+        self.ssl = ssl
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._domains: Dict[str, list] = {}
+        self._flight = SingleFlight("article")
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            # 目标站点各不相同，共用一个会话；每个域名的并发由 _domain_slot 控制
+            connector = aiohttp.TCPConnector(ssl=self.ssl, limit=100, ttl_dns_cache=DNS_CACHE_TTL)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"User-Agent": USER_AGENT, "Accept": "text/html,application/xhtml+xml",
+                         "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.6"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @asynccontextmanager
+    async def _domain_slot(self, url: str):
+        domain = _domain(url)
+        slot = self._domains.get(domain)
+        if slot is None:
+            slot = self._domains[domain] = [asyncio.Semaphore(max(1, self.per_domain)), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._domains[domain]
+
+    async def _body(self, meta: Optional[dict]) -> Optional[str]:
+        return await self.cache.aget(f"body:{meta['hash']}") if meta else None
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """返回 url 的正文（可能来自缓存）；抓取失败时返回缓存中的旧正文或 None"""
+        entry = await self.cache.aget_entry(f"url:{url}")
+        meta = entry[0] if entry else None
+        if meta is not None and entry[1] >= time.time():
+            body = await self._body(meta)
+            if body is not None:
+                ARTICLE_FETCHES.inc(result="cached")
+                return body
+        return await self._flight.do(url, lambda _: self._fetch(url, meta))
+
+    async def _fetch(self, url: str, meta: Optional[dict]) -> Optional[str]:
+        cached = await self._body(meta)
+        headers = {}
+        # 正文还在才能做条件请求，否则 304 之后无内容可用
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            async with self._domain_slot(url), metrics.track("articles", "fetch") as call:
+                async with self.session().get(url, headers=headers, proxy=self.proxy,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+                    if resp.status == 304 and cached is not None:
+                        self.cache.set(f"url:{url}", meta)
+                        self.cache.set(f"body:{meta['hash']}", cached, ARTICLE_CACHE_TTL + ARTICLE_CACHE_KEEP)
+                        ARTICLE_FETCHES.inc(result="not_modified")
+                        return cached
+                    if resp.status != 200 or 'html' not in resp.headers.get('Content-Type', 'text/html'):
+                        call.status = "error" if resp.status != 200 else "skipped"
+                        ARTICLE_FETCHES.inc(result=call.status)
+                        return cached
+                    chunks, size = [], 0
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size >= ARTICLE_MAX_BYTES:
+                            break
+                    raw = b"".join(chunks)[:ARTICLE_MAX_BYTES]
+                    validators = {"etag": resp.headers.get('ETag'), "last_modified": resp.headers.get('Last-Modified')}
+                    charset = resp.charset
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.debug(f"原文抓取失败 {url}: {e}")
+            ARTICLE_FETCHES.inc(result=metrics.failure_reason(e))
+            return cached
+
+        digest = hashlib.sha256(raw).hexdigest()[:32]
+        body = await self.cache.aget(f"body:{digest}")
+        if body is None:
+            # 解析几百 KB 的 HTML 要几十毫秒，放到线程里不阻塞事件循环
+            body = await asyncio.to_thread(extract_text, decode_html(raw, charset))
+            ARTICLE_FETCHES.inc(result="extracted")
+        else:
+            ARTICLE_FETCHES.inc(result="same_content")
+        self.cache.set(f"body:{digest}", body, ARTICLE_CACHE_TTL + ARTICLE_CACHE_KEEP)
+        self.cache.set(f"url:{url}", dict(validators, hash=digest))
+        return body or None
+
+    async def enrich(self, topic: str, results: Optional[List[dict]], top_k: int = ARTICLE_TOP_K) -> Optional[List[dict]]:
+        """并发抓取前 top_k 条结果的原文，时限内拿到的加上 body（与主题最相关的段落），其余保持原样"""
+        if not results or top_k <= 0:
+            return results
+        targets = {r['url'] for r in results[:top_k] if (r.get('url') or '').startswith(('http://', 'https://'))}
+        if not targets:
+            return results
+        tasks = {asyncio.ensure_future(self.fetch(url)): url for url in targets}
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            ARTICLE_FETCHES.inc(len(pending), result="deadline")
+        bodies = {}
+        for task in done:
+            if task.exception() is None and task.result():
+                bodies[tasks[task]] = task.result()
+        return [dict(r, body=excerpt(bodies[r['url']], topic)) if r.get('url') in bodies else r for r in results]
@@ -0,0 +1,210 @@
+"""
+ÖNIKA LI 批量生成
+一批主题并发处理，按服务商限制同时进行的请求数；进度逐条写入日志文件，进程中断后从断点继续
+"""
+
+import os
+import re
+import json
+import uuid
+import asyncio
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from onikali import metrics
+from onikali.router import load_config
+
+logger = logging.getLogger(__name__)
+
+_batch_config = (load_config().get('workflows') or {}).get('batch') or {}
+# 同时处理的主题数；真正的上游并发由各服务商的上限控制
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', str(_batch_config.get('concurrency', 8))))
+BATCH_MAX_TOPICS = int(os.getenv('BATCH_MAX_TOPICS', str(_batch_config.get('max_topics', 50))))
+PROVIDER_CAPS: Dict[str, int] = {
+    str(k): int(v) for k, v in (_batch_config.get('provider_concurrency') or {}).items()
+}
+
+BATCH_ITEMS = metrics.REGISTRY.counter(
+    "onikali_batch_items_total", "批量生成处理的主题数", ["status"])
+
+_TOPIC_SPLIT = re.compile(r'[\n;；]+')
+
+# 当前任务所属批次的服务商并发上限；不在批量任务中时为 None，不做限制
+_slots: contextvars.ContextVar = contextvars.ContextVar('batch_slots', default=None)
+
+
+def parse_topics(text: str, limit: int = BATCH_MAX_TOPICS) -> List[str]:
+    """按换行或分号拆分主题，去掉空行、# 注释和重复项"""
+    topics, seen = [], set()
+    for part in _TOPIC_SPLIT.split(text or ''):
+        topic = part.strip()
+        if not topic or topic.startswith('#') or topic in seen:
+            continue
+        seen.add(topic)
+        topics.append(topic)
+    return topics[:limit]
+
+
+@asynccontextmanager
+async def provider_slot(provider: str):
+    """批量任务中占用该服务商的一个并发位；普通请求直接通过"""
+    slots = _slots.get()
+    semaphore = slots.get(provider) if slots else None
+    if semaphore is None:
+        yield
+        return
+    async with semaphore:
+        yield
+
+
+class BatchJournal:
+    """批次日志（JSONL）
+
+    首行记录批次信息和主题列表，之后每处理完一个主题追加一行并 fsync（在线程中进行，不阻塞事件循环）；
+    重新打开时以每个主题的最后一条记录为准，成功的不再重做，失败的重试。
+    """
+
+    def __init__(self, path: str, info: dict, results: Optional[Dict[int, dict]] = None):
+        self.path = path
+        self.info = info
+        self.results: Dict[int, dict] = results or {}
+        # 并发完成的主题按顺序逐行追加
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def create(cls, root: str, topics: List[str], owner=None, chat_id=None) -> 'BatchJournal':
+        os.makedirs(root, exist_ok=True)
+        now = datetime.now()
+        batch_id = f"{now.strftime('%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        info = {"type": "batch", "id": batch_id, "owner": owner, "chat_id": chat_id,
+                "topics": topics, "created": now.isoformat(timespec='seconds')}
+        journal = cls(os.path.join(root, f"{batch_id}.jsonl"), info)
+        journal._append(info)
+        return journal
+
+    @classmethod
+    def open(cls, path: str) -> 'BatchJournal':
+        info, results = None, {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的最后一行
+                    continue
+                if entry.get("type") == "batch":
+                    info = entry
+                elif "index" in entry:
+                    results[entry["index"]] = entry
+        if info is None:
+            raise ValueError(f"不是批次日志: {path}")
+        return cls(path, info, results)
+
+    @property
+    def id(self) -> str:
+        return self.info["id"]
+
+    @property
+    def topics(self) -> List[str]:
+        return self.info["topics"]
+
+    @property
+    def owner(self):
+        return self.info.get("owner")
+
+    @property
+    def total(self) -> int:
+        return len(self.topics)
+
+    @property
+    def done(self) -> int:
+        return sum(1 for r in self.results.values() if r.get("status") == "ok")
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for r in self.results.values() if r.get("status") != "ok")
+
+    @property
+    def finished(self) -> bool:
+        return self.done == self.total
+
+    def pending(self) -> List[Tuple[int, str]]:
+        return [(i, t) for i, t in enumerate(self.topics) if self.results.get(i, {}).get("status") != "ok"]
+
+    async def record(self, index: int, path: Optional[str] = None, layer: Optional[str] = None,
+                     error: Optional[str] = None) -> dict:
+        entry = {"index": index, "topic": self.topics[index], "status": "ok" if path else "failed",
+                 "path": path, "layer": layer, "error": error,
+                 "timestamp": datetime.now().isoformat(timespec='seconds')}
+        async with self._lock:
+            await asyncio.to_thread(self._append, entry)
+        self.results[index] = entry
+        return entry
+
+    def _append(self, entry: dict):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def unfinished(root: str, owner=None) -> List[BatchJournal]:
+    """root 下未完成的批次（新到旧）；owner 不为 None 时只返回该用户的"""
+    journals = []
+    try:
+        names = sorted(os.listdir(root), reverse=True)
+    except FileNotFoundError:
+        return journals
+    for name in names:
+        if not name.endswith('.jsonl'):
+            continue
+        try:
+            journal = BatchJournal.open(os.path.join(root, name))
+        except (OSError, ValueError) as e:
+            logger.warning(f"批次日志读取失败 {name}: {e}")
+            continue
+        if not journal.finished and (owner is None or journal.owner == owner):
+            journals.append(journal)
+    return journals
+
+
+async def run_batch(journal: BatchJournal,
+                    process: Callable[[str], Awaitable[Tuple[Optional[str], Optional[str], Optional[str]]]],
+                    concurrency: int = BATCH_CONCURRENCY, caps: Optional[Dict[str, int]] = None,
+                    on_progress: Optional[Callable[[BatchJournal, dict], None]] = None) -> BatchJournal:
+    """并发处理 journal 中未成功的主题
+
+    process(topic) 返回 (保存路径, 层名, 错误)；caps 为 服务商 -> 同时请求数，
+    由 process 内部经 provider_slot() 占用。每个主题处理完立即写入日志并回调 on_progress。
+    """
+    gate = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(index: int, topic: str):
+        async with gate:
+            try:
+                path, layer, error = await process(topic)
+            except Exception as e:
+                logger.error(f"批量生成失败 [{topic}]: {e}")
+                path, layer, error = None, None, str(e)[:100]
+            entry = await journal.record(index, path, layer, None if path else (error or "生成失败"))
+            BATCH_ITEMS.inc(status=entry["status"])
+            if on_progress:
+                on_progress(journal, entry)
+
+    caps = PROVIDER_CAPS if caps is None else caps
+    # 子任务创建时复制当前上下文，批次的并发上限只对本批次的请求生效
+    token = _slots.set({provider: asyncio.Semaphore(max(1, n)) for provider, n in caps.items()})
+    try:
+        tasks = [asyncio.ensure_future(one(index, topic)) for index, topic in journal.pending()]
+    finally:
+        _slots.reset(token)
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    return journal
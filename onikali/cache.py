@@ -0,0 +1,211 @@
+"""
+ÖNIKA LI 缓存
+内存 LRU + TTL，可选共享层（SQLite 文件或 onikali.state 的后端，重启后和多个实例间仍然有效）
+"""
+
+import re
+import json
+import time
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+from onikali.state import SQLiteBackend, StateBackend, StateError
+
+logger = logging.getLogger(__name__)
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_query(query: str) -> str:
+    """查询归一化：全角转半角、大小写折叠、合并空白"""
+    text = unicodedata.normalize('NFKC', query or '').casefold()
+    return _SPACES.sub(' ', text).strip()
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存
+
+    内存层超过 maxsize 时淘汰最久未使用的条目；
+    提供 path 时同时写入该 SQLite 文件，提供 backend 时写入共享后端，内存未命中时从中读取。
+    grace 为过期后在共享层多保留的秒数，供调用方读取过期条目（先返回旧结果再刷新）。
+    事件循环中用 aget()/aget_entry()，共享层的读取不阻塞事件循环；写入和删除都不等待共享层。
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600, path: Optional[str] = None,
+                 table: str = 'cache', backend: Optional[StateBackend] = None, grace: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._store = backend
+        if self._store is None and path:
+            try:
+                self._store = SQLiteBackend(path, table)
+            except StateError as e:
+                logger.warning(f"磁盘缓存不可用 {path}: {e}")
+
+    def _entry(self, row):
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1] - self.grace
+
+    def _load(self, key: str):
+        if self._store is None:
+            return None
+        try:
+            return self._entry(self._store.get(key))
+        except StateError as e:
+            logger.warning(f"共享缓存读取失败: {e}")
+            return None
+
+    async def _aload(self, key: str):
+        try:
+            return self._entry(await self._store.aget(key))
+        except StateError as e:
+            logger.warning(f"共享缓存读取失败: {e}")
+            return None
+
+    def _cached(self, key: str):
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def _loaded(self, key: str, entry):
+        if entry is not None and key not in self._data:
+            self._remember(key, entry)
+        return self._data.get(key, entry)
+
+    def get_entry(self, key: str):
+        """返回 (值, 过期时间戳)，过期条目也会返回，由调用方决定是否使用（阻塞读取共享层）"""
+        entry = self._cached(key)
+        if entry is None:
+            entry = self._loaded(key, self._load(key))
+        return entry
+
+    async def aget_entry(self, key: str):
+        """同 get_entry，不阻塞事件循环"""
+        entry = self._cached(key)
+        if entry is None and self._store is not None:
+            # 等待期间可能已有新的 set()，以内存中的为准
+            entry = self._loaded(key, await self._aload(key))
+        return entry
+
+    def _count(self, entry, default: Any) -> Any:
+        if entry is None or entry[1] < time.time():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._count(self.get_entry(key), default)
+
+    async def aget(self, key: str, default: Any = None) -> Any:
+        return self._count(await self.aget_entry(key), default)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, (value, expires))
+        if self._store is not None:
+            try:
+                self._store.set_nowait(key, json.dumps(value, ensure_ascii=False), expires + self.grace - time.time())
+            except (TypeError, ValueError) as e:
+                logger.warning(f"共享缓存写入失败: {e}")
+
+    def _remember(self, key: str, entry: tuple):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+        if self._store is not None:
+            self._store.delete_nowait(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+class DedupeWindow:
+    """去重窗口：记住最近 ttl 秒内见过的键，最多 maxsize 个
+
+    提供 backend 时用 claim() 在共享后端中登记，多个实例收到同一个键时只有一个返回 True；
+    本实例已见过的键直接在内存中判断，不访问后端；后端不可用时退回本地窗口。
+    """
+
+    def __init__(self, ttl: float = 600, maxsize: int = 10000, backend: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.backend = backend
+        self._seen: "OrderedDict[Any, float]" = OrderedDict()
+
+    def _expire(self, now: float):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        """只看本地窗口"""
+        seen_at = self._seen.get(key)
+        return seen_at is not None and time.time() - seen_at < self.ttl
+
+    def _remember(self, key, now: float):
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        self._expire(now)
+
+    def add(self, key) -> bool:
+        """在本地窗口登记一个键，返回是否首次出现；共享后端只写入不等待"""
+        now = time.time()
+        new = key not in self
+        self._remember(key, now)
+        if new and self.backend is not None:
+            self.backend.set_nowait(str(key), "1", self.ttl)
+        return new
+
+    async def claim(self, key) -> bool:
+        """登记一个键，多个实例同时登记时只有一个返回 True"""
+        if key in self:
+            return False
+        now = time.time()
+        # 先占住本地窗口，等待后端期间同一实例的重复请求直接判为重复
+        self._remember(key, now)
+        if self.backend is None:
+            return True
+        try:
+            return await self.backend.aadd(str(key), "1", self.ttl)
+        except StateError as e:
+            logger.warning(f"共享去重窗口写入失败，按本地窗口处理: {e}")
+            return True
+
+    def discard(self, key):
+        """撤销登记（如入队失败，需要让重投的更新被接受）"""
+        self._seen.pop(key, None)
+        if self.backend is not None:
+            self.backend.delete_nowait(str(key))
+
+    def __len__(self):
+        return len(self._seen)
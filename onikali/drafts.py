@@ -0,0 +1,194 @@
+"""
+ÖNIKA LI 文案落盘
+异步写入队列：批量写文件、批量 fsync，并维护 manifest.jsonl 索引
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.jsonl"
+# 内存中只保留最近的索引条目，更早的在需要时从 manifest 读取
+INDEX_SIZE = int(os.getenv('DRAFT_INDEX_SIZE', '1000'))
+
+
+def safe_name(filename: str) -> str:
+    return "".join([c for c in filename if c.isalpha() or c.isdigit() or c in (' ', '-', '_')]).rstrip()[:30]
+
+
+class DraftWriter:
+    """文案写入器
+
+    save() 立即返回不会重名的文件路径，实际写盘由后台任务完成：
+    每批最多 batch_size 个文件，全部写完后统一 fsync，再追加 manifest。
+    内存索引只保留最近 index_size 条，更早的条目在列表不够时从 manifest 读取。
+    """
+
+    def __init__(self, root: str, max_queue: int = 256, batch_size: int = 32, index_size: int = INDEX_SIZE):
+        self.root = root
+        self.batch_size = batch_size
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self.index: deque = deque(maxlen=index_size)
+        # manifest 中是否有不在内存索引里的更早条目
+        self._truncated = False
+        for entry in self._read_manifest():
+            self._truncated = self._truncated or len(self.index) == index_size
+            self.index.append(entry)
+
+    def _read_manifest(self) -> Iterable[dict]:
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def path_for(self, filename: str, folder: str, now: datetime) -> str:
+        """时间精确到秒，并附加随机后缀，同一分钟内同主题不会互相覆盖"""
+        name = f"{safe_name(filename)}_{now.strftime('%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.txt"
+        return os.path.join(self.root, folder, name)
+
+    async def save(self, filename: str, content: str, folder: str = "文案",
+                   user_id=None, model: Optional[str] = None, wait: bool = False) -> str:
+        """wait=True 时写盘并 fsync 后才返回（批量任务据此记录断点）"""
+        now = datetime.now()
+        filepath = self.path_for(filename, folder, now)
+        body = f"# {filename}\n# 生成时间: {now.strftime('%Y-%m-%d %H:%M:%S')}\n\n{content}".encode('utf-8')
+        entry = {
+            "path": filepath,
+            "folder": folder,
+            "topic": filename,
+            "user": user_id,
+            "model": model,
+            "timestamp": now.isoformat(timespec='seconds'),
+            "bytes": len(body),
+        }
+        if self._task is None or wait:
+            # 后台任务未启动（如命令行模式）或需要确认落盘时直接在线程中写入
+            failed = await asyncio.to_thread(self._write_batch, [(entry, body)])
+            if failed:
+                raise failed[0][1]
+        else:
+            await self._queue.put((entry, body))
+        return filepath
+
+    def _write_batch(self, batch) -> List[tuple]:
+        """写入一批文案，返回失败的 (entry, 异常)；只有写入并 fsync 成功的文件才记入 manifest"""
+        opened, failed = [], []
+        try:
+            for entry, body in batch:
+                f = None
+                try:
+                    os.makedirs(os.path.dirname(entry["path"]), exist_ok=True)
+                    f = open(entry["path"], 'wb')
+                    opened.append((entry, f))
+                    f.write(body)
+                except OSError as e:
+                    failed.append((entry, e))
+                    if f is not None:
+                        opened.pop()
+                        f.close()
+            # 一批文件写完后统一 fsync
+            written = []
+            for entry, f in opened:
+                try:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    written.append(entry)
+                except OSError as e:
+                    failed.append((entry, e))
+        finally:
+            for _, f in opened:
+                f.close()
+        if written:
+            with open(self.manifest_path, 'a', encoding='utf-8') as m:
+                for entry in written:
+                    m.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                m.flush()
+                os.fsync(m.fileno())
+            self._truncated = self._truncated or len(self.index) + len(written) > self.index.maxlen
+            self.index.extend(written)
+        return failed
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                failed = await asyncio.to_thread(self._write_batch, batch)
+                for entry, e in failed:
+                    logger.error(f"文案写入失败 {entry['path']}: {e}")
+            except Exception as e:
+                # manifest 写入失败等：记录后继续处理后面的批次，不让后台任务退出
+                logger.error(f"文案写入失败 ({len(batch)} 个): {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """写完队列中剩余的文案后停止"""
+        if self._task is None:
+            return
+        # 后台任务已退出时队列不会再被处理，不能一直等 join()
+        join = asyncio.ensure_future(self._queue.join())
+        await asyncio.wait({join, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        if not join.done():
+            join.cancel()
+            logger.error(f"文案写入任务已退出，{self._queue.qsize()} 个文案未写入")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"文案写入任务异常退出: {e}")
+        self._task = None
+
+    @staticmethod
+    def _match(entries: Iterable[dict], user_id, folder: Optional[str]) -> Iterable[dict]:
+        for entry in entries:
+            if user_id is not None and entry.get("user") != user_id:
+                continue
+            if folder is not None and entry.get("folder") != folder:
+                continue
+            yield entry
+
+    def _scan(self, user_id, folder: Optional[str], limit: int) -> List[dict]:
+        """从 manifest 读取最近 limit 条匹配的条目（新到旧）"""
+        return list(reversed(deque(self._match(self._read_manifest(), user_id, folder), maxlen=limit)))
+
+    def _recent(self, user_id, folder: Optional[str], limit: int):
+        """从内存索引取匹配的条目，返回 (条目, 是否已完整)"""
+        result = []
+        for entry in self._match(reversed(self.index), user_id, folder):
+            result.append(entry)
+            if len(result) >= limit:
+                return result, True
+        return result, not self._truncated
+
+    def list(self, user_id=None, folder: Optional[str] = None, limit: int = 10) -> List[dict]:
+        """从索引列出最近的文案（新到旧），不扫描目录；内存索引中不够时读取 manifest"""
+        result, complete = self._recent(user_id, folder, limit)
+        return result if complete else self._scan(user_id, folder, limit)
+
+    async def alist(self, user_id=None, folder: Optional[str] = None, limit: int = 10) -> List[dict]:
+        """同 list()，读取 manifest 时在线程中进行"""
+        result, complete = self._recent(user_id, folder, limit)
+        return result if complete else await asyncio.to_thread(self._scan, user_id, folder, limit)
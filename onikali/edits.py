@@ -0,0 +1,76 @@
+"""
+ÖNIKA LI 增量修改
+文案按段落编号，模型只返回需要改动的段落，在本地应用
+"""
+
+import re
+import json
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+_JSON_OBJECT = re.compile(r'\{.*\}', re.S)
+
+# 涉及全文的修改要求直接整篇重写，省去一次增量尝试
+GLOBAL_EDIT_KEYWORDS = ['口语化', '风格', '重写', '全文', '整体', '整篇', '翻译', '缩短', '精简', '扩写', '语气', '字以内', '字左右']
+
+EDIT_FORMAT = """只输出JSON，不要输出其他文字：
+{"edits": [{"op": "replace", "index": 段落编号, "text": "新段落"}, {"op": "insert_after", "index": 段落编号（0表示开头）, "text": "新段落"}, {"op": "delete", "index": 段落编号}]}
+如果修改要求需要改动大部分段落，只输出 {"full": true}"""
+
+
+def is_global_edit(modification: str) -> bool:
+    return any(kw in modification for kw in GLOBAL_EDIT_KEYWORDS)
+
+
+def split_sections(content: str) -> List[str]:
+    return [p.strip() for p in _PARAGRAPH_BREAK.split(content.strip()) if p.strip()]
+
+
+def join_sections(sections: List[str]) -> str:
+    return "\n\n".join(sections)
+
+
+def numbered(sections: List[str]) -> str:
+    return "\n\n".join(f"[{i}] {s}" for i, s in enumerate(sections, 1))
+
+
+def parse_edits(text: str) -> Optional[dict]:
+    """从模型输出中取出JSON对象（允许带```代码块），解析失败返回 None"""
+    match = _JSON_OBJECT.search(text or '')
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def apply_edits(sections: List[str], edits) -> Optional[List[str]]:
+    """应用段落修改，编号越界或格式不对时返回 None（调用方改为整篇重写）"""
+    if not isinstance(edits, list) or not edits:
+        return None
+    result = list(sections)
+    count = len(sections)
+    # 从后往前应用，前面段落的编号不受影响；同一编号先插入再替换/删除
+    try:
+        ordered = sorted(edits, key=lambda e: (int(e['index']), e.get('op') == 'insert_after'), reverse=True)
+    except (KeyError, TypeError, ValueError):
+        return None
+    for edit in ordered:
+        op = edit.get('op')
+        index = int(edit['index'])
+        text = (edit.get('text') or '').strip()
+        if op == 'replace' and 1 <= index <= count and text:
+            result[index - 1] = text
+        elif op == 'delete' and 1 <= index <= count:
+            del result[index - 1]
+        elif op == 'insert_after' and 0 <= index <= count and text:
+            result.insert(index, text)
+        else:
+            logger.warning(f"无效的段落修改: {edit}")
+            return None
+    return result if result else None
@@ -0,0 +1,118 @@
+"""
+ÖNIKA LI 对冲请求
+主层在历史延迟分位数内没有返回时，并行启动下一层，取第一个可用结果
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '1') == '1'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '8'))
+HEDGE_MIN_SAMPLES = 5
+
+
+class LatencyTracker:
+    """记录每层最近的成功延迟，用于计算对冲等待时间
+
+    样本不足 HEDGE_MIN_SAMPLES 时按 defaults 中该层的等待秒数对冲，未列出的层用 default_delay。
+    """
+
+    def __init__(self, window: int = 100, percentile: float = HEDGE_PERCENTILE,
+                 default_delay: float = HEDGE_DEFAULT_DELAY, enabled: bool = HEDGE_ENABLED,
+                 defaults: Optional[Dict[str, float]] = None):
+        self.window = window
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.defaults = defaults or {}
+        self.enabled = enabled
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, layer: str, seconds: float):
+        self._samples.setdefault(layer, deque(maxlen=self.window)).append(seconds)
+
+    def quantile(self, layer: str, percentile: Optional[float] = None) -> Optional[float]:
+        samples = self._samples.get(layer)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        p = self.percentile if percentile is None else percentile
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def hedge_delay(self, layer: str) -> Optional[float]:
+        """返回对冲前的等待秒数，None 表示不对冲（严格串行）"""
+        if not self.enabled:
+            return None
+        samples = self._samples.get(layer)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return self.defaults.get(layer, self.default_delay)
+        return self.quantile(layer)
+
+
+Attempt = Tuple[str, Callable[[], Awaitable]]
+
+
+async def race(layers: List[Attempt], tracker: LatencyTracker,
+               accept: Callable[[object], bool] = lambda result: result is not None):
+    """按优先级依次启动各层，返回 (层名, 结果)
+
+    某层失败时立即启动下一层；某层超过对冲等待时间仍未返回时，
+    并行启动下一层。第一个被 accept 的结果胜出，其余请求被取消。
+    全部失败时返回 (None, 最后一个结果或异常)。
+    """
+    pending: Dict[asyncio.Task, Tuple[str, float]] = {}
+    next_index = 0
+    hedge_at = None
+    last = None
+
+    def launch():
+        nonlocal next_index, hedge_at
+        name, factory = layers[next_index]
+        next_index += 1
+        task = asyncio.ensure_future(factory())
+        pending[task] = (name, time.monotonic())
+        delay = tracker.hedge_delay(name)
+        hedge_at = None if delay is None or next_index >= len(layers) else time.monotonic() + delay
+
+    if not layers:
+        return None, None
+    launch()
+    try:
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                logger.info(f"⏱️ {layers[next_index - 1][0]} 未在对冲时间内返回，并行启动 {layers[next_index][0]}")
+                launch()
+                continue
+
+            for task in done:
+                name, started = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.warning(f"{name} failed: {e}")
+                    result = e
+                if not isinstance(result, Exception) and accept(result):
+                    tracker.record(name, time.monotonic() - started)
+                    return name, result
+                last = result
+
+            # 失败后立即顺延到下一层
+            if next_index < len(layers):
+                launch()
+        return None, last
+    finally:
+        for task in pending:
+            task.cancel()
+        # 等待被取消的请求退出，让它们的清理和指标记录执行完
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,113 @@
+"""
+ÖNIKA LI 共享HTTP连接池
+每个上游主机一个长连接 ClientSession，启动时创建，退出时关闭
+"""
+
+import os
+import json
+import logging
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# 默认连接参数，可用环境变量覆盖
+DEFAULT_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', '10'))
+DEFAULT_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '75'))
+DNS_CACHE_TTL = 300
+
+
+class HTTPPool:
+    """按主机划分的 keep-alive 连接池
+
+    同一主机的所有请求（包括重试）复用同一个连接器，
+    DNS、TCP、TLS 以及代理隧道只在首次请求时建立。
+    """
+
+    def __init__(self, proxy: Optional[str] = None,
+                 limit_per_host: int = DEFAULT_LIMIT_PER_HOST,
+                 keepalive_timeout: float = DEFAULT_KEEPALIVE,
+                 host_limits: Optional[Dict[str, int]] = None,
+                 ssl: bool = False):
+        self.proxy = proxy
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.host_limits = host_limits or {}
+        self.ssl = ssl
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    @staticmethod
+    def _host(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """取得目标主机的会话，不存在时创建"""
+        host = self._host(url)
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            limit = self.host_limits.get(urlsplit(url).hostname, self.limit_per_host)
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl,
+                limit=0,
+                limit_per_host=limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[host] = session
+            logger.info(f"🔌 连接池已创建: {host} (limit={limit})")
+        return session
+
+    def request(self, method: str, url: str, **kwargs):
+        """发起请求，默认走代理"""
+        kwargs.setdefault('proxy', self.proxy)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def start(self, urls=()):
+        """启动时预建各服务商的会话"""
+        for url in urls:
+            self.session(url)
+
+    async def close(self):
+        """退出时关闭所有会话"""
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        logger.info(f"🔌 连接池已关闭 ({len(sessions)} 个主机)")
+
+
+async def read_openai_stream(resp, on_delta, usage: Optional[dict] = None) -> str:
+    """读取 OpenAI 兼容接口的 SSE 流，逐段回调增量文本，返回完整内容
+
+    请求带 stream_options.include_usage 时最后一个数据块带 usage，传入 usage 字典时写入其中。
+    """
+    parts = []
+    async for raw in resp.content:
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            break
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            continue
+        if usage is not None and chunk.get('usage'):
+            usage.update(chunk['usage'])
+        choices = chunk.get('choices') or []
+        delta = (choices[0].get('delta') or {}).get('content') if choices else None
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    return ''.join(parts)
@@ -0,0 +1,305 @@
+"""
+ÖNIKA LI 运行指标
+进程内计数器、仪表、直方图，按 Prometheus 文本格式导出（不依赖第三方库）
+"""
+
+import os
+import time
+import asyncio
+import inspect
+import logging
+import functools
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 上游调用耗时分桶（秒）：覆盖从缓存级响应到长文生成
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(pairs: Iterable[Tuple[str, object]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _matching(self, match: dict):
+        for key, value in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            if all(labels.get(k) == str(v) for k, v in match.items()):
+                yield value
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **match) -> float:
+        return sum(self._matching(match))
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def total(self, **match) -> Tuple[int, float]:
+        """匹配标签的 (次数, 总耗时)"""
+        count, total = 0, 0.0
+        for counts, value_sum, value_count in self._matching(match):
+            count += value_count
+            total += value_sum
+        return count, total
+
+    def samples(self):
+        for key, (counts, value_sum, value_count) in sorted(self._values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket", labels + [("le", _number(bound))], cumulative
+            yield f"{self.name}_sum", labels, round(value_sum, 6)
+            yield f"{self.name}_count", labels, value_count
+
+
+class Registry:
+    """指标注册表；collector 在导出时调用，用于读取缓存命中率等现有统计"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[Metric]]):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                for metric in fn():
+                    lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"指标收集失败: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LAYER_DURATION = REGISTRY.histogram(
+    "onikali_layer_duration_seconds", "各层一次尝试的耗时", ["layer", "outcome"])
+FAILOVERS = REGISTRY.counter(
+    "onikali_failovers_total", "因该层失败或熔断而切换到下一层的次数", ["layer", "reason"])
+REQUEST_DURATION = REGISTRY.histogram(
+    "onikali_upstream_request_duration_seconds", "上游请求耗时（按服务商和模型）", ["provider", "model", "status"])
+IN_FLIGHT = REGISTRY.gauge(
+    "onikali_upstream_in_flight", "进行中的上游请求数", ["provider"])
+TOKENS = REGISTRY.counter(
+    "onikali_tokens_total", "上游返回的token用量", ["provider", "model", "kind"])
+
+
+def failure_reason(error) -> str:
+    """把异常或 (结果, 错误) 中的错误归类为 local_throttle / rate_limit / no_credits / timeout / error"""
+    if isinstance(error, tuple):
+        error = error[-1]
+    if error is None:
+        return "empty"
+    if isinstance(error, BaseException):
+        name = type(error).__name__
+        status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+        if isinstance(error, asyncio.TimeoutError) or 'Timeout' in name:
+            return "timeout"
+        if name == 'RateLimitExceeded':
+            return "local_throttle"
+        if status == 429 or 'RateLimit' in name:
+            return "rate_limit"
+        if status == 402:
+            return "no_credits"
+        return "error"
+    text = str(error)
+    if text in ("local_throttle", "rate_limit", "no_credits"):
+        return text
+    if 'timeout' in text.lower() or '超时' in text:
+        return "timeout"
+    return "error"
+
+
+def record_tokens(provider: str, model: str, prompt: int = 0, completion: int = 0):
+    if prompt:
+        TOKENS.inc(prompt, provider=provider, model=model, kind="prompt")
+    if completion:
+        TOKENS.inc(completion, provider=provider, model=model, kind="completion")
+
+
+class _Call:
+    __slots__ = ('status',)
+
+    def __init__(self):
+        self.status = "ok"
+
+
+@asynccontextmanager
+async def track(provider: str, model: str = ""):
+    """记录一次上游请求的耗时与进行中数量；调用方可设置 call.status 标记非异常的失败"""
+    call = _Call()
+    IN_FLIGHT.inc(provider=provider)
+    started = time.perf_counter()
+    try:
+        yield call
+    except asyncio.CancelledError:
+        call.status = "cancelled"
+        raise
+    except Exception as e:
+        call.status = failure_reason(e)
+        raise
+    finally:
+        IN_FLIGHT.dec(provider=provider)
+        REQUEST_DURATION.observe(time.perf_counter() - started, provider=provider, model=model, status=call.status)
+
+
+def tracked(provider: str, model_arg: str = "model"):
+    """装饰返回 (结果, 错误) 的上游调用函数"""
+    def decorate(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            async with track(provider, str(bound.arguments.get(model_arg, ''))) as call:
+                result, error = await fn(*args, **kwargs)
+                if error:
+                    call.status = failure_reason(error)
+            return result, error
+        return wrapper
+    return decorate
+
+
+def cache_metrics(caches: Dict[str, object]) -> List[Metric]:
+    """TTLCache.stats() -> 命中/未命中计数和条目数"""
+    hits = Counter("onikali_cache_hits_total", "缓存命中次数", ["cache"])
+    misses = Counter("onikali_cache_misses_total", "缓存未命中次数", ["cache"])
+    size = Gauge("onikali_cache_entries", "缓存内存层条目数", ["cache"])
+    for name, cache in caches.items():
+        stats = cache.stats()
+        hits.inc(stats["hits"], cache=name)
+        misses.inc(stats["misses"], cache=name)
+        size.set(stats["size"], cache=name)
+    return [hits, misses, size]
+
+
+def breaker_metrics(router) -> List[Metric]:
+    """各层熔断状态（0 正常、1 熔断、2 试探中）和路由使用的加权耗时、失败率"""
+    codes = {"closed": 0, "open": 1, "half_open": 2}
+    state = Gauge("onikali_layer_breaker_state", "熔断器状态（0 正常、1 熔断、2 试探中）", ["layer"])
+    latency = Gauge("onikali_layer_ewma_latency_seconds", "各层成功请求的指数加权耗时", ["layer"])
+    errors = Gauge("onikali_layer_ewma_error_rate", "各层指数加权失败率", ["layer"])
+    for key, info in router.status().items():
+        state.set(codes.get(str(info['state']).lower(), 0), layer=key)
+        stats = router.stats.get(key)
+        if stats is not None and stats.samples:
+            errors.set(round(stats.error_rate, 4), layer=key)
+            if stats.latency is not None:
+                latency.set(round(stats.latency, 4), layer=key)
+    return [state, latency, errors]
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+async def serve(port: int, host: Optional[str] = None):
+    """独立的 /metrics 服务（轮询模式的 Bot 没有 HTTP 入口时使用），返回 runner 供退出时清理"""
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(body=render().encode('utf-8'), headers={"Content-Type": f"{CONTENT_TYPE}; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host or os.getenv('METRICS_HOST', '127.0.0.1'), port).start()
+    logger.info(f"📈 指标服务: http://{host or os.getenv('METRICS_HOST', '127.0.0.1')}:{port}/metrics")
+    return runner
@@ -0,0 +1,232 @@
+"""
+ÖNIKA LI Telegram 发送出口
+回复和编辑统一经过这里：全局与每个会话的限流、按 RetryAfter 暂停重试、长文按段落拆成多条、同一条消息的编辑合并
+"""
+
+import os
+import re
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from onikali import metrics
+from onikali.ratelimit import TokenBucket, parse_rate
+from onikali.router import load_config
+
+logger = logging.getLogger(__name__)
+
+# Telegram 的限制：全局约 30 条/秒，同一会话约 1 条/秒，群组约 20 条/分钟
+_send_config = (load_config().get('telegram') or {}).get('send_limits') or {}
+TG_GLOBAL_RATE = os.getenv('TG_GLOBAL_RATE', str(_send_config.get('global', '30/s')))
+TG_CHAT_RATE = os.getenv('TG_CHAT_RATE', str(_send_config.get('chat', '1/s')))
+TG_GROUP_RATE = os.getenv('TG_GROUP_RATE', str(_send_config.get('group', '20/min')))
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', str(_send_config.get('chat_burst', 3))))
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', str(_send_config.get('max_retries', 3))))
+TG_MAX_QUEUE = int(os.getenv('TG_MAX_QUEUE', '1000'))
+# 单条消息上限（UTF-16 码元，emoji 计 2）
+MAX_MESSAGE = 4096
+# 保留限流状态的会话数
+MAX_CHATS = 10000
+
+SENDS = metrics.REGISTRY.counter(
+    "onikali_telegram_requests_total", "发往 Telegram 的发送/编辑请求", ["method", "status"])
+FLOOD_WAITS = metrics.REGISTRY.counter(
+    "onikali_telegram_retry_after_total", "Telegram 返回 RetryAfter 的次数", ["method"])
+EDITS_MERGED = metrics.REGISTRY.counter(
+    "onikali_telegram_edits_merged_total", "排队中被更新内容覆盖、没有单独发出的编辑")
+
+# 依次尝试的拆分位置：段落、换行、句末；(分隔符, 拼回时的连接符)
+_SPLITS = (
+    (re.compile(r'\n\s*\n'), "\n\n"),
+    (re.compile(r'\n'), "\n"),
+    (re.compile(r'(?<=[。！？!?；;.])'), ""),
+)
+
+
+def text_units(text: str) -> int:
+    """Telegram 按 UTF-16 码元计算长度"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _hard_cut(text: str, limit: int) -> List[str]:
+    chunks, current, size = [], [], 0
+    for char in text:
+        width = text_units(char)
+        if size + width > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(char)
+        size += width
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def _pack(text: str, limit: int, level: int = 0) -> List[str]:
+    if text_units(text) <= limit:
+        return [text]
+    if level == len(_SPLITS):
+        return _hard_cut(text, limit)
+    pattern, joiner = _SPLITS[level]
+    chunks, current = [], ""
+    for part in pattern.split(text):
+        if not part.strip():
+            continue
+        for piece in _pack(part, limit, level + 1):
+            candidate = f"{current}{joiner}{piece}" if current else piece
+            if text_units(candidate) <= limit:
+                current = candidate
+            else:
+                if current:
+                    chunks.append(current)
+                current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE) -> List[str]:
+    """拆成不超过 limit 的多条，优先在段落处断开；段落本身过长时再按换行、句末、字数拆分"""
+    chunks = [c.strip() for c in _pack(text or "", limit)]
+    return [c for c in chunks if c] or [text or ""]
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """RetryAfter 异常要求等待的秒数（新版本为 timedelta），其他异常返回 None"""
+    delay = getattr(error, 'retry_after', None)
+    if delay is None:
+        return None
+    return float(getattr(delay, 'total_seconds', lambda: delay)())
+
+
+def _not_modified(error: Exception) -> bool:
+    return 'not modified' in str(error).lower()
+
+
+class _Edit:
+    __slots__ = ('chunks', 'kwargs', 'started', 'future')
+
+    def __init__(self, chunks: List[str], kwargs: dict):
+        self.chunks = chunks
+        self.kwargs = kwargs
+        self.started = False
+        self.future = asyncio.get_running_loop().create_future()
+        # 没有合并进来的调用方时，异常也不应作为“未读取”报告
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class Outbox:
+    """Telegram 发送出口
+
+    每次请求先取会话令牌再取全局令牌；收到 RetryAfter 时暂停该会话，最多重试 max_retries 次。
+    reply()/send() 超过 4096 字时按段落拆成多条依次发出；edit() 在排队期间收到的新内容覆盖旧内容，只发送最新的一次。
+    """
+
+    def __init__(self, global_rate: str = TG_GLOBAL_RATE, chat_rate: str = TG_CHAT_RATE,
+                 group_rate: str = TG_GROUP_RATE, burst: int = TG_CHAT_BURST,
+                 max_retries: int = TG_MAX_RETRIES, max_queue: int = TG_MAX_QUEUE, max_chats: int = MAX_CHATS):
+        rate = parse_rate(global_rate)
+        self.global_bucket = TokenBucket(rate, max(1, int(rate)), max_queue * 10)
+        self.chat_rate = parse_rate(chat_rate)
+        self.group_rate = parse_rate(group_rate)
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._edits: Dict[Tuple[int, int], _Edit] = {}
+
+    def bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # 群组和频道的 chat_id 为负数
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst, self.max_queue)
+            while len(self._chats) > self.max_chats:
+                oldest = next(iter(self._chats.values()))
+                if oldest.waiting:
+                    break
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id: int, method: str, request):
+        """限流后执行 request()（返回协程），遇到 RetryAfter 暂停该会话后重试"""
+        for attempt in range(self.max_retries + 1):
+            await self.bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                result = await request()
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == self.max_retries:
+                    SENDS.inc(method=method, status="error")
+                    raise
+                FLOOD_WAITS.inc(method=method)
+                logger.warning(f"Telegram 限流：会话 {chat_id} 暂停 {delay:.0f}s 后重试 {method}")
+                self.bucket(chat_id).pause(delay)
+                continue
+            SENDS.inc(method=method, status="ok")
+            return result
+
+    async def send(self, bot, chat_id: int, text: str, **kwargs):
+        """发送到 chat_id，返回发出的第一条消息"""
+        first = None
+        for chunk in split_message(text):
+            sent = await self.call(chat_id, "send", lambda c=chunk: bot.send_message(chat_id, c, **kwargs))
+            first = first or sent
+        return first
+
+    async def reply(self, message, text: str, **kwargs):
+        """回复 message 所在的会话，返回发出的第一条消息（之后的编辑针对它）"""
+        first = None
+        for chunk in split_message(text):
+            sent = await self.call(message.chat_id, "send", lambda c=chunk: message.reply_text(c, **kwargs))
+            first = first or sent
+        return first
+
+    async def edit(self, message, text: str, **kwargs):
+        """把 message 改为 text；超长时第一段写入原消息，其余作为新消息跟在后面"""
+        key = (message.chat_id, message.message_id)
+        chunks = split_message(text)
+        pending = self._edits.get(key)
+        if pending is not None and not pending.started:
+            # 还在排队：改成最新内容，和它一起发出
+            pending.chunks, pending.kwargs = chunks, kwargs
+            EDITS_MERGED.inc()
+            return await asyncio.shield(pending.future)
+        entry = self._edits[key] = _Edit(chunks, kwargs)
+        try:
+            if pending is not None:
+                # 同一条消息的上一次编辑发出后再发，保证顺序
+                await asyncio.wait([pending.future])
+            result = await self.call(message.chat_id, "edit", lambda: self._edit_once(message, entry))
+            for chunk in entry.chunks[1:]:
+                await self.call(message.chat_id, "send", lambda c=chunk: message.reply_text(c, **entry.kwargs))
+        except asyncio.CancelledError:
+            entry.future.cancel()
+            raise
+        except Exception as e:
+            entry.future.set_exception(e)
+            raise
+        finally:
+            if self._edits.get(key) is entry:
+                del self._edits[key]
+        entry.future.set_result(result)
+        return result
+
+    async def _edit_once(self, message, entry: _Edit):
+        # 拿到令牌后内容就固定了，之后的编辑排在下一轮
+        entry.started = True
+        try:
+            return await message.edit_text(entry.chunks[0], **entry.kwargs)
+        except Exception as e:
+            if _not_modified(e):
+                return message
+            raise
+
+    def stats(self) -> dict:
+        return {"chats": len(self._chats), "pending_edits": len(self._edits),
+                "waiting": self.global_bucket.waiting}
@@ -0,0 +1,125 @@
+"""
+ÖNIKA LI 流式进度显示
+把模型的流式输出节流后写入同一条 Telegram 消息（edit_text）
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Telegram 对同一条消息的编辑频率有限制，默认每1.5秒最多编辑一次
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+MAX_PREVIEW = 3500
+
+
+class ProgressiveEdit:
+    """节流的渐进式消息编辑
+
+    对冲请求时多个层可能同时输出，只显示最先开始输出的层；
+    该层失败后调用 release()，由下一个输出的层接管。提供 outbox 时编辑经它限流和合并。
+    """
+
+    def __init__(self, message, header: str = "", interval: float = EDIT_INTERVAL,
+                 max_chars: int = MAX_PREVIEW, outbox=None):
+        self.message = message
+        self.outbox = outbox
+        self.header = header
+        self.interval = interval
+        self.max_chars = max_chars
+        self.owner = None
+        self.text = ""
+        self._shown = ""
+        self._next_edit = time.monotonic() + interval
+        self._task: Optional[asyncio.Task] = None
+
+    def writer(self, layer):
+        """返回某层使用的增量回调"""
+        return lambda delta: self.feed(layer, delta)
+
+    def feed(self, layer, delta: str):
+        if self.owner is None:
+            self.owner = layer
+        if layer != self.owner:
+            return
+        self.text += delta
+        if time.monotonic() >= self._next_edit and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._edit())
+
+    def release(self, layer):
+        if self.owner == layer:
+            self.owner = None
+            self.text = ""
+
+    def _render(self) -> str:
+        body = self.text
+        if len(body) > self.max_chars:
+            body = body[:self.max_chars] + "…"
+        return f"{self.header}{body} ▌"
+
+    async def _edit(self):
+        content = self._render()
+        if content == self._shown:
+            return
+        self._next_edit = time.monotonic() + self.interval
+        try:
+            if self.outbox is not None:
+                await self.outbox.edit(self.message, content)
+            else:
+                await self.message.edit_text(content)
+            self._shown = content
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after:
+                retry_after = getattr(retry_after, 'total_seconds', lambda: retry_after)()
+                self._next_edit = time.monotonic() + float(retry_after)
+            logger.debug(f"流式编辑跳过: {e}")
+
+    async def close(self):
+        """等待进行中的编辑完成，之后由调用方写入最终文本"""
+        if self._task is not None and not self._task.done():
+            try:
+                await self._task
+            except Exception:
+                pass
+        self._next_edit = float('inf')
+
+
+class ProgressGroup:
+    """把一次生成的流式输出同时写入多条消息
+
+    合并的相同请求共享一次生成，每个调用方的 ProgressiveEdit 都加入同一组；
+    中途加入的成员会先补上已输出的内容。
+    """
+
+    def __init__(self):
+        self.members = []
+        self._events = []
+
+    def add(self, member):
+        for layer, delta in self._events:
+            if delta is None:
+                member.release(layer)
+            else:
+                member.feed(layer, delta)
+        self.members.append(member)
+
+    def discard(self, member):
+        if member in self.members:
+            self.members.remove(member)
+
+    def writer(self, layer):
+        return lambda delta: self.feed(layer, delta)
+
+    def feed(self, layer, delta: str):
+        self._events.append((layer, delta))
+        for member in self.members:
+            member.feed(layer, delta)
+
+    def release(self, layer):
+        self._events.append((layer, None))
+        for member in self.members:
+            member.release(layer)
@@ -0,0 +1,189 @@
+"""
+ÖNIKA LI 提示词预算
+按目标模型估算token数，在输入预算内挑选最相关、互不重复的搜索摘要，并按目标字数设置 max_tokens
+"""
+
+import os
+import re
+import logging
+from typing import Dict, List, Optional
+
+from onikali.cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# 整个提示词的输入预算（token）与期望输出字数上限（正文500字，加上标题、标签、平台建议）
+PROMPT_INPUT_BUDGET = int(os.getenv('PROMPT_INPUT_BUDGET', '1200'))
+PROMPT_OUTPUT_CHARS = int(os.getenv('PROMPT_OUTPUT_CHARS', '800'))
+PROMPT_MAX_SNIPPETS = int(os.getenv('PROMPT_MAX_SNIPPETS', '5'))
+# 输出token留出的余量
+OUTPUT_HEADROOM = 1.2
+# 两条摘要的字符二元组重合度超过该值视为重复
+DUPLICATE_OVERLAP = 0.5
+# 截断后摘要少于这个字数就不再放入
+MIN_SNIPPET_CHARS = 40
+
+# 各模型系列的分词估算：每个中日韩字符的token数、每个其他字符的token数、推理模型额外预留的思考token
+TOKEN_PROFILES = {
+    "deepseek": {"cjk": 0.6, "other": 0.3, "reasoning": 0},
+    "deepseek-r1": {"cjk": 0.6, "other": 0.3, "reasoning": 1200},
+    "moonshot": {"cjk": 0.6, "other": 0.3, "reasoning": 0},
+    "llama": {"cjk": 1.0, "other": 0.28, "reasoning": 0},
+    "claude": {"cjk": 1.2, "other": 0.3, "reasoning": 0},
+    "default": {"cjk": 1.0, "other": 0.3, "reasoning": 0},
+}
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+_SENTENCE_END = re.compile(r'(?<=[。！？；!?;.])')
+
+
+def token_profile(model: str) -> dict:
+    name = (model or '').lower()
+    if 'deepseek' in name:
+        return TOKEN_PROFILES['deepseek-r1' if 'r1' in name else 'deepseek']
+    for family in ('moonshot', 'llama', 'claude'):
+        if family in name:
+            return TOKEN_PROFILES[family]
+    if 'kimi' in name:
+        return TOKEN_PROFILES['moonshot']
+    return TOKEN_PROFILES['default']
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    """按模型系列估算token数（略偏大，宁可少放一条摘要也不超预算）"""
+    if not text:
+        return 0
+    profile = token_profile(model)
+    cjk = len(_CJK.findall(text))
+    return int(cjk * profile['cjk'] + (len(text) - cjk) * profile['other']) + 1
+
+
+def output_tokens(chars: int = PROMPT_OUTPUT_CHARS, model: str = "") -> int:
+    """生成 chars 个中文字符需要的 max_tokens，推理模型加上思考预留"""
+    profile = token_profile(model)
+    return int(chars * profile['cjk'] * OUTPUT_HEADROOM) + profile['reasoning']
+
+
+def _bigrams(text: str) -> set:
+    text = _NON_WORD.sub('', normalize_query(text))
+    return {text[i:i + 2] for i in range(len(text) - 1)} or ({text} if text else set())
+
+
+def relevance(topic: str, result: dict) -> float:
+    """主题的字符二元组在标题+摘要中出现的比例；标题命中加权"""
+    wanted = _bigrams(topic)
+    if not wanted:
+        return 0.0
+    title = _bigrams(result.get('title', ''))
+    body = _bigrams(result.get('description', ''))
+    return (len(wanted & title) * 1.5 + len(wanted & body)) / (len(wanted) * 2.5)
+
+
+def overlap(a: set, b: set) -> float:
+    """以较短一方为基准的重合度，能识别一条摘要被另一条包含的情况"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def trim_to(text: str, limit: int, model: str = "") -> str:
+    """在 limit token 内按句子截断；一句都放不下时按字符截断"""
+    if count_tokens(text, model) <= limit:
+        return text
+    kept = ""
+    for sentence in _SENTENCE_END.split(text):
+        if count_tokens(kept + sentence, model) > limit:
+            break
+        kept += sentence
+    if not kept:
+        for i in range(len(text), 0, -1):
+            if count_tokens(text[:i], model) <= limit:
+                return text[:i]
+    return kept
+
+
+class Prompt:
+    __slots__ = ('text', 'tokens', 'max_tokens', 'snippets')
+
+    def __init__(self, text: str, tokens: int, max_tokens: int, snippets: List[dict]):
+        self.text = text
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.snippets = snippets
+
+    @property
+    def messages(self) -> List[dict]:
+        return [{"role": "user", "content": self.text}]
+
+
+def select_snippets(topic: str, results: Optional[List[dict]], budget: int, model: str = "",
+                    max_snippets: int = PROMPT_MAX_SNIPPETS) -> List[dict]:
+    """按相关度从高到低放入摘要，跳过与已选重复的，放不下时截断到句子边界
+
+    结果带 body（抓取到的原文段落）时用它代替搜索摘要，每条最多占剩余预算的平均份额。
+    """
+    if not results or budget <= 0:
+        return []
+    scored = [(relevance(topic, r), i, r) for i, r in enumerate(results)]
+    # 相关度相同时保留搜索引擎原有的顺序；有相关结果时不放与主题毫无关联的
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    if scored[0][0] > 0:
+        scored = [item for item in scored if item[0] > 0]
+    chosen, seen_urls, seen_grams = [], set(), []
+    remaining = budget
+    slots = min(max_snippets, len(scored))
+    for _, _, r in scored:
+        if len(chosen) >= max_snippets:
+            break
+        url = (r.get('url') or '').rstrip('/')
+        grams = _bigrams(f"{r.get('title', '')} {r.get('description', '')}")
+        if (url and url in seen_urls) or any(overlap(grams, g) >= DUPLICATE_OVERLAP for g in seen_grams):
+            continue
+        title = r.get('title', '')
+        overhead = count_tokens(f"{len(chosen) + 1}. {title}: \n", model)
+        text = r.get('body') or r.get('description', '')
+        limit = remaining - overhead
+        if r.get('body'):
+            # 原文较长，不让排在前面的一篇占满全部预算
+            limit = min(limit, remaining // max(1, slots - len(chosen)) - overhead)
+        description = trim_to(text, limit, model)
+        if len(description) < min(MIN_SNIPPET_CHARS, len(text)):
+            continue
+        snippet = dict(r, description=description)
+        remaining -= overhead + count_tokens(description, model)
+        chosen.append(snippet)
+        seen_urls.add(url)
+        seen_grams.append(grams)
+    return chosen
+
+
+def build_prompt(template: str, topic: str, search_results: Optional[List[dict]] = None, model: str = "",
+                 input_budget: int = PROMPT_INPUT_BUDGET, output_chars: int = PROMPT_OUTPUT_CHARS,
+                 header: str = "基于以下网络信息创作：\n") -> Prompt:
+    """用 template（含 {topic} 和 {search_info}）拼出提示词，摘要部分占用模板之外的剩余预算"""
+    fixed = template.format(topic=topic, search_info="")
+    budget = input_budget - count_tokens(fixed, model) - count_tokens(header, model)
+    snippets = select_snippets(topic, search_results, budget, model)
+    search_info = ""
+    if snippets:
+        search_info = header + "".join(
+            f"{i}. {r.get('title', '')}: {r['description']}\n" for i, r in enumerate(snippets, 1)
+        )
+    text = template.format(topic=topic, search_info=search_info)
+    tokens = count_tokens(text, model)
+    if budget <= 0:
+        logger.warning(f"提示词模板已超出输入预算 {input_budget} tokens（{model}）")
+    return Prompt(text, tokens, output_tokens(output_chars, model), snippets)
+
+
+def build_prompts(template: str, topic: str, search_results: Optional[List[dict]], models: List[str],
+                  **kwargs) -> Dict[str, Prompt]:
+    """为每个模型各拼一份；分词估算相同的模型共用同一份"""
+    prompts, by_profile = {}, {}
+    for model in models:
+        profile = id(token_profile(model))
+        if profile not in by_profile:
+            by_profile[profile] = build_prompt(template, topic, search_results, model, **kwargs)
+        prompts[model] = by_profile[profile]
+    return prompts
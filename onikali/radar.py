@@ -0,0 +1,292 @@
+"""
+ÖNIKA LI 信息雷达
+按配置中启用的站点并发搜索，SimHash 去除近似重复，只推送上次运行后的新内容
+
+命令行（GitHub Actions 每日运行）：
+    python -m onikali.radar --state .radar/state.json --notify
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import html
+import asyncio
+import hashlib
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from onikali.cache import normalize_query
+from onikali.http import HTTPPool
+from onikali.ratelimit import TokenBucket
+from onikali.router import load_config
+
+logger = logging.getLogger(__name__)
+
+BRAVE_URL = "https://api.search.brave.com/res/v1/web/search"
+RADAR_CONCURRENCY = int(os.getenv('RADAR_CONCURRENCY', '4'))
+RADAR_QPS = float(os.getenv('RADAR_QPS', '1'))  # Brave 免费额度每秒1次
+RETENTION_DAYS = int(os.getenv('RADAR_RETENTION_DAYS', '14'))
+SIMHASH_BITS = 64
+SIMHASH_DISTANCE = 6  # 汉明距离不超过6视为同一条新闻（标题+摘要较短，阈值比长文放宽）
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+# 站点未配置 content_types 时按站点类型取默认值
+DEFAULT_CONTENT_TYPES = {
+    "media": ["news"],
+    "label": ["news"],
+    "events": ["events"],
+}
+
+
+def simhash(text: str) -> int:
+    """64位 SimHash，去掉标点空白后按字符二元组计算，适合中英文混排的短文本"""
+    text = _NON_WORD.sub('', normalize_query(text))
+    tokens = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    weights = [0] * SIMHASH_BITS
+    for token in tokens:
+        h = int.from_bytes(hashlib.md5(token.encode('utf-8')).digest()[:8], 'big')
+        for i in range(SIMHASH_BITS):
+            weights[i] += 1 if (h >> i) & 1 else -1
+    return sum(1 << i for i in range(SIMHASH_BITS) if weights[i] > 0)
+
+
+def url_key(url: str) -> str:
+    normalized = (url or '').split('#', 1)[0].rstrip('/').lower()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class SimHashIndex:
+    """分8段各8位建索引：距离≤7的两个指纹至少有一段完全相同，只需比较同段候选"""
+
+    BANDS = 8
+
+    def __init__(self):
+        self._bands: List[Dict[int, List[int]]] = [{} for _ in range(self.BANDS)]
+
+    def _parts(self, fingerprint: int):
+        width = SIMHASH_BITS // self.BANDS
+        mask = (1 << width) - 1
+        return [(fingerprint >> (i * width)) & mask for i in range(self.BANDS)]
+
+    def add(self, fingerprint: int):
+        for band, part in zip(self._bands, self._parts(fingerprint)):
+            band.setdefault(part, []).append(fingerprint)
+
+    def near(self, fingerprint: int) -> bool:
+        for band, part in zip(self._bands, self._parts(fingerprint)):
+            for other in band.get(part, ()):
+                if bin(fingerprint ^ other).count('1') <= SIMHASH_DISTANCE:
+                    return True
+        return False
+
+
+class RadarState:
+    """磁盘上的雷达状态：见过的URL与指纹、上次运行时间"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.items: List[dict] = []
+        self.last_run: Optional[float] = None
+        # 本次扫描至少一个查询成功时记录扫描时间，save() 才推进 last_run
+        self.scanned_at: Optional[float] = None
+        self.urls = set()
+        self.index = SimHashIndex()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        cutoff = time.time() - RETENTION_DAYS * 86400
+        self.last_run = data.get('last_run')
+        for item in data.get('items', []):
+            if item.get('seen', 0) >= cutoff:
+                self._remember(item)
+
+    def _remember(self, item: dict):
+        self.items.append(item)
+        self.urls.add(item['url'])
+        self.index.add(item['simhash'])
+
+    def is_new(self, url: str, fingerprint: int) -> bool:
+        return url_key(url) not in self.urls and not self.index.near(fingerprint)
+
+    def add(self, url: str, fingerprint: int):
+        self._remember({"url": url_key(url), "simhash": fingerprint, "seen": time.time()})
+
+    def mark(self, items: List[dict]):
+        """把已推送的条目记为见过；没推送的条目下次运行还会出现"""
+        for item in items:
+            self.add(item['url'], item['simhash'])
+
+    def freshness(self) -> str:
+        """按距上次运行的时间选择 Brave freshness 参数，只取增量"""
+        if self.last_run is None:
+            return "pw"
+        age = time.time() - self.last_run
+        if age <= 86400:
+            return "pd"
+        if age <= 7 * 86400:
+            return "pw"
+        return "pm"
+
+    def save(self):
+        if self.scanned_at is not None:
+            self.last_run = self.scanned_at
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"last_run": self.last_run, "items": self.items}, f)
+        os.replace(tmp, self.path)
+
+
+def site_queries(config: dict) -> List[tuple]:
+    """(站点, 内容类型, 查询) 列表，只包含启用的站点"""
+    radar = (config.get('workflows') or {}).get('daily_radar') or {}
+    templates = radar.get('queries') or {}
+    queries = []
+    for site, info in (config.get('sites') or {}).items():
+        if not info.get('enabled'):
+            continue
+        for content_type in info.get('content_types') or DEFAULT_CONTENT_TYPES.get(info.get('type'), []):
+            for query in templates.get(content_type, []):
+                queries.append((site, content_type, query))
+    return queries
+
+
+async def brave_search(pool: HTTPPool, query: str, count: int = 10, freshness: Optional[str] = None):
+    """Brave Search，返回 (结果列表, 错误)"""
+    key = os.getenv('BRAVE_API_KEY')
+    if not key:
+        return None, "Brave API Key 未配置"
+    headers = {"Accept": "application/json", "X-Subscription-Token": key}
+    params = {"q": query, "count": count, "search_lang": "zh"}
+    if freshness:
+        params["freshness"] = freshness
+    try:
+        async with pool.get(BRAVE_URL, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+            if resp.status != 200:
+                await resp.read()
+                return None, f"搜索失败: {resp.status}"
+            data = await resp.json()
+    except Exception as e:
+        return None, f"搜索错误: {str(e)[:100]}"
+    return [
+        {'title': item.get('title', ''), 'url': item.get('url', ''), 'description': item.get('description', '')[:300]}
+        for item in data.get('web', {}).get('results', [])
+    ], None
+
+
+async def run_radar(pool: HTTPPool, state: RadarState, config: Optional[dict] = None,
+                    concurrency: int = RADAR_CONCURRENCY) -> Dict[str, List[dict]]:
+    """执行一次扫描，返回 {站点: [新条目]}
+
+    不标记见过的条目（由调用方对实际推送的条目调用 state.mark()），也不写盘；
+    全部查询失败时不记录扫描时间，下次仍按上次成功运行后的时间范围搜索。
+    """
+    config = load_config() if config is None else config
+    radar = (config.get('workflows') or {}).get('daily_radar') or {}
+    count = int(radar.get('max_results', 10))
+    freshness = state.freshness()
+    semaphore = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(RADAR_QPS, burst=1, max_queue=1000)
+
+    async def fetch(site, content_type, query):
+        async with semaphore:
+            await bucket.acquire()
+            results, error = await brave_search(pool, query, count, freshness)
+        if error:
+            logger.warning(f"雷达查询失败 [{site}] {query}: {error}")
+        return site, content_type, results
+
+    started = time.time()
+    batches = await asyncio.gather(*[fetch(*q) for q in site_queries(config)])
+    if any(results is not None for _, _, results in batches):
+        state.scanned_at = started
+
+    # 本次结果之间也去重
+    urls, index = set(), SimHashIndex()
+    found: Dict[str, List[dict]] = {}
+    for site, content_type, results in batches:
+        for r in results or []:
+            fingerprint = simhash(f"{r['title']} {r['description']}")
+            if not r['url'] or not state.is_new(r['url'], fingerprint):
+                continue
+            key = url_key(r['url'])
+            if key in urls or index.near(fingerprint):
+                continue
+            urls.add(key)
+            index.add(fingerprint)
+            found.setdefault(site, []).append(dict(r, type=content_type, simhash=fingerprint))
+    return found
+
+
+def build_report(found: Dict[str, List[dict]], limit: int = 5, max_chars: int = 4000):
+    """Telegram HTML 格式的雷达报告，按整行截断，不会切断标签；返回 (报告, 报告中列出的条目)"""
+    lines = [("🎸 <b>ÖNIKA LI 信息雷达</b>", None), ("━━━━━━━━━━━━━━", None)]
+    if not found:
+        lines.append(("没有发现新内容", None))
+    for site, items in found.items():
+        lines.append((f"\n<b>{html.escape(site)}</b>（{len(items)} 条新内容）", None))
+        for item in items[:limit]:
+            lines.append((f"• [{item['type']}] {html.escape(item['title'])}\n  {html.escape(item['url'])}", item))
+    size = 0
+    for i, (line, _) in enumerate(lines):
+        size += len(line) + 1
+        if size > max_chars:
+            lines = lines[:i] + [("…", None)]
+            break
+    return "\n".join(line for line, _ in lines), [item for _, item in lines if item is not None]
+
+
+def format_report(found: Dict[str, List[dict]], limit: int = 5, max_chars: int = 4000) -> str:
+    return build_report(found, limit, max_chars)[0]
+
+
+async def notify(pool: HTTPPool, text: str) -> bool:
+    token = os.getenv('TELEGRAM_TOKEN')
+    chat_id = os.getenv('TELEGRAM_CHAT_ID')
+    if not token or not chat_id:
+        logger.warning("TELEGRAM_TOKEN / TELEGRAM_CHAT_ID 未配置，跳过推送")
+        return False
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
+    async with pool.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        await resp.read()
+        return resp.status == 200
+
+
+async def main(state_path: str, send: bool) -> int:
+    """返回退出码：推送失败时为 1，让定时任务显示失败"""
+    pool = HTTPPool(proxy=os.getenv('RADAR_PROXY') or None)
+    state = RadarState(state_path)
+    try:
+        found = await run_radar(pool, state)
+        report, shown = build_report(found)
+        print(report)
+        if send and not await notify(pool, report):
+            # 推送失败：不保存状态，下次运行重新推送这些条目
+            logger.error("雷达报告推送失败，状态未保存")
+            return 1
+        state.mark(shown)
+        state.save()
+        return 0
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="ÖNIKA LI 信息雷达")
+    parser.add_argument("--state", default=os.getenv('RADAR_STATE', '.radar/state.json'))
+    parser.add_argument("--notify", action="store_true", help="把报告推送到 TELEGRAM_CHAT_ID")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.state, args.notify)))
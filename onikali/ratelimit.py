@@ -0,0 +1,119 @@
+"""
+ÖNIKA LI 令牌桶限流
+按 (服务商, 模型) 分桶，速率与突发容量来自配置文件各层的 rate_limit / burst
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE = os.getenv('RATE_LIMIT_DEFAULT', '60/min')
+DEFAULT_BURST = int(os.getenv('RATE_LIMIT_BURST', '5'))
+DEFAULT_MAX_QUEUE = int(os.getenv('RATE_LIMIT_MAX_QUEUE', '100'))
+
+_UNITS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': 60, 'min': 60, 'minute': 60,
+    'h': 3600, 'hour': 3600,
+    'd': 86400, 'day': 86400,
+}
+
+
+class RateLimitExceeded(Exception):
+    """等待队列已满或等待时间超过上限"""
+
+
+# 本地令牌桶排队已满时返回的错误：请求没有发给服务商，不计入熔断和失败率
+LOCAL_THROTTLE = "local_throttle"
+
+
+def is_local_throttle(outcome) -> bool:
+    """异常或 (结果, 错误) 是否为本地限流"""
+    if isinstance(outcome, tuple) and outcome:
+        outcome = outcome[-1]
+    return isinstance(outcome, RateLimitExceeded) or outcome == LOCAL_THROTTLE
+
+
+def parse_rate(rate: str) -> float:
+    """把 "1000/min" 这样的配置转换为每秒令牌数"""
+    count, _, unit = str(rate).partition('/')
+    return float(count) / _UNITS.get(unit.strip().lower() or 's', 1)
+
+
+class TokenBucket:
+    """令牌桶：平时按 rate 补充令牌，最多积累 burst 个用于突发
+
+    令牌不足时请求按先后顺序排队等待，排队数超过 max_queue 立即拒绝；
+    pause() 让之后的请求都等到指定时间（如上游返回 Retry-After）。
+    """
+
+    def __init__(self, rate: float, burst: int = DEFAULT_BURST, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.max_queue = max_queue
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, timeout: Optional[float] = None):
+        if self.waiting >= self.max_queue:
+            raise RateLimitExceeded(f"等待队列已满 ({self.max_queue})")
+        self.waiting += 1
+        try:
+            async with self._lock:
+                # 暂停期间持有锁等待，排在后面的请求也一起顺延
+                pause = self.paused_until - time.monotonic()
+                while pause > 0:
+                    if timeout is not None and pause > timeout:
+                        raise RateLimitExceeded(f"暂停中，还需 {pause:.1f}s")
+                    await asyncio.sleep(pause)
+                    pause = self.paused_until - time.monotonic()
+                self._refill()
+                if self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                    if timeout is not None and wait > timeout:
+                        raise RateLimitExceeded(f"需要等待 {wait:.1f}s")
+                    await asyncio.sleep(wait)
+                    self._refill()
+                self.tokens -= 1
+        finally:
+            self.waiting -= 1
+
+
+class RateLimiters:
+    """按 (服务商, 模型) 管理令牌桶，参数取自对应层的配置"""
+
+    def __init__(self, layers: Optional[Dict[str, dict]] = None):
+        self.layers = layers or {}
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    def bucket(self, provider: str, model: str, layer: Optional[str] = None) -> TokenBucket:
+        key = (provider, model)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            config = self.layers.get(layer, {}) if layer else {}
+            bucket = TokenBucket(
+                parse_rate(config.get('rate_limit', DEFAULT_RATE)),
+                int(config.get('burst', DEFAULT_BURST)),
+                int(config.get('max_queue', DEFAULT_MAX_QUEUE)),
+            )
+            self._buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, provider: str, model: str, layer: Optional[str] = None,
+                      timeout: Optional[float] = None):
+        await self.bucket(provider, model, layer).acquire(timeout)
@@ -0,0 +1,519 @@
+"""
+ÖNIKA LI 层级路由
+读取 config/onikali_config.yml 的 layers / failover 配置，为每层维护熔断状态
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import yaml
+
+from onikali import metrics
+from onikali.ratelimit import LOCAL_THROTTLE, is_local_throttle
+from onikali.state import STATE_SYNC_INTERVAL, StateBackend, StateError
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.getenv(
+    'ONIKALI_CONFIG',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'onikali_config.yml')
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_config_cache = {}
+
+
+def load_config(path: str = CONFIG_PATH) -> dict:
+    """读取主配置文件（进程内只解析一次）"""
+    if path not in _config_cache:
+        try:
+            with open(path, encoding='utf-8') as f:
+                _config_cache[path] = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            logger.warning(f"配置文件不存在: {path}")
+            _config_cache[path] = {}
+    return _config_cache[path]
+
+
+# 共享后端中熔断记录的保留时间
+BREAKER_STATE_TTL = 86400
+
+
+class LayerUnavailable(Exception):
+    """该层在启动前被熔断（试探名额已被其他请求或实例领取），不计入失败"""
+
+
+class CircuitBreaker:
+    """单层熔断器：连续失败达到阈值后打开，recovery_check 秒后放行一次试探
+
+    提供 store 时熔断状态保存在共享后端，多个实例共用；试探名额也经后端分配，同一时间只有一个实例试探。
+    判断和记录只用内存中的状态，写入不等待后端，由 sync() 定期读回其他实例的变化。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 2, recovery_check: float = 300,
+                 store: Optional[StateBackend] = None, key: Optional[str] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_check = recovery_check
+        self.store = store
+        self.key = key or name
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.state = CLOSED
+        self.last_error = None
+        self._changes = 0
+
+    def _apply(self, row):
+        if row is None:
+            self.state, self.failures, self.opened_at, self.probe_at, self.last_error = CLOSED, 0, None, None, None
+            return
+        data = json.loads(row[0])
+        self.state = data.get('state', CLOSED)
+        self.failures = data.get('failures', 0)
+        self.last_error = data.get('last_error')
+        # 后端保存墙上时间，本地换算回单调时钟
+        opened, probed = data.get('opened_at'), data.get('probe_at')
+        self.opened_at = None if opened is None else time.monotonic() - (time.time() - opened)
+        self.probe_at = None if probed is None else time.monotonic() - (time.time() - probed)
+
+    async def sync(self):
+        """从共享后端读取其他实例写入的状态；判断和记录都只用内存中的状态"""
+        if self.store is None:
+            return
+        changes = self._changes
+        try:
+            row = await self.store.aget(self.key)
+        except StateError as e:
+            logger.warning(f"熔断状态读取失败，沿用本地状态: {e}")
+            return
+        # 读取期间本地有新的变化时，以本地为准（写入已排在读取之后）
+        if self._changes == changes:
+            self._apply(row)
+
+    def _save(self):
+        self._changes += 1
+        if self.store is None:
+            return
+
+        def wall(at):
+            return None if at is None else time.time() - (time.monotonic() - at)
+
+        data = {"state": self.state, "failures": self.failures, "opened_at": wall(self.opened_at),
+                "probe_at": wall(self.probe_at), "last_error": self.last_error}
+        self.store.set_nowait(self.key, json.dumps(data, ensure_ascii=False), BREAKER_STATE_TTL)
+
+    async def claim_probe(self) -> bool:
+        """共享模式下每个恢复周期只有一个实例拿到试探名额"""
+        if self.store is None:
+            return True
+        try:
+            return await self.store.aadd(f"{self.key}:probe", "1", self.recovery_check)
+        except StateError:
+            return True
+
+    def _probe_due(self) -> bool:
+        """熔断已到试探时间，或上一次试探超过 recovery_check 仍无结果（进程退出、请求丢失）"""
+        now = time.monotonic()
+        if self.state == OPEN:
+            return now - self.opened_at >= self.recovery_check
+        if self.state == HALF_OPEN:
+            return self.probe_at is None or now - self.probe_at >= self.recovery_check
+        return False
+
+    def available(self) -> bool:
+        """是否可以尝试该层，不改变状态；试探名额在真正发起请求时由 allow() 领取"""
+        return self.state == CLOSED or self._probe_due()
+
+    async def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if not self._probe_due():
+            return False
+        # 试探前确认其他实例没有已经恢复或正在试探
+        await self.sync()
+        if self.state == CLOSED:
+            return True
+        if not self._probe_due() or not await self.claim_probe():
+            return False
+        # 只放行一个试探请求，其余请求继续跳过
+        self.state = HALF_OPEN
+        self.probe_at = time.monotonic()
+        self._save()
+        return True
+
+    def cancel_probe(self):
+        """试探请求被取消（如被对冲的其他层抢先），回到熔断状态等待下次试探"""
+        if self.state == HALF_OPEN:
+            self.state = OPEN
+            self.probe_at = None
+            self._save()
+            if self.store is not None:
+                self.store.delete_nowait(f"{self.key}:probe")
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"✅ {self.name} 已恢复")
+        elif self.failures == 0:
+            return
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.state = CLOSED
+        self.last_error = None
+        self._save()
+
+    def record_failure(self, error=None):
+        self.failures += 1
+        self.last_error = str(error)[:100] if error else None
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"🔴 {self.name} 熔断（连续失败 {self.failures} 次）")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+        self._save()
+
+    def retry_in(self) -> float:
+        """距离下次试探的秒数"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.recovery_check - (time.monotonic() - self.opened_at))
+
+
+class LayerStats:
+    """单层的指数加权统计：成功耗时和失败率，越新的样本权重越大
+
+    统计只在调用该层时更新；被排到后面的层很少再被调用，
+    因此没有新样本时按 half_life 衰减回先验（失败率 0、耗时 prior_latency），让降级的层有机会重新被选中。
+    """
+
+    def __init__(self, alpha: float = 0.3, half_life: float = 0, prior_latency: float = 5):
+        self.alpha = alpha
+        self.half_life = half_life
+        self.prior_latency = prior_latency
+        self.samples = 0
+        self._latency: Optional[float] = None
+        self._error_rate = 0.0
+        self._updated_at = time.monotonic()
+
+    def _weight(self) -> float:
+        """上次样本的剩余权重"""
+        if self.half_life <= 0:
+            return 1.0
+        return 0.5 ** ((time.monotonic() - self._updated_at) / self.half_life)
+
+    @property
+    def error_rate(self) -> float:
+        return self._error_rate * self._weight()
+
+    @property
+    def latency(self) -> Optional[float]:
+        if self._latency is None:
+            return None
+        return self.prior_latency + (self._latency - self.prior_latency) * self._weight()
+
+    def observe(self, ok: bool, seconds: Optional[float] = None):
+        a = self.alpha
+        # 先把衰减落到存储值上，再叠加新样本
+        self._error_rate, self._latency = self.error_rate, self.latency
+        self._updated_at = time.monotonic()
+        self.samples += 1
+        self._error_rate = (1 - a) * self._error_rate + a * (0.0 if ok else 1.0)
+        if ok and seconds is not None:
+            self._latency = seconds if self._latency is None else (1 - a) * self._latency + a * seconds
+
+    def expected_latency(self, default: float) -> float:
+        """按失败率放大的期望耗时：失败后还要再等下一层"""
+        latency = self.latency
+        latency = default if latency is None else latency
+        return latency / max(0.1, 1 - self.error_rate)
+
+
+# 排序策略：priority 按配置顺序；fastest 按期望耗时；quality 在 slo 内按质量分；cheapest 在 slo 内按单价
+STRATEGIES = ("priority", "fastest", "quality", "cheapest")
+
+
+class LayerRouter:
+    """按配置的优先级和 failover_to 链路由请求，跳过已熔断的层
+
+    每层记录指数加权的耗时和失败率，按 routing.policies 中各命令的策略排序：
+    失败率超过 max_error_rate 的层排到最后，超出延迟 slo 的层排在 slo 内的层之后。
+    """
+
+    def __init__(self, config: Optional[dict] = None, backend: Optional[StateBackend] = None):
+        config = load_config() if config is None else config
+        self.layers: Dict[str, dict] = config.get('layers') or {}
+        routing = config.get('routing') or {}
+        self.policies: Dict[str, dict] = routing.get('policies') or {}
+        self.default_latency = float(routing.get('default_latency', 5))
+        self.max_error_rate = float(routing.get('max_error_rate', 0.5))
+        self.stats = {
+            key: LayerStats(float(routing.get('ewma_alpha', 0.3)), float(routing.get('decay_half_life', 300)),
+                            self.default_latency)
+            for key in self.layers
+        }
+        failover = config.get('failover') or {}
+        self.failure_threshold = int(failover.get('failure_threshold', 2))
+        self.recovery_check = float(failover.get('recovery_check', 300))
+        self.emergency = failover.get('emergency_mode') or {}
+        # backend 为共享后端时，各实例共用熔断状态
+        self.breakers = {
+            key: CircuitBreaker(layer.get('name', key), self.failure_threshold, self.recovery_check,
+                                store=backend, key=key)
+            for key, layer in self.layers.items()
+        }
+        self._probe_task = None
+        self._synced_at = 0.0
+        self._sync_task = None
+
+    def hedge_delays(self) -> Dict[str, float]:
+        """各层样本不足时的对冲等待秒数：layers.<层>.hedge_delay，未配置时用 routing.default_latency"""
+        return {key: float(layer.get('hedge_delay', self.default_latency)) for key, layer in self.layers.items()}
+
+    async def sync(self):
+        """读回所有层在共享后端中的熔断状态"""
+        self._synced_at = time.monotonic()
+        await asyncio.gather(*(breaker.sync() for breaker in self.breakers.values()))
+
+    def _sync_later(self):
+        # 距上次同步超过 STATE_SYNC_INTERVAL 时在后台读取，本次请求沿用内存状态
+        if self._sync_task is not None and not self._sync_task.done():
+            return
+        if time.monotonic() - self._synced_at < STATE_SYNC_INTERVAL:
+            return
+        if all(breaker.store is None for breaker in self.breakers.values()):
+            return
+        self._sync_task = asyncio.ensure_future(self.sync())
+
+    @property
+    def emergency_enabled(self) -> bool:
+        return bool(self.emergency.get('enabled'))
+
+    def order(self) -> List[str]:
+        """从优先级最高的层开始沿 failover_to 链排序，未在链上的层按优先级补在后面"""
+        by_priority = sorted(self.layers, key=lambda k: self.layers[k].get('priority', 99))
+        chain = []
+        key = by_priority[0] if by_priority else None
+        while key in self.layers and key not in chain:
+            chain.append(key)
+            key = self.layers[key].get('failover_to')
+        return chain + [k for k in by_priority if k not in chain]
+
+    def priority(self, key: str) -> int:
+        return int(self.layers.get(key, {}).get('priority', 0))
+
+    def name(self, key: str) -> str:
+        return self.layers.get(key, {}).get('name', key)
+
+    def quality(self, key: str) -> float:
+        return float(self.layers.get(key, {}).get('quality', 0))
+
+    def cost(self, key: str) -> float:
+        """每百万token的输入、输出均价（美元）"""
+        cost = self.layers.get(key, {}).get('cost') or {}
+        return (float(cost.get('input', 0)) + float(cost.get('output', 0))) / 2
+
+    def policy(self, name: Optional[str]) -> dict:
+        return self.policies.get(name) or self.policies.get('default') or {"strategy": "priority"}
+
+    def rank(self, policy: Optional[str] = None, keys=None) -> List[str]:
+        """按命令策略排序各层；keys 限定参与排序的层"""
+        order = [k for k in self.order() if keys is None or k in keys]
+        spec = self.policy(policy)
+        strategy = spec.get('strategy', 'priority')
+        if strategy not in STRATEGIES:
+            logger.warning(f"未知路由策略 {strategy}，按配置顺序")
+            strategy = 'priority'
+        if strategy == 'priority':
+            return order
+        slo = spec.get('slo')
+        max_error_rate = float(spec.get('max_error_rate', self.max_error_rate))
+
+        def score(key):
+            stats = self.stats[key]
+            latency = stats.expected_latency(self.default_latency)
+            unhealthy = stats.error_rate > max_error_rate
+            if slo is not None and latency > float(slo):
+                # 超出 slo 的层只按耗时排在后面
+                return (unhealthy, 1, latency)
+            if strategy == 'fastest':
+                return (unhealthy, 0, latency)
+            if strategy == 'quality':
+                return (unhealthy, 0, -self.quality(key), latency)
+            return (unhealthy, 0, self.cost(key), latency)
+
+        # sorted 是稳定排序，分数相同时保持配置顺序
+        return sorted(order, key=score)
+
+    def rankings(self, policy: Optional[str] = None, keys=None) -> List[dict]:
+        """当前排序及各层统计，用于 /status 显示"""
+        result = []
+        for key in self.rank(policy, keys):
+            stats = self.stats[key]
+            latency = stats.latency
+            result.append({
+                "key": key,
+                "name": self.name(key),
+                "latency": None if latency is None else round(latency, 2),
+                "error_rate": round(stats.error_rate, 3),
+                "samples": stats.samples,
+                "quality": self.quality(key),
+                "cost": self.cost(key),
+                "state": self.breakers[key].state,
+            })
+        return result
+
+    def attempts(self, handlers: Dict[str, Callable[[], Awaitable]],
+                 accept: Callable[[object], bool] = lambda result: result is not None,
+                 policy: Optional[str] = None):
+        """生成 race() 使用的尝试列表：按 policy 排序、只含已注册且未熔断的层
+
+        每次调用的结果会记录到对应熔断器；被对冲取消的请求和本地限流不计入失败。
+        race() 按需启动后面的层，半开试探名额在该层真正启动时才领取。
+        """
+        self._sync_later()
+        attempts = []
+        for key in self.rank(policy, handlers):
+            if key not in handlers:
+                continue
+            if not self.breakers[key].available():
+                logger.info(f"⏭️ {self.name(key)} 熔断中，跳过")
+                metrics.FAILOVERS.inc(layer=key, reason="breaker_open")
+                continue
+            attempts.append((key, self._guard(key, handlers[key], accept)))
+        return attempts
+
+    def _guard(self, key, factory, accept):
+        breaker = self.breakers[key]
+        stats = self.stats[key]
+
+        def throttled(started, probing):
+            # 本地限流：请求没有发出，不计入熔断和失败率；占用的试探名额交还
+            if probing:
+                breaker.cancel_probe()
+            metrics.LAYER_DURATION.observe(time.perf_counter() - started, layer=key, outcome="throttled")
+            metrics.FAILOVERS.inc(layer=key, reason=LOCAL_THROTTLE)
+
+        def failed(error, started):
+            breaker.record_failure(error)
+            stats.observe(False)
+            metrics.LAYER_DURATION.observe(time.perf_counter() - started, layer=key, outcome="failed")
+            metrics.FAILOVERS.inc(layer=key, reason=metrics.failure_reason(error))
+
+        async def guarded():
+            # 排在前面的层先返回时本函数不会被调用，熔断状态保持不变
+            if not await breaker.allow():
+                metrics.FAILOVERS.inc(layer=key, reason="breaker_open")
+                raise LayerUnavailable(f"{self.name(key)} 熔断中")
+            probing = breaker.state == HALF_OPEN
+            started = time.perf_counter()
+            try:
+                result = await factory()
+            except asyncio.CancelledError:
+                # 试探请求被取消，下次请求重新试探
+                if probing:
+                    breaker.cancel_probe()
+                metrics.LAYER_DURATION.observe(time.perf_counter() - started, layer=key, outcome="cancelled")
+                raise
+            except Exception as e:
+                if is_local_throttle(e):
+                    throttled(started, probing)
+                else:
+                    failed(e, started)
+                raise
+            if accept(result):
+                breaker.record_success()
+                stats.observe(True, time.perf_counter() - started)
+                metrics.LAYER_DURATION.observe(time.perf_counter() - started, layer=key, outcome="ok")
+            elif is_local_throttle(result):
+                throttled(started, probing)
+            else:
+                failed(result, started)
+            return result
+        return guarded
+
+    def status(self) -> Dict[str, dict]:
+        """内存中的熔断状态；需要其他实例的最新状态时先 await sync()"""
+        return {
+            key: {
+                "name": self.name(key),
+                "priority": self.priority(key),
+                "state": self.breakers[key].state,
+                "failures": self.breakers[key].failures,
+                "retry_in": round(self.breakers[key].retry_in()),
+            }
+            for key in self.order()
+        }
+
+    async def probe_loop(self, probes: Dict[str, Callable[[], Awaitable[bool]]]):
+        """后台试探已熔断的层，recovery_check 到期后调用探针，成功即关闭熔断"""
+        intervals = [self.layers[k].get('health_check_interval', 30) for k in probes if k in self.layers]
+        tick = min(intervals) if intervals else 30
+        while True:
+            await asyncio.sleep(tick)
+            for key, probe in probes.items():
+                breaker = self.breakers.get(key)
+                if breaker is None:
+                    continue
+                await breaker.sync()
+                # OPEN 到期，或 HALF_OPEN 的试探已过期无结果
+                if breaker.state == CLOSED or not breaker.available() or not await breaker.claim_probe():
+                    continue
+                try:
+                    ok = await probe()
+                except Exception as e:
+                    ok = False
+                    logger.warning(f"{self.name(key)} 探测失败: {e}")
+                if ok:
+                    breaker.record_success()
+                    self.stats[key].observe(True)
+                else:
+                    breaker.state = HALF_OPEN
+                    breaker.record_failure("probe failed")
+
+    def start_probing(self, probes: Dict[str, Callable[[], Awaitable[bool]]]):
+        if self._probe_task is None and probes:
+            self._probe_task = asyncio.ensure_future(self.probe_loop(probes))
+
+    async def stop_probing(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+
+# 应急模式：所有AI层不可用时的预设规则回复
+EMERGENCY_RULES = [
+    (('你好', 'hello', 'hi', '在吗', '介绍'), "🎸 我是 ÖNIKA LI，LiveGigs Asia 的摇滚运营助理。AI层正在恢复中，稍后就能正常对话！"),
+    (('帮助', 'help', '指令'), "📋 /start 启动 · /status 状态 · /help 帮助\nAI层恢复后即可使用 /create 生成内容"),
+    (('状态', 'status'), "🔴 所有AI层暂时熔断，系统每隔几分钟自动试探恢复。"),
+]
+EMERGENCY_DEFAULT = "⚠️ 所有AI层都暂时不可用，已进入应急模式。消息已收到，请稍后再试。"
+
+
+def _keyword_in(keyword: str, text: str) -> bool:
+    """英文关键词按整词匹配（'hi' 不匹配 this / which），中文关键词按子串匹配"""
+    if keyword.isascii():
+        return re.search(rf'(?<![a-z0-9]){re.escape(keyword)}(?![a-z0-9])', text) is not None
+    return keyword in text
+
+
+def emergency_reply(message: str) -> str:
+    """按关键词匹配预设回复，不访问任何外部服务"""
+    lowered = (message or '').lower()
+    for keywords, reply in EMERGENCY_RULES:
+        if any(_keyword_in(kw, lowered) for kw in keywords):
+            return reply
+    return EMERGENCY_DEFAULT
@@ -0,0 +1,109 @@
+"""
+ÖNIKA LI 更新调度
+不同会话的更新并发处理，同一会话内严格按到达顺序；/start、/status、/help 走独立的快速通道
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Iterable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+from onikali import metrics
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_PRIORITY_WORKERS = int(os.getenv('UPDATE_PRIORITY_WORKERS', '2'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1000'))
+PRIORITY_COMMANDS = ("start", "status", "help")
+
+UPDATE_WAIT = metrics.REGISTRY.histogram(
+    "onikali_update_wait_seconds", "更新从到达到开始处理的等待时间", ["lane"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+UPDATES_RUNNING = metrics.REGISTRY.gauge("onikali_updates_running", "正在处理的更新数", ["lane"])
+
+
+def command_of(update) -> Optional[str]:
+    """取出消息开头的指令名（去掉 @bot 后缀），不是指令返回 None"""
+    message = getattr(update, 'effective_message', None)
+    text = getattr(message, 'text', None) or ''
+    if not text.startswith('/'):
+        return None
+    return text[1:].split(maxsplit=1)[0].split('@', 1)[0].lower() if len(text) > 1 else None
+
+
+def chat_of(update):
+    chat = getattr(update, 'effective_chat', None)
+    return chat.id if chat is not None else None
+
+
+class ChatScheduler(BaseUpdateProcessor):
+    """按会话排序的更新处理器
+
+    每个会话维护一条链：后到的更新等前一条处理完再开始，不同会话互不等待。
+    开始处理前按通道占用工作位：普通通道 workers 个，快速通道 priority_workers 个，
+    长时间的生成任务占满普通通道时，其他会话的 /status 等仍能立即处理。
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, priority_workers: int = UPDATE_PRIORITY_WORKERS,
+                 max_pending: int = UPDATE_MAX_PENDING,
+                 priority_commands: Iterable[str] = PRIORITY_COMMANDS):
+        # 父类的信号量只限制已接收的更新总数，实际并发由各通道的工作位控制
+        super().__init__(max(max_pending, workers + priority_workers))
+        self.workers = workers
+        self.priority_workers = priority_workers
+        self.priority_commands = frozenset(priority_commands)
+        self._lanes: Dict[str, asyncio.Semaphore] = {}
+        self._tails: Dict[Any, asyncio.Future] = {}
+        self.pending = 0
+
+    def lane(self, update) -> str:
+        return "priority" if command_of(update) in self.priority_commands else "default"
+
+    def _lane_slots(self, lane: str) -> asyncio.Semaphore:
+        semaphore = self._lanes.get(lane)
+        if semaphore is None:
+            size = self.priority_workers if lane == "priority" else self.workers
+            semaphore = self._lanes[lane] = asyncio.Semaphore(max(1, size))
+        return semaphore
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = chat_of(update)
+        lane = self.lane(update)
+        arrived = time.perf_counter()
+        previous = self._tails.get(chat) if chat is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if chat is not None:
+            self._tails[chat] = done
+        self.pending += 1
+        started = False
+        try:
+            if previous is not None:
+                # shield：本更新被取消时不影响前一条的完成信号
+                await asyncio.shield(previous)
+            async with self._lane_slots(lane):
+                UPDATE_WAIT.observe(time.perf_counter() - arrived, lane=lane)
+                UPDATES_RUNNING.inc(lane=lane)
+                started = True
+                try:
+                    await coroutine
+                finally:
+                    UPDATES_RUNNING.dec(lane=lane)
+        finally:
+            self.pending -= 1
+            if not started and hasattr(coroutine, 'close'):
+                # 排队期间被取消，避免协程未被等待的警告
+                coroutine.close()
+            if not done.done():
+                done.set_result(None)
+            if self._tails.get(chat) is done:
+                del self._tails[chat]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,313 @@
+"""
+ÖNIKA LI 用户会话存储
+内存 LRU（__slots__ 记录）+ SQLite 延迟批量写入，保存每个用户的草稿版本历史；
+多实例部署时改用共享后端（SharedSessionStore）
+"""
+
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from onikali.state import StateError
+
+logger = logging.getLogger(__name__)
+
+# 会话中只保留精简的搜索结果
+MAX_SEARCH_RESULTS = 3
+MAX_DESCRIPTION = 200
+
+
+class Session:
+    """单个用户的当前草稿"""
+
+    __slots__ = ('user_id', 'topic', 'content', 'filepath', 'search_results', 'version', 'updated')
+
+    def __init__(self, user_id, topic, content, filepath=None, search_results=None, version=1, updated=None):
+        self.user_id = user_id
+        self.topic = topic
+        self.content = content
+        self.filepath = filepath
+        self.search_results = search_results
+        self.version = version
+        self.updated = updated or time.time()
+
+
+def compact_results(results) -> Optional[list]:
+    if not results:
+        return None
+    return [
+        {'title': r.get('title', ''), 'url': r.get('url', ''), 'description': r.get('description', '')[:MAX_DESCRIPTION]}
+        for r in results[:MAX_SEARCH_RESULTS]
+    ]
+
+
+class SessionStore:
+    """按用户保存草稿
+
+    读：先查内存 LRU，未命中再查 SQLite；
+    写：先更新内存，再由后台任务每 flush_interval 秒批量写入磁盘。
+    """
+
+    def __init__(self, path: str, maxsize: int = 1000, flush_interval: float = 2.0, history: int = 10):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.history_size = history
+        self._cache: "OrderedDict[int, Session]" = OrderedDict()
+        self._pending: List[Session] = []
+        self._lock = threading.Lock()
+        self._task = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    user_id INTEGER PRIMARY KEY, topic TEXT, content TEXT, filepath TEXT,
+                    search_results TEXT, version INTEGER, updated REAL
+                );
+                CREATE TABLE IF NOT EXISTS drafts (
+                    user_id INTEGER, version INTEGER, topic TEXT, content TEXT, filepath TEXT, created REAL,
+                    PRIMARY KEY (user_id, version)
+                );
+            """)
+
+    def _remember(self, session: Session):
+        self._cache[session.user_id] = session
+        self._cache.move_to_end(session.user_id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def _local(self, user_id) -> Optional[Session]:
+        session = self._cache.get(user_id)
+        if session is not None:
+            self._cache.move_to_end(user_id)
+            return session
+        # 已被LRU淘汰但尚未写盘的版本
+        for pending in reversed(self._pending):
+            if pending.user_id == user_id:
+                self._remember(pending)
+                return pending
+        return None
+
+    def _select(self, user_id) -> Optional[Session]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT topic, content, filepath, search_results, version, updated FROM sessions WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Session(user_id, row[0], row[1], row[2], json.loads(row[3]) if row[3] else None, row[4], row[5])
+
+    def get(self, user_id) -> Optional[Session]:
+        session = self._local(user_id)
+        if session is not None:
+            return session
+        session = self._select(user_id)
+        if session is not None:
+            self._remember(session)
+        return session
+
+    def __contains__(self, user_id) -> bool:
+        return self.get(user_id) is not None
+
+    async def aget(self, user_id) -> Optional[Session]:
+        """与 get() 相同，LRU 未命中时在线程中查询 SQLite，不阻塞事件循环"""
+        session = self._local(user_id)
+        if session is not None:
+            return session
+        session = await asyncio.to_thread(self._select, user_id)
+        # 查询期间可能已保存了新版本，以内存中的为准
+        newer = self._local(user_id)
+        if newer is not None:
+            return newer
+        if session is not None:
+            self._remember(session)
+        return session
+
+    def _next(self, previous: Optional[Session], user_id, topic, content, filepath, search_results) -> Session:
+        """记录新版本草稿；未提供搜索结果时沿用上一版本的"""
+        if previous is not None and search_results is None:
+            search_results = previous.search_results
+        session = Session(
+            user_id, topic, content, filepath, compact_results(search_results),
+            version=previous.version + 1 if previous else 1
+        )
+        self._remember(session)
+        self._pending.append(session)
+        return session
+
+    async def asave_draft(self, user_id, topic, content, filepath=None, search_results=None) -> Session:
+        return self._next(await self.aget(user_id), user_id, topic, content, filepath, search_results)
+
+    def save_draft(self, user_id, topic, content, filepath=None, search_results=None) -> Session:
+        return self._next(self.get(user_id), user_id, topic, content, filepath, search_results)
+
+    def history(self, user_id, limit: int = 10) -> List[dict]:
+        """最近的草稿版本（新到旧），包含尚未写入磁盘的版本"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT version, topic, filepath, created FROM drafts WHERE user_id = ? ORDER BY version DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        versions = {row[0]: {"version": row[0], "topic": row[1], "filepath": row[2], "created": row[3]} for row in rows}
+        for s in self._pending:
+            if s.user_id == user_id:
+                versions[s.version] = {"version": s.version, "topic": s.topic, "filepath": s.filepath, "created": s.updated}
+        return sorted(versions.values(), key=lambda v: -v["version"])[:limit]
+
+    def _write(self, batch: List[Session]):
+        with self._lock, self._db:
+            for s in batch:
+                results = json.dumps(s.search_results, ensure_ascii=False) if s.search_results else None
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (s.user_id, s.topic, s.content, s.filepath, results, s.version, s.updated)
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO drafts VALUES (?, ?, ?, ?, ?, ?)",
+                    (s.user_id, s.version, s.topic, s.content, s.filepath, s.updated)
+                )
+                self._db.execute(
+                    "DELETE FROM drafts WHERE user_id = ? AND version <= ?",
+                    (s.user_id, s.version - self.history_size)
+                )
+
+    async def flush(self):
+        if not self._pending:
+            return
+        # 写盘完成前这些版本仍留在 _pending 中，保证读取不会拿到旧数据
+        batch = list(self._pending)
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except sqlite3.Error as e:
+            logger.error(f"会话写入失败，稍后重试: {e}")
+            return
+        self._pending = self._pending[len(batch):]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SharedSessionStore:
+    """会话直接读写共享后端（onikali.state），多个 worker / 实例看到同一份草稿
+
+    接口与 SessionStore 相同；不做本地缓存，每次读取都访问后端。
+    事件循环中用 aget()/asave_draft()：读取不阻塞事件循环，写入不等待后端。
+    """
+
+    def __init__(self, backend, history: int = 10, ttl: float = 30 * 86400):
+        self.backend = backend
+        self.history_size = history
+        self.ttl = ttl
+
+    @staticmethod
+    def _session(user_id, row) -> Optional[Session]:
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        return Session(user_id, data['topic'], data['content'], data.get('filepath'),
+                       data.get('search_results'), data.get('version', 1), data.get('updated'))
+
+    def get(self, user_id) -> Optional[Session]:
+        try:
+            return self._session(user_id, self.backend.get(f"session:{user_id}"))
+        except StateError as e:
+            logger.error(f"会话读取失败: {e}")
+            return None
+
+    async def aget(self, user_id) -> Optional[Session]:
+        try:
+            return self._session(user_id, await self.backend.aget(f"session:{user_id}"))
+        except StateError as e:
+            logger.error(f"会话读取失败: {e}")
+            return None
+
+    def __contains__(self, user_id) -> bool:
+        return self.get(user_id) is not None
+
+    def _next(self, previous, user_id, topic, content, filepath, search_results):
+        """新版本会话，以及写入后端的会话记录和历史条目"""
+        if previous is not None and search_results is None:
+            search_results = previous.search_results
+        session = Session(
+            user_id, topic, content, filepath, compact_results(search_results),
+            version=previous.version + 1 if previous else 1
+        )
+        record = {"topic": topic, "content": content, "filepath": filepath,
+                  "search_results": session.search_results, "version": session.version, "updated": session.updated}
+        entry = {"version": session.version, "topic": topic, "filepath": filepath, "created": session.updated}
+        return session, json.dumps(record, ensure_ascii=False), entry
+
+    def save_draft(self, user_id, topic, content, filepath=None, search_results=None) -> Session:
+        session, record, entry = self._next(self.get(user_id), user_id, topic, content, filepath, search_results)
+        try:
+            self.backend.set(f"session:{user_id}", record, self.ttl)
+            versions = [entry] + self.history(user_id, self.history_size - 1)
+            self.backend.set(f"history:{user_id}", json.dumps(versions, ensure_ascii=False), self.ttl)
+        except StateError as e:
+            logger.error(f"会话写入失败: {e}")
+        return session
+
+    async def asave_draft(self, user_id, topic, content, filepath=None, search_results=None) -> Session:
+        previous = await self.aget(user_id)
+        session, record, entry = self._next(previous, user_id, topic, content, filepath, search_results)
+        # 写入按提交顺序执行，之后的读取能看到新版本
+        self.backend.set_nowait(f"session:{user_id}", record, self.ttl)
+        versions = [entry] + await self.ahistory(user_id, self.history_size - 1)
+        self.backend.set_nowait(f"history:{user_id}", json.dumps(versions, ensure_ascii=False), self.ttl)
+        return session
+
+    @staticmethod
+    def _history(row, limit: int) -> List[dict]:
+        return json.loads(row[0])[:limit] if row else []
+
+    def history(self, user_id, limit: int = 10) -> List[dict]:
+        try:
+            return self._history(self.backend.get(f"history:{user_id}"), limit)
+        except StateError as e:
+            logger.error(f"草稿历史读取失败: {e}")
+            return []
+
+    async def ahistory(self, user_id, limit: int = 10) -> List[dict]:
+        try:
+            return self._history(await self.backend.aget(f"history:{user_id}"), limit)
+        except StateError as e:
+            logger.error(f"草稿历史读取失败: {e}")
+            return []
+
+    async def flush(self):
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        await asyncio.to_thread(self.backend.close)
+
+    def __len__(self):
+        return 0
@@ -0,0 +1,73 @@
+"""
+ÖNIKA LI 请求合并（single-flight）
+相同键的并发请求只向上游发起一次，所有调用方等待并共享同一个结果
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from onikali import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCED = metrics.REGISTRY.counter(
+    "onikali_coalesced_total", "与进行中的相同请求合并、未单独调用上游的次数", ["flight"])
+
+
+class _Flight:
+    __slots__ = ('task', 'waiters', 'data')
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.data: Dict[str, Any] = {}
+
+
+class SingleFlight:
+    """进行中请求的合并表
+
+    do() 的 factory(data) 只在该键没有进行中的请求时调用；data 是本次合并共享的字典，
+    join(data) 对每个调用方（包括第一个）调用，可用于挂接各自的进度显示。
+    某个调用方被取消只影响它自己；最后一个调用方离开时才取消上游请求。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def __contains__(self, key) -> bool:
+        return key in self._flights
+
+    async def do(self, key: Hashable, factory: Callable[[dict], Awaitable],
+                 join: Optional[Callable[[dict], None]] = None):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            if join:
+                join(flight.data)
+            flight.task = asyncio.ensure_future(factory(flight.data))
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        else:
+            COALESCED.inc(flight=self.name)
+            if join:
+                join(flight.data)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled() and flight.task.exception() is not None and flight.waiters == 0:
+            # 调用方都已离开时读取异常，避免 "exception was never retrieved" 告警
+            logger.debug(f"合并请求 {self.name} 失败且无人等待: {flight.task.exception()}")
@@ -0,0 +1,561 @@
+"""
+ÖNIKA LI 共享状态后端
+多个 worker / 实例共享会话、层健康、缓存和去重窗口：单机用 SQLite，多机用 Redis 协议的存储
+
+事件循环中用 aget()/aadd() 等待结果，用 set_nowait()/delete_nowait() 写入不等待：
+SQLite 的读写在每个后端专用的 I/O 线程中执行，Redis 用异步客户端在一条连接上流水线发送；
+两者都按提交顺序执行，先提交的写入对之后的读取可见。get()/set() 等同步方法会阻塞，只在事件循环外使用。
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+# 为空时各组件使用进程内状态；sqlite:///路径 或 redis://[:密码@]主机:端口/库号
+STATE_BACKEND = os.getenv('STATE_BACKEND', '')
+STATE_TIMEOUT = float(os.getenv('STATE_TIMEOUT', '0.5'))
+STATE_PREFIX = os.getenv('STATE_PREFIX', 'onikali')
+# 熔断状态、当前层等从共享后端同步到内存的最短间隔（秒）
+STATE_SYNC_INTERVAL = float(os.getenv('STATE_SYNC_INTERVAL', '2'))
+
+
+class StateError(Exception):
+    """后端不可用或返回错误；调用方按各自的降级方式处理"""
+
+
+def _io_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='onikali-state')
+
+
+def _log_write_error(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.warning(f"共享状态写入失败: {error}")
+
+
+class StateBackend:
+    """键值存储接口：值为字符串，每个键带过期时间（时间戳，秒）
+
+    get/set/add/delete 是阻塞调用；异步方法默认在专用 I/O 线程中执行它们。
+    """
+
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = _io_executor()
+        return self._executor
+
+    async def run(self, fn, *args):
+        """在 I/O 线程中执行 fn(*args) 并等待结果，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    async def aget(self, key: str) -> Optional[Tuple[str, float]]:
+        return await self.run(self.get, key)
+
+    async def aadd(self, key: str, value: str, ttl: float) -> bool:
+        return await self.run(self.add, key, value, ttl)
+
+    def set_nowait(self, key: str, value: str, ttl: float):
+        """提交写入后立即返回；失败只记录日志"""
+        self.executor.submit(self.set, key, value, ttl).add_done_callback(_log_write_error)
+
+    def delete_nowait(self, key: str):
+        self.executor.submit(self.delete, key).add_done_callback(_log_write_error)
+
+    def drain(self, timeout: Optional[float] = None):
+        """等待已提交的写入完成（退出前调用）"""
+        self.executor.submit(lambda: None).result(timeout)
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """返回 (值, 过期时间)，不存在或已过期返回 None"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        """键不存在（或已过期）时写入并返回 True，多个实例同时写入时只有一个成功"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """单机共享：同一个数据库文件，每个命名空间一张表
+
+    表结构与 TTLCache 原有的磁盘层相同；WAL 模式下多个 worker 进程可以同时读写。
+    """
+
+    def __init__(self, path: str, table: str = 'state'):
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=STATE_TIMEOUT * 10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._db.execute(f"DELETE FROM {table} WHERE expires < ?", (time.time(),))
+            self._db.commit()
+        except sqlite3.Error as e:
+            raise StateError(f"SQLite 不可用 {path}: {e}") from e
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._db.execute(f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            raise StateError(str(e)) from e
+        if row is None or row[1] < time.time():
+            return None
+        return row[0], row[1]
+
+    def set(self, key, value, ttl):
+        try:
+            with self._lock, self._db:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+                    (key, value, time.time() + ttl)
+                )
+        except sqlite3.Error as e:
+            raise StateError(str(e)) from e
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        try:
+            with self._lock, self._db:
+                # 过期的旧记录视为不存在；单条语句在 SQLite 中是原子的
+                cursor = self._db.execute(
+                    f"INSERT INTO {self.table} (key, value, expires) VALUES (?, ?, ?) "
+                    f"ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+                    f"WHERE {self.table}.expires < ?",
+                    (key, value, now + ttl, now)
+                )
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            raise StateError(str(e)) from e
+
+    def delete(self, key):
+        try:
+            with self._lock, self._db:
+                self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            raise StateError(str(e)) from e
+
+    def close(self):
+        # 已提交的写入先落盘
+        self.drain()
+        with self._lock:
+            self._db.close()
+
+
+class RedisConnection:
+    """最小的 RESP2 客户端（同步、带锁），只实现本项目用到的命令，不依赖 redis 包"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = STATE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = STATE_TIMEOUT) -> 'RedisConnection':
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return cls(parsed.hostname or '127.0.0.1', parsed.port or 6379, db, password, timeout)
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = b""
+        if self.password:
+            self._call_locked([("AUTH", self.password)])
+        if self.db:
+            self._call_locked([("SELECT", str(self.db))])
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _readline(self) -> bytes:
+        while b"\r\n" not in self._buffer:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("连接已关闭")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\r\n", 1)
+        return line
+
+    def _read_exact(self, n: int) -> bytes:
+        while len(self._buffer) < n + 2:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("连接已关闭")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:n], self._buffer[n + 2:]
+        return data
+
+    def _read_reply(self):
+        line = self._readline()
+        kind, rest = line[:1], line[1:]
+        if kind == b"+":
+            return rest.decode('utf-8')
+        if kind == b"-":
+            # 先读完同一批的其余响应再抛出，连接保持可用
+            return StateError(f"Redis 错误: {rest.decode('utf-8', 'replace')}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else self._read_exact(n).decode('utf-8')
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read_reply() for _ in range(n)]
+        raise StateError(f"无法解析的 Redis 响应: {line[:50]!r}")
+
+    def _call_locked(self, commands: List[tuple]) -> list:
+        # 一次发送多条命令（流水线），按顺序读回结果
+        self._sock.sendall(b"".join(self._encode(c) for c in commands))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, StateError):
+                raise reply
+        return replies
+
+    def pipeline(self, *commands: tuple) -> list:
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call_locked(list(commands))
+                except StateError:
+                    raise
+                except (OSError, ValueError) as e:
+                    self.close_socket()
+                    # 空闲连接被服务端关闭时重连一次；超时不重试，避免命令被执行两次
+                    if attempt or isinstance(e, socket.timeout):
+                        raise StateError(f"Redis 不可用 {self.host}:{self.port}: {e}") from e
+
+    def call(self, *args):
+        return self.pipeline(args)[0]
+
+    def close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            self._buffer = b""
+
+
+def _reply_future() -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    # 调用方超时放弃后，迟到的连接错误不再报告为“未读取的异常”
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
+
+
+class _Stream:
+    """一条异步连接：写端和按发送顺序等待响应的调用"""
+
+    __slots__ = ('writer', 'waiters')
+
+    def __init__(self, writer):
+        self.writer = writer
+        # 每个元素为 [future, 已读到的响应, 命令数]
+        self.waiters = deque()
+
+    def send(self, commands: List[tuple]) -> asyncio.Future:
+        future = _reply_future()
+        self.waiters.append([future, [], len(commands)])
+        self.writer.write(b"".join(RedisConnection._encode(c) for c in commands))
+        return future
+
+    def fail(self, error: StateError):
+        self.writer.close()
+        while self.waiters:
+            future = self.waiters.popleft()[0]
+            if not future.done():
+                future.set_exception(error)
+
+
+class AsyncRedisConnection:
+    """RESP2 异步客户端：各协程的命令在同一条连接上流水线发送，由读取任务按顺序分发响应
+
+    慢的 Redis 只让等待结果的协程变慢，不阻塞事件循环；超时只影响本次调用，迟到的响应照常读走，连接保持同步。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = STATE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._loop = None
+        self._stream: Optional[_Stream] = None
+        self._connecting = None
+        # 连接建立前提交的命令，连接后按顺序发送
+        self._backlog = deque()
+        self._readers = set()
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = STATE_TIMEOUT) -> 'AsyncRedisConnection':
+        sync = RedisConnection.from_url(url, timeout)
+        return cls(sync.host, sync.port, sync.db, sync.password, timeout)
+
+    def _current(self) -> Optional[_Stream]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 换了事件循环（如命令行里多次 asyncio.run），旧连接不能再用
+            self._loop, self._stream, self._connecting = loop, None, None
+            self._backlog = deque()
+        return self._stream
+
+    async def _open(self):
+        try:
+            stream = await self._handshake()
+        except StateError as e:
+            while self._backlog:
+                future = self._backlog.popleft()[1]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._connecting = None
+        self._stream = stream
+        while self._backlog:
+            commands, future = self._backlog.popleft()
+            stream.send(commands).add_done_callback(functools.partial(_chain, future))
+
+    async def _handshake(self) -> _Stream:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise StateError(f"Redis 不可用 {self.host}:{self.port}: {e}") from e
+        stream = _Stream(writer)
+        task = asyncio.ensure_future(self._read_loop(reader, stream))
+        self._readers.add(task)
+        task.add_done_callback(self._readers.discard)
+        handshake = []
+        if self.password:
+            handshake.append(("AUTH", self.password))
+        if self.db:
+            handshake.append(("SELECT", str(self.db)))
+        if handshake:
+            try:
+                await self._wait(stream.send(handshake))
+            except StateError:
+                stream.fail(StateError("Redis 握手失败"))
+                raise
+        return stream
+
+    async def _wait(self, future: asyncio.Future) -> list:
+        try:
+            replies = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError as e:
+            raise StateError(f"Redis 超时 {self.host}:{self.port}") from e
+        for reply in replies:
+            if isinstance(reply, StateError):
+                raise reply
+        return replies
+
+    async def _read_reply(self, reader):
+        line = (await reader.readuntil(b"\r\n"))[:-2]
+        kind, rest = line[:1], line[1:]
+        if kind == b"+":
+            return rest.decode('utf-8')
+        if kind == b"-":
+            return StateError(f"Redis 错误: {rest.decode('utf-8', 'replace')}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else (await reader.readexactly(n + 2))[:-2].decode('utf-8')
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [await self._read_reply(reader) for _ in range(n)]
+        raise StateError(f"无法解析的 Redis 响应: {line[:50]!r}")
+
+    async def _read_loop(self, reader, stream: _Stream):
+        error = StateError("Redis 连接已关闭")
+        try:
+            while True:
+                reply = await self._read_reply(reader)
+                waiter = stream.waiters[0]
+                waiter[1].append(reply)
+                if len(waiter[1]) == waiter[2]:
+                    stream.waiters.popleft()
+                    if not waiter[0].done():
+                        waiter[0].set_result(waiter[1])
+        except (OSError, IndexError, ValueError, StateError, asyncio.IncompleteReadError) as e:
+            error = StateError(f"Redis 连接中断 {self.host}:{self.port}: {e}")
+        finally:
+            # 还没有响应的命令全部失败，下次调用重新连接
+            if self._stream is stream:
+                self._stream = None
+            stream.fail(error)
+
+    def submit(self, *commands: tuple) -> asyncio.Future:
+        """立即写入（未连接时排队，连接后按顺序发送）并返回响应的 future，与之后提交的命令保持顺序"""
+        stream = self._current()
+        if stream is not None:
+            return stream.send(list(commands))
+        future = _reply_future()
+        self._backlog.append((list(commands), future))
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        return future
+
+    async def pipeline(self, *commands: tuple) -> list:
+        return await self._wait(self.submit(*commands))
+
+    async def call(self, *args):
+        return (await self.pipeline(args))[0]
+
+    async def close(self):
+        for task in list(self._readers):
+            task.cancel()
+        await asyncio.gather(*self._readers, return_exceptions=True)
+        self._stream = None
+
+
+def _chain(target: asyncio.Future, source: asyncio.Future):
+    if target.done():
+        if not source.cancelled():
+            source.exception()
+    elif source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _log_reply_error(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is None:
+        error = next((r for r in future.result() if isinstance(r, StateError)), None)
+    if error is not None:
+        logger.warning(f"共享状态写入失败: {error}")
+
+
+class RedisBackend(StateBackend):
+    """多机共享：Redis 协议的存储，命名空间作为键前缀，过期交给服务端
+
+    同步方法用 connection，异步方法用 aconnection；同一地址的各命名空间共用这两条连接。
+    """
+
+    def __init__(self, connection: RedisConnection, namespace: str = 'state',
+                 aconnection: Optional[AsyncRedisConnection] = None):
+        self.connection = connection
+        self.aconnection = aconnection or AsyncRedisConnection(
+            connection.host, connection.port, connection.db, connection.password, connection.timeout)
+        self.prefix = f"{STATE_PREFIX}:{namespace}:"
+
+    @staticmethod
+    def _row(value, pttl):
+        if value is None:
+            return None
+        # PTTL 为 -1 表示没有过期时间
+        expires = time.time() + pttl / 1000 if pttl >= 0 else float('inf')
+        return value, expires
+
+    def get(self, key):
+        return self._row(*self.connection.pipeline(("GET", self.prefix + key), ("PTTL", self.prefix + key)))
+
+    async def aget(self, key):
+        return self._row(*await self.aconnection.pipeline(("GET", self.prefix + key), ("PTTL", self.prefix + key)))
+
+    async def aadd(self, key, value, ttl):
+        reply = await self.aconnection.call("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)), "NX")
+        return reply == "OK"
+
+    def set_nowait(self, key, value, ttl):
+        self.aconnection.submit(("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))) \
+            .add_done_callback(_log_reply_error)
+
+    def delete_nowait(self, key):
+        self.aconnection.submit(("DEL", self.prefix + key)).add_done_callback(_log_reply_error)
+
+    def drain(self, timeout: Optional[float] = None):
+        pass
+
+    def set(self, key, value, ttl):
+        self.connection.call("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+    def add(self, key, value, ttl):
+        return self.connection.call("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)), "NX") == "OK"
+
+    def delete(self, key):
+        self.connection.call("DEL", self.prefix + key)
+
+
+_connections: Dict[str, Tuple[RedisConnection, AsyncRedisConnection]] = {}
+
+
+def open_backend(namespace: str, url: Optional[str] = None) -> Optional[StateBackend]:
+    """按 URL 打开某个命名空间的后端；URL 为空返回 None（使用进程内状态）
+
+    同一个 Redis 地址共用一条连接；SQLite 每个命名空间一张表。
+    """
+    url = STATE_BACKEND if url is None else url
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme == 'sqlite':
+        path = url[len('sqlite://'):]
+        # sqlite:///相对路径、sqlite:////绝对路径（与 SQLAlchemy 的写法一致）
+        return SQLiteBackend(path[1:] if path.startswith('/') else path, namespace)
+    if scheme in ('redis', 'rediss'):
+        if scheme == 'rediss':
+            raise StateError("暂不支持 TLS 连接（rediss://）")
+        connections = _connections.get(url)
+        if connections is None:
+            connections = _connections[url] = (RedisConnection.from_url(url), AsyncRedisConnection.from_url(url))
+        return RedisBackend(connections[0], namespace, connections[1])
+    raise StateError(f"未知的状态后端: {url}")
+
+
+def describe(url: Optional[str] = None) -> str:
+    """用于日志和 /health 的后端描述（不含密码）"""
+    url = STATE_BACKEND if url is None else url
+    if not url:
+        return "local"
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        return url
+    return f"{parsed.scheme}://{parsed.hostname}:{parsed.port or 6379}{parsed.path}"
@@ -0,0 +1,191 @@
+"""
+Webhook 并发：模型调用不阻塞事件循环
+用延迟固定的假客户端代替 Kimi / Claude 和 Telegram，N 个并发请求的总耗时应接近一次调用
+
+    python -m pytest tests/ -q
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入入口前设置：假Key、进程内状态、后台处理更新、放开本地限流
+os.environ.update({
+    "TELEGRAM_TOKEN": "123456:test",
+    "MOONSHOT_API_KEY": "test",
+    "ANTHROPIC_API_KEY": "test",
+    "STATE_BACKEND": "",
+    "WEBHOOK_INLINE": "0",
+    "LLM_CACHE_DISABLED": "1",
+    "RADAR_STATE": os.path.join(tempfile.mkdtemp(), "radar.json"),
+    "RATE_LIMIT_DEFAULT": "1000000/min",
+    "RATE_LIMIT_BURST": "100000",
+    "TG_GLOBAL_RATE": "1000000/s",
+    "TG_CHAT_RATE": "1000000/s",
+    "TG_CHAT_BURST": "100000",
+})
+
+from telegram.request import BaseRequest  # noqa: E402
+
+from api import index  # noqa: E402
+
+# 单次模型调用耗时；并发总耗时上限为其 SLACK 倍
+CALL_DELAY = 0.5
+SLACK = 1.8
+
+
+def _usage():
+    return types.SimpleNamespace(prompt_tokens=10, completion_tokens=20, input_tokens=10, output_tokens=20)
+
+
+class SlowMoonshot:
+    """openai.AsyncOpenAI 的替身：每次调用等待 CALL_DELAY 秒（不占用事件循环）"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(CALL_DELAY)
+        text = "今晚有乐队现场"
+        if not stream:
+            message = types.SimpleNamespace(content=text)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=_usage())
+        return self._stream(text)
+
+    async def _stream(self, text):
+        delta = types.SimpleNamespace(content=text)
+        yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+
+class SlowClaude:
+    """anthropic.AsyncAnthropic 的替身（非流式）"""
+
+    def __init__(self):
+        self.calls = 0
+        self.messages = types.SimpleNamespace(create=self.create)
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(CALL_DELAY)
+        return types.SimpleNamespace(content=[types.SimpleNamespace(text="Claude 回复")], usage=_usage())
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API 替身：立即返回成功，sendMessage / editMessageText 返回一条消息"""
+
+    def __init__(self):
+        self.methods = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        self.methods.append(name)
+        params = request_data.parameters if request_data else {}
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "onikali", "username": "onikali_bot"}
+        elif name in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 1))
+            result = {"message_id": len(self.methods), "date": int(time.time()), "text": params.get("text", ""),
+                      "chat": {"id": chat_id, "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+
+def update_data(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "test"},
+        },
+    }
+
+
+class ConcurrencyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        from telegram.ext import Application
+        from onikali.ratelimit import RateLimiters
+        from onikali.scheduler import ChatScheduler
+
+        # 每个用例使用新的状态：熔断器、限流器、单飞表都绑定当前事件循环
+        self.state = index.bot_state = index.BotState()
+        self.state._moonshot_client = self.moonshot = SlowMoonshot()
+        self.state._anthropic_client = self.claude = SlowClaude()
+        # 测的是并发而不是配额：不使用配置中各层的限流
+        self.state.limiters = RateLimiters()
+        self.telegram = FakeTelegram()
+        self.state.application = (
+            Application.builder().token(os.environ["TELEGRAM_TOKEN"])
+            .request(self.telegram).get_updates_request(FakeTelegram())
+            .concurrent_updates(ChatScheduler(index.WEBHOOK_WORKERS, max_pending=index.WEBHOOK_QUEUE_SIZE)).build()
+        )
+        self.state._register_handlers()
+        await self.state.application.initialize()
+        self.state.initialized = True
+
+    async def asyncTearDown(self):
+        await self.state.drain()
+        await self.state.application.shutdown()
+
+    async def timed(self, coroutines) -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*coroutines)
+        return time.perf_counter() - started
+
+    async def test_call_moonshot_concurrent(self):
+        n = min(20, index.LLM_MAX_CONCURRENCY)
+        wall = await self.timed(self.state.call_moonshot(f"演出推荐 {i}") for i in range(n))
+        self.assertEqual(self.moonshot.calls, n)
+        self.assertLess(wall, CALL_DELAY * SLACK, f"{n} 次并发调用耗时 {wall:.2f}s")
+
+    async def test_call_claude_concurrent(self):
+        n = min(20, index.LLM_MAX_CONCURRENCY)
+        wall = await self.timed(self.state.call_claude(f"演出推荐 {i}") for i in range(n))
+        self.assertEqual(self.claude.calls, n)
+        self.assertLess(wall, CALL_DELAY * SLACK, f"{n} 次并发调用耗时 {wall:.2f}s")
+
+    async def test_coalesce_by_policy(self):
+        # 相同策略的相同消息合并为一次调用，不同策略各自调用
+        await asyncio.gather(*(self.state.get_ai_response("演出推荐", policy=p) for p in ("chat", "chat", "create")))
+        self.assertEqual(self.moonshot.calls + self.claude.calls, 2)
+
+    async def test_webhook_concurrent_posts(self):
+        import httpx
+
+        # 不超过后台并发处理数，全部更新应同时处理
+        n = index.WEBHOOK_WORKERS
+        transport = httpx.ASGITransport(app=index.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.post("/", json=update_data(1000 + i, 5000 + i, f"今晚有什么演出推荐 {i}"))
+                for i in range(n)
+            ))
+            await self.state.drain(timeout=30)
+            wall = time.perf_counter() - started
+        self.assertEqual([r.status_code for r in responses], [200] * n)
+        self.assertEqual(self.moonshot.calls + self.claude.calls, n)
+        self.assertEqual(self.telegram.methods.count("sendMessage"), n)
+        self.assertLess(wall, CALL_DELAY * SLACK, f"{n} 条并发更新处理耗时 {wall:.2f}s")
+
+
+if __name__ == '__main__':
+    unittest.main()
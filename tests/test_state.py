@@ -0,0 +1,160 @@
+"""
+共享状态后端：用 bench/stubs 的 Redis 协议替身检查 SET NX、过期、流水线响应顺序，
+以及多个实例经后端共用的去重窗口和熔断状态
+
+    python -m pytest tests/ -q
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.stubs import RespStub  # noqa: E402
+from onikali.cache import DedupeWindow  # noqa: E402
+from onikali.router import CLOSED, OPEN, LayerRouter  # noqa: E402
+from onikali.state import AsyncRedisConnection, RedisBackend, RedisConnection, SQLiteBackend  # noqa: E402
+
+
+class BackendCases:
+    """两种后端共用的用例；instance() 返回一个新“实例”（独立连接）使用的后端"""
+
+    async def instance(self, namespace: str = 'test'):
+        raise NotImplementedError
+
+    async def test_add_is_atomic(self):
+        backends = [await self.instance() for _ in range(2)]
+        results = await asyncio.gather(*(b.aadd("update:1", "1", 60) for b in backends for _ in range(10)))
+        self.assertEqual(results.count(True), 1)
+
+    async def test_ttl_expiry(self):
+        backend = await self.instance()
+        self.assertTrue(await backend.aadd("probe", "1", 0.2))
+        value, expires = await backend.aget("probe")
+        self.assertEqual(value, "1")
+        self.assertGreater(expires, time.time())
+        self.assertFalse(await backend.aadd("probe", "1", 0.2))
+        await asyncio.sleep(0.3)
+        self.assertIsNone(await backend.aget("probe"))
+        self.assertTrue(await backend.aadd("probe", "1", 0.2))
+
+    async def test_dedupe_claim_across_instances(self):
+        first = DedupeWindow(ttl=60, backend=await self.instance())
+        second = DedupeWindow(ttl=60, backend=await self.instance())
+        results = await asyncio.gather(first.claim(42), second.claim(42))
+        self.assertEqual(sorted(results), [False, True])
+        # 本地已登记的键不再访问后端
+        self.assertFalse(await first.claim(42))
+        self.assertFalse(await second.claim(42))
+        self.assertTrue(await second.claim(43))
+        self.assertFalse(await first.claim(43))
+
+    async def test_breaker_shared_between_routers(self):
+        config = {
+            "layers": {"L1_Kimi": {"name": "Kimi", "priority": 1}},
+            "failover": {"failure_threshold": 2, "recovery_check": 0.3},
+        }
+        first = LayerRouter(config, backend=await self.instance('layers'))
+        second = LayerRouter(config, backend=await self.instance('layers'))
+        for _ in range(2):
+            first.breakers["L1_Kimi"].record_failure("500")
+        await self.flush(first.breakers["L1_Kimi"].store)
+
+        await second.sync()
+        self.assertEqual(second.breakers["L1_Kimi"].state, OPEN)
+        self.assertFalse(second.breakers["L1_Kimi"].available())
+
+        # 到试探时间后两个实例同时试探，只有一个拿到名额
+        await asyncio.sleep(0.35)
+        allowed = await asyncio.gather(first.breakers["L1_Kimi"].allow(), second.breakers["L1_Kimi"].allow())
+        self.assertEqual(allowed.count(True), 1)
+
+        winner = first if allowed[0] else second
+        other = second if allowed[0] else first
+        winner.breakers["L1_Kimi"].record_success()
+        await self.flush(winner.breakers["L1_Kimi"].store)
+        await other.sync()
+        self.assertEqual(other.breakers["L1_Kimi"].state, CLOSED)
+
+    async def flush(self, backend):
+        """等待该实例不等待的写入完成"""
+        await asyncio.to_thread(backend.drain)
+
+
+class RedisBackendTest(BackendCases, unittest.IsolatedAsyncioTestCase):
+
+    profile = None
+
+    async def asyncSetUp(self):
+        self.stub = await RespStub(self.profile).start()
+        self.connections = []
+
+    async def asyncTearDown(self):
+        for connection, aconnection in self.connections:
+            connection.close_socket()
+            await aconnection.close()
+        await self.stub.close()
+
+    async def instance(self, namespace: str = 'test'):
+        connections = (RedisConnection.from_url(self.stub.url), AsyncRedisConnection.from_url(self.stub.url))
+        self.connections.append(connections)
+        return RedisBackend(connections[0], namespace, connections[1])
+
+    async def flush(self, backend):
+        # 同一连接上的命令按顺序执行：读到一次响应说明之前提交的写入已完成
+        await backend.aconnection.call("PING")
+
+    async def test_pipelined_replies_in_order(self):
+        connection = (await self.instance()).aconnection
+        n = 200
+        replies = await asyncio.gather(*(
+            connection.pipeline(("SET", f"k{i}", f"v{i}"), ("GET", f"k{i}")) for i in range(n)
+        ))
+        self.assertEqual(replies, [["OK", f"v{i}"] for i in range(n)])
+
+    async def test_sync_and_async_clients_share_keys(self):
+        backend = await self.instance()
+        await asyncio.to_thread(backend.set, "session", "draft", 60)
+        self.assertEqual((await backend.aget("session"))[0], "draft")
+        backend.set_nowait("session", "draft v2", 60)
+        await self.flush(backend)
+        self.assertEqual((await asyncio.to_thread(backend.get, "session"))[0], "draft v2")
+
+
+class SlowRedisBackendTest(RedisBackendTest):
+    """每条响应延迟 50ms：并发命令在一条连接上流水线发送，总耗时接近一次往返"""
+
+    profile = {"latency_ms": 50}
+
+    async def test_pipelined_commands_do_not_serialize(self):
+        connection = (await self.instance()).aconnection
+        await connection.call("PING")
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(connection.call("SET", f"k{i}", "1", "NX") for i in range(50)))
+        wall = time.perf_counter() - started
+        self.assertEqual(replies, ["OK"] * 50)
+        self.assertLess(wall, 0.05 * 10, f"50 条命令耗时 {wall:.2f}s")
+
+
+class SQLiteBackendTest(BackendCases, unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "state.db")
+        self.backends = []
+
+    async def asyncTearDown(self):
+        for backend in self.backends:
+            await asyncio.to_thread(backend.close)
+
+    async def instance(self, namespace: str = 'test'):
+        backend = SQLiteBackend(self.path, namespace)
+        self.backends.append(backend)
+        return backend
+
+
+if __name__ == '__main__':
+    unittest.main()